@@ -1,4 +1,3 @@
-import asyncio
 import builtins
 import gettext
 import logging
@@ -20,7 +19,12 @@ from streamlit import logger
 from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 from osuawa import Awapi, C, LANGUAGES, Osuawa
+from osuawa.beatmapfiles import BeatmapFileFetcher, create_beatmap_file_fetcher
+from osuawa.cache import create_cache_backend
+from osuawa.calculation import create_calculation_executor
 from osuawa.components import delete_user_cache, get_session_id, load_value, register_commands, task_board, update_user_cache
+from osuawa.osuawa import CachedMixIn, get_background_loop
+from osuawa.ratelimit import create_rate_limiter
 from osuawa.utils import RedisTaskId, create_unique_picker, read_injected_code
 
 st.session_state._debugging_mode = st.secrets.args.debugging_mode
@@ -71,14 +75,39 @@ def init_logger_fh():
     _init_logger_fh(logger.get_logger(st.session_state.username))
 
 
+@st.cache_resource
+def get_persistent_cache():
+    # 进程内只创建一次，所有会话共享；缓存策略也只在这里配置一次
+    cache_config = st.secrets.get("cache", {})
+    CachedMixIn.configure_policies(cache_config.get("policies"))
+    return create_cache_backend(cache_config)
+
+
+@st.cache_resource
+def get_rate_limiter():
+    # 所有会话共享同一个限速器
+    return create_rate_limiter(st.secrets.get("ratelimit"))
+
+
+@st.cache_resource
+def get_calculation_executor():
+    # 所有会话共享同一个计算进程池
+    return create_calculation_executor(st.secrets.get("calculation"))
+
+
+@st.cache_resource
+def get_beatmap_file_fetcher():
+    # 所有会话共享同一个 .osu 文件下载器与其限速器
+    return create_beatmap_file_fetcher(st.secrets.get("beatmap_files"))
+
+
 def register_awa(ci, cs, ru, sc, dm, oauth_token: Optional[str] = None, oauth_refresh_token: Optional[str] = None):
-    # 在 session_state 中持久化事件循环
-    if "async_loop" not in st.session_state:
-        # 创建新的事件循环
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        st.session_state.async_loop = loop
-    return Osuawa(st.session_state.async_loop, ci, cs, ru, sc, dm, st.context.cookies["ajs_anonymous_id"], oauth_token, oauth_refresh_token, debugging_mode=st.session_state._debugging_mode)
+    CachedMixIn.set_persistent_cache(get_persistent_cache())
+    Awapi.set_rate_limiter(get_rate_limiter())
+    Osuawa.set_calculation_executor(get_calculation_executor())
+    BeatmapFileFetcher.set_default(get_beatmap_file_fetcher())
+    # 所有会话共享进程内的后台事件循环与连接池
+    return Osuawa(get_background_loop(), ci, cs, ru, sc, dm, st.context.cookies["ajs_anonymous_id"], oauth_token, oauth_refresh_token, debugging_mode=st.session_state._debugging_mode)
 
 
 def toggle_immersive():
@@ -0,0 +1,79 @@
+"""
+osu-tools 计算后端的吞吐量基准测试
+
+从本地已下载的 .osu 文件（默认 ./static/beatmaps/）随机生成若干成绩（随机的 mods、准确率与 miss 数），比较原先在一个线程中逐个计算的方式与不同子进程数的进程池后端。
+计算直接调用 run_performance_job，不经过属性存储
+
+需要 osu-tools 与 pythonnet，在项目根目录下运行
+
+用法：python benchmarks/bench_calculation.py [--scores 2000] [--workers 2 4 8] [--beatmaps ./static/beatmaps/]
+"""
+
+import argparse
+import asyncio
+import glob
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from osuawa.calculation import ProcessCalculationExecutor
+from osuawa.utils import PerformanceJob, run_performance_job
+
+MODS = [[], ["HD"], ["HR"], ["DT"], ["HD", "DT"], ["HD", "HR"]]
+
+
+def make_jobs(beatmap_paths: list[str], n: int, seed: int) -> list[PerformanceJob]:
+    rng = random.Random(seed)
+    jobs = []
+    for _ in range(n):
+        performance = {"accuracy_percent": round(rng.uniform(85, 100), 2), "misses": rng.choice([0, 0, 0, 1, 2, 5, 10])}
+        jobs.append(PerformanceJob(rng.choice(beatmap_paths), 0, rng.choice(MODS), [], [performance], True))
+    return jobs
+
+
+async def inline(jobs: list[PerformanceJob]) -> list:
+    # 与原先的 complete_scores_compact 相同：在一个线程中逐个计算
+    return await asyncio.to_thread(lambda: [run_performance_job(job) for job in jobs])
+
+
+async def pooled(executor: ProcessCalculationExecutor, jobs: list[PerformanceJob]) -> list:
+    return await asyncio.gather(*(executor.run(job) for job in jobs))
+
+
+async def main(beatmaps_dir: str, n: int, workers: list[int], seed: int) -> None:
+    beatmap_paths = sorted(glob.glob(os.path.join(beatmaps_dir, "*.osu")))
+    if not beatmap_paths:
+        raise SystemExit("no .osu files found in %s" % beatmaps_dir)
+    jobs = make_jobs(beatmap_paths, n, seed)
+    print("%d scores on %d beatmaps" % (n, len(beatmap_paths)))
+    print("%12s %10s %12s" % ("method", "time (s)", "scores/s"))
+
+    start = perf_counter()
+    expected = await inline(jobs)
+    elapsed = perf_counter() - start
+    print("%12s %10.3f %12.1f" % ("inline", elapsed, n / elapsed))
+
+    for w in workers:
+        executor = ProcessCalculationExecutor(w)
+        try:
+            # 子进程的启动（加载 .NET 运行时）不计入
+            await asyncio.gather(*(executor.run(job) for job in jobs[:w]))
+            start = perf_counter()
+            results = await pooled(executor, jobs)
+            elapsed = perf_counter() - start
+        finally:
+            executor.shutdown()
+        assert [r.performances[0]["pp"] for r in results] == [r.performances[0]["pp"] for r in expected]
+        print("%12s %10.3f %12.1f" % ("workers=%d" % w, elapsed, n / elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--beatmaps", default="./static/beatmaps/", help="directory of downloaded .osu files")
+    parser.add_argument("--scores", type=int, default=2000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(main(args.beatmaps, args.scores, args.workers, args.seed))
@@ -0,0 +1,62 @@
+"""
+导入 osuawa.utils 与生成 mod 表的耗时
+
+1. 用 python -X importtime 导入 osuawa.utils，列出累计耗时最多的模块
+2. 在一个空的临时工作目录中两次生成全部四个 ruleset 的 mod 表：第一次没有磁盘缓存（需要通过 pythonnet 反射），第二次读取第一次写入的缓存
+
+每一项都在新的子进程中进行。需要 osu-tools 与 pythonnet，在项目根目录下运行
+
+用法：python benchmarks/bench_import.py [--top 15]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+MOD_TABLES_CODE = """
+import sys
+from time import perf_counter
+sys.path.insert(0, sys.argv[1])
+start = perf_counter()
+from osuawa.utils import get_mod_entries
+imported = perf_counter()
+for ruleset_id in range(4):
+    get_mod_entries(ruleset_id)
+print("%.3f %.3f" % (imported - start, perf_counter() - imported))
+"""
+
+
+def importtime(top: int) -> None:
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", "import osuawa.utils"], cwd=ROOT, capture_output=True, text=True, check=True)
+    rows = []
+    for line in r.stderr.splitlines():
+        m = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)", line)
+        if m is not None:
+            rows.append((int(m.group(2)), int(m.group(1)), m.group(4)))
+    total = max(cumulative for cumulative, _, _ in rows)
+    print("import osuawa.utils: %.3f s" % (total / 1e6))
+    print("%12s %12s  %s" % ("cumulative", "self", "module"))
+    for cumulative, self_, name in sorted(rows, reverse=True)[:top]:
+        print("%10.3fms %10.3fms  %s" % (cumulative / 1e3, self_ / 1e3, name))
+
+
+def mod_tables() -> None:
+    with tempfile.TemporaryDirectory() as cwd:
+        for name in ("cold", "warm"):
+            r = subprocess.run([sys.executable, "-c", MOD_TABLES_CODE, ROOT], cwd=cwd, capture_output=True, text=True, check=True)
+            import_s, tables_s = map(float, r.stdout.splitlines()[-1].split())
+            print("%s: import %.3f s, mod tables %.3f s" % (name, import_s, tables_s))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--top", type=int, default=15, help="number of modules to list")
+    args = parser.parse_args()
+    importtime(args.top)
+    print()
+    mod_tables()
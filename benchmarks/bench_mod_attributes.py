@@ -0,0 +1,133 @@
+"""
+批量计算 mods 调整后的谱面属性（encode_mods + calc_mod_adjusted_attributes）的等价性检查与基准测试
+
+1. 随机生成谱面属性与 mods（包含 HR/EZ/DA 的优先级、各种变速设置与 AR/OD 的边界值），确认批量结果与逐个调用 SimpleDifficultyAttribute.set_mods 的结果逐位一致
+2. 按照 bench_mods.py 中的分布生成若干成绩，比较逐个调用 set_mods 与批量计算的耗时
+
+需要 osu-tools 与 pythonnet，在项目根目录下运行
+
+用法：python benchmarks/bench_mod_attributes.py [--check 20000] [--rows 200000]
+"""
+
+import argparse
+import os
+import random
+import sys
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bench_mods import DISTRIBUTION
+from osuawa.utils import MOD_MATRIX_COLUMNS, SimpleDifficultyAttribute, calc_mod_adjusted_attributes, encode_mods
+
+# (acronym, {设置名: 生成设置值的函数})
+RANDOM_MODS = [
+    ("NF", {}),
+    ("HD", {}),
+    ("HR", {}),
+    ("EZ", {}),
+    ("DA", {"circle_size": lambda rng: rng.choice([0.0, 3.5, 7.0, 10.0])}),
+    ("DA", {"approach_rate": lambda rng: round(rng.uniform(-10.0, 11.0), 1), "overall_difficulty": lambda rng: round(rng.uniform(0.0, 11.0), 1)}),
+    ("DT", {}),
+    ("DT", {"speed_change": lambda rng: rng.choice([1.01, 1.3, 1.75, 2.0])}),
+    ("NC", {}),
+    ("HT", {}),
+    ("HT", {"speed_change": lambda rng: rng.choice([0.5, 0.8, 0.99])}),
+    ("DC", {}),
+    ("WU", {"final_rate": lambda rng: rng.choice([1.01, 1.5, 2.0])}),
+    ("WD", {"initial_rate": lambda rng: rng.choice([0.75, 1.0, 1.5])}),
+]
+
+
+def random_mods(rng: random.Random) -> list[dict]:
+    mods = []
+    acronyms = set()
+    for acronym, settings in rng.sample(RANDOM_MODS, rng.randint(0, 4)):
+        if acronym in acronyms:
+            continue
+        acronyms.add(acronym)
+        mod = {"acronym": acronym}
+        if settings:
+            mod["settings"] = {k: f(rng) for k, f in settings.items()}
+        mods.append(mod)
+    return mods
+
+
+def random_bases(rng: random.Random, n: int) -> np.ndarray:
+    # 混入整数与 preempt 边界（AR 5、AR 9.3 等）上的值
+    return np.array(
+        [
+            (
+                rng.choice([rng.uniform(0.0, 10.0), 4.0, 5.0]),
+                rng.choice([rng.uniform(0.0, 10.0), 8.0]),
+                rng.choice([rng.uniform(0.0, 10.0), 5.0, 7.0, 9.0, 9.3]),
+                rng.uniform(60.0, 300.0),
+                rng.randint(10, 600),
+            )
+            for _ in range(n)
+        ]
+    )
+
+
+def scalar(bases: np.ndarray, mods_list: list[list[dict]]) -> list[SimpleDifficultyAttribute]:
+    attributes = []
+    for (cs, accuracy, ar, bpm, hit_length), mods in zip(bases, mods_list, strict=True):
+        attribute = SimpleDifficultyAttribute(float(cs), float(accuracy), float(ar), float(bpm), int(hit_length))
+        attribute.set_mods(mods)
+        attributes.append(attribute)
+    return attributes
+
+
+def batch(bases: np.ndarray, mods_list: list[list[dict]]) -> dict[str, np.ndarray]:
+    return calc_mod_adjusted_attributes(bases[:, 0], bases[:, 1], bases[:, 2], bases[:, 3], bases[:, 4].astype(np.int64), encode_mods(mods_list))
+
+
+def check(n: int, seed: int) -> None:
+    rng = random.Random(seed)
+    mods_list = [random_mods(rng) for _ in range(n)]
+    bases = random_bases(rng, n)
+    expected = scalar(bases, mods_list)
+    actual = batch(bases, mods_list)
+    mismatches = 0
+    for column, values in actual.items():
+        for i, attribute in enumerate(expected):
+            if getattr(attribute, column) != values[i]:
+                mismatches += 1
+                if mismatches <= 10:
+                    print("mismatch in %s at %d: %r vs %r, mods %s" % (column, i, getattr(attribute, column), values[i], mods_list[i]))
+    print("checked %d rows x %d columns, %d mismatches" % (n, len(actual), mismatches))
+    if mismatches:
+        sys.exit(1)
+
+
+def bench(n: int, seed: int) -> None:
+    rng = random.Random(seed)
+    weights, combinations = zip(*DISTRIBUTION, strict=True)
+    mods_list = rng.choices(combinations, weights, k=n)
+    bases = random_bases(rng, n)
+    start = perf_counter()
+    scalar(bases, mods_list)
+    scalar_s = perf_counter() - start
+    start = perf_counter()
+    mod_matrix = encode_mods(mods_list)
+    encoded = perf_counter()
+    calc_mod_adjusted_attributes(bases[:, 0], bases[:, 1], bases[:, 2], bases[:, 3], bases[:, 4].astype(np.int64), mod_matrix)
+    batch_end = perf_counter()
+    print("%d rows, mod matrix %s" % (n, "/".join(MOD_MATRIX_COLUMNS)))
+    print("%10s %10s %14s" % ("method", "time (s)", "rows/s"))
+    print("%10s %10.3f %14.0f" % ("scalar", scalar_s, n / scalar_s))
+    print("%10s %10.3f %14.0f" % ("encode", encoded - start, n / (encoded - start)))
+    print("%10s %10.3f %14.0f" % ("compute", batch_end - encoded, n / (batch_end - encoded)))
+    print("%10s %10.3f %14.0f" % ("batch", batch_end - start, n / (batch_end - start)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", type=int, default=20000, help="number of random rows to compare")
+    parser.add_argument("--rows", type=int, default=200000, help="number of rows to time")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    check(args.check, args.seed)
+    print()
+    bench(args.rows, args.seed)
@@ -0,0 +1,111 @@
+"""
+成绩 DataFrame 中 mods 相关列的计算与筛选的等价性检查与基准测试
+
+按照 bench_mods.py 中的分布生成若干成绩，比较逐行计算与按不同组合计算后广播的结果与耗时：
+
+1. 解析 SCORE 表中 MODS 列的 JSON（scores_table_to_dataframe 中的做法，相同的值只解析一次并共享同一个对象）
+2. 可读的 mods 与 only_common_mods（calc_score_derived_columns 中的做法）
+3. 正则筛选（regex_search_column），分别用于 object 列与 category 列
+4. 按缩写集合筛选（filter_mods，在 mods_mask 上计算）与逐行的集合比较
+
+需要 osu-tools 与 pythonnet，在项目根目录下运行
+
+用法：python benchmarks/bench_mod_filters.py [--rows 200000]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+from time import perf_counter
+
+import numpy as np
+import orjson
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bench_mods import DISTRIBUTION
+from osuawa.utils import _factorize_mods, _loads_json_column, _loads_shared_json_column, encode_mod_combinations, filter_mods, regex_search_column, to_readable_mods
+
+COMMON_MODS = frozenset({"NM", "HD", "HR", "DT", "NC", "FL", "NF", "SD", "PF", "CL"})
+PATTERNS = ["HD", "^DT", r"speed_change=1\.3", "HD|HR"]
+ACRONYM_FILTERS = [(("HD",), ()), ((), ("DT", "NC")), (("HD", "DT"), ("HR",))]
+
+
+def row_wise_derived(df: pd.DataFrame) -> tuple[pd.Series, pd.Series]:
+    mods = df["_mods"].map(lambda x: "; ".join(to_readable_mods(x)))
+    only_common_mods = df["_mods"].map(lambda x: {m["acronym"] for m in x} <= COMMON_MODS).astype(bool)
+    return mods, only_common_mods
+
+
+def unique_wise_derived(df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    codes, first = _factorize_mods(df["_mods"])
+    unique_mods = [df["_mods"].iat[i] for i in first]
+    mods = np.array(["; ".join(to_readable_mods(x)) for x in unique_mods], dtype=object)[codes]
+    only_common_mods = np.array([{m["acronym"] for m in x} <= COMMON_MODS for x in unique_mods], dtype=bool)[codes]
+    return mods, only_common_mods
+
+
+def row_wise_regex(data: pd.DataFrame, column: str, pattern: str) -> pd.DataFrame:
+    data[column] = data[column].apply(lambda text: None if pd.isna(text) else (text if re.search(pattern, str(text)) else None))
+    return data
+
+
+def row_wise_acronyms(df: pd.DataFrame, required: tuple[str, ...], excluded: tuple[str, ...]) -> pd.Series:
+    return df["_mods"].map(lambda x: set(required) <= {m["acronym"] for m in x} and not set(excluded) & {m["acronym"] for m in x}).astype(bool)
+
+
+def timed(f, *args):
+    start = perf_counter()
+    result = f(*args)
+    return result, perf_counter() - start
+
+
+def normalize(values: pd.Series) -> list:
+    return [None if pd.isna(x) else x for x in values.astype(object)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    weights, combinations = zip(*DISTRIBUTION, strict=True)
+    mods_json = pd.Series([orjson.dumps(x).decode() for x in rng.choices(combinations, weights, k=args.rows)])
+
+    print("%d rows over %d combinations" % (args.rows, len(DISTRIBUTION)))
+    print("%-36s %10s %10s %8s" % ("step", "row-wise", "unique", "speedup"))
+
+    def report(name: str, old_s: float, new_s: float) -> None:
+        print("%-36s %9.3fs %9.3fs %7.1fx" % (name, old_s, new_s, old_s / new_s))
+
+    expected, old_s = timed(_loads_json_column, mods_json, "[]")
+    actual, new_s = timed(_loads_shared_json_column, mods_json, "[]")
+    assert expected == actual
+    report("decode MODS", old_s, new_s)
+    df = pd.DataFrame({"ruleset_id": 0, "_mods": actual})
+
+    (old_mods, old_ocm), old_s = timed(row_wise_derived, df)
+    (new_mods, new_ocm), new_s = timed(unique_wise_derived, df)
+    assert old_mods.tolist() == new_mods.tolist() and old_ocm.tolist() == new_ocm.tolist()
+    report("mods + only_common_mods", old_s, new_s)
+
+    df["mods"] = old_mods
+    categorical = df.assign(mods=df["mods"].astype("category"))
+    codes, mod_combinations = encode_mod_combinations(categorical)
+    categorical["mods_mask"] = np.array([c.mods_mask for c in mod_combinations], dtype=np.uint64)[codes]
+    for pattern in PATTERNS:
+        expected, old_s = timed(row_wise_regex, df.copy(), "mods", pattern)
+        actual, object_s = timed(regex_search_column, df.copy(), "mods", pattern)
+        actual_categorical, categorical_s = timed(regex_search_column, categorical.copy(), "mods", pattern)
+        assert normalize(expected["mods"]) == normalize(actual["mods"]) == normalize(actual_categorical["mods"])
+        report("regex %r (object)" % pattern, old_s, object_s)
+        report("regex %r (category)" % pattern, old_s, categorical_s)
+
+    for required, excluded in ACRONYM_FILTERS:
+        expected, old_s = timed(row_wise_acronyms, df, required, excluded)
+        actual, new_s = timed(filter_mods, categorical, required, excluded)
+        assert expected.tolist() == actual.tolist()
+        report("+%s -%s" % ("".join(required), "".join(excluded)), old_s, new_s)
@@ -0,0 +1,66 @@
+"""
+mods 规范化（SimpleDifficultyAttribute.validate_and_transform_mods）的微基准测试
+
+按照大致真实的分布（大多数成绩是 NM、HD、HR、DT 及其组合，少量带设置的 DT/DA/AC）生成若干组 mods，
+比较不使用 LRU 缓存（只用预编译的查找表）与使用 LRU 缓存时每次调用的耗时
+
+需要 osu-tools 与 pythonnet，在项目根目录下运行
+
+用法：python benchmarks/bench_mods.py [--calls 200000]
+"""
+
+import argparse
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from osuawa.utils import SimpleDifficultyAttribute, _transform_frozen_mods
+
+# (权重, mods)
+DISTRIBUTION = [
+    (30, []),
+    (20, [{"acronym": "HD"}]),
+    (10, [{"acronym": "HR"}]),
+    (10, [{"acronym": "DT"}]),
+    (8, [{"acronym": "HD"}, {"acronym": "DT"}]),
+    (6, [{"acronym": "HD"}, {"acronym": "HR"}]),
+    (4, [{"acronym": "CL"}]),
+    (3, [{"acronym": "NC"}, {"acronym": "HD"}]),
+    (2, [{"acronym": "EZ"}]),
+    (2, [{"acronym": "HD"}, {"acronym": "FL"}]),
+    (2, [{"acronym": "DT", "settings": {"speed_change": 1.3}}]),
+    (1, [{"acronym": "HT", "settings": {"speed_change": 0.8, "adjust_pitch": True}}]),
+    (1, [{"acronym": "DA", "settings": {"approach_rate": 9.5, "circle_size": 4}}]),
+    (1, [{"acronym": "AC", "settings": {"minimum_accuracy": 0.9, "accuracy_judge_mode": "1"}}]),
+]
+
+
+def bench(mods_list: list[list[dict]], cached: bool) -> float:
+    start = perf_counter()
+    for mods in mods_list:
+        if not cached:
+            _transform_frozen_mods.cache_clear()
+        SimpleDifficultyAttribute.validate_and_transform_mods(mods, 0)
+    return perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    weights, combinations = zip(*DISTRIBUTION, strict=True)
+    mods_list = rng.choices(combinations, weights, k=args.calls)
+    # 预热：编译查找表
+    SimpleDifficultyAttribute.validate_and_transform_mods([], 0)
+
+    print("%d calls over %d combinations" % (args.calls, len(DISTRIBUTION)))
+    print("%10s %10s %14s" % ("method", "time (s)", "us/call"))
+    for name, cached in (("compiled", False), ("memoized", True)):
+        _transform_frozen_mods.cache_clear()
+        elapsed = bench(mods_list, cached)
+        print("%10s %10.3f %14.2f" % (name, elapsed, elapsed / args.calls * 1e6))
+    print(_transform_frozen_mods.cache_info())
@@ -0,0 +1,95 @@
+"""
+async_get_recent_scores 分页方式的基准测试
+
+在本地启动一个模拟 ``/users/{user}/scores/recent`` 的桩服务器（每个请求固定延迟），比较原先逐页串行直到空页面的方式与不同窗口大小的 ``paginate_offsets``
+
+用法：python benchmarks/bench_pagination.py [--latency 150] [--window 1 2 4 8]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from time import perf_counter
+
+from aiohttp import ClientSession, web
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from osuawa.osuawa import paginate_offsets
+
+PAGE_SIZE = 50
+
+
+class StubApi(object):
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.total = 0
+        self.requests = 0
+        self.runner: web.AppRunner | None = None
+        self.base_url = ""
+
+    async def recent_scores(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", PAGE_SIZE))
+        await asyncio.sleep(self.latency)
+        return web.json_response([{"id": i} for i in range(offset, min(offset + limit, self.total))])
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/users/{user}/scores/recent", self.recent_scores)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base_url = "http://127.0.0.1:%d" % self.runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+
+async def serial(fetch_page) -> list:
+    # 与原先的 async_get_recent_scores 相同：逐页获取直到空页面
+    scores = []
+    offset = 0
+    while True:
+        page = await fetch_page(offset)
+        if len(page) == 0:
+            break
+        scores.extend(page)
+        offset += PAGE_SIZE
+    return scores
+
+
+async def main(latency: float, windows: list[int], totals: list[int]) -> None:
+    stub = StubApi(latency)
+    await stub.start()
+    try:
+        async with ClientSession() as session:
+
+            async def fetch_page(offset: int) -> list:
+                async with session.get("%s/users/1/scores/recent" % stub.base_url, params={"limit": PAGE_SIZE, "offset": offset}) as r:
+                    return await r.json()
+
+            print("%8s %10s %10s %10s" % ("scores", "method", "requests", "time (s)"))
+            for total in totals:
+                stub.total = total
+                methods = [("serial", lambda: serial(fetch_page))] + [("window=%d" % w, lambda w=w: paginate_offsets(fetch_page, PAGE_SIZE, w)) for w in windows]
+                for name, run in methods:
+                    stub.requests = 0
+                    start = perf_counter()
+                    scores = await run()
+                    elapsed = perf_counter() - start
+                    assert [s["id"] for s in scores] == list(range(total))
+                    print("%8d %10s %10d %10.3f" % (total, name, stub.requests, elapsed))
+    finally:
+        await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=150, help="stub latency per request (ms)")
+    parser.add_argument("--window", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--scores", type=int, nargs="+", default=[0, 30, 180, 500, 1000])
+    args = parser.parse_args()
+    asyncio.run(main(args.latency / 1000, args.window, args.scores))
@@ -0,0 +1,132 @@
+"""
+表结构迁移中的索引对常用查询的影响
+
+在一个空数据库（默认是临时的 SQLite 文件）中创建版本 0 的表，写入合成的成绩、谱面与用户，
+分别在执行 osuawa.schema.migrate 之前和之后多次执行页面与后台程序中的常用查询，比较耗时的中位数
+
+需要 osu-tools 与 pythonnet（导入 osuawa 包时加载），在项目根目录下运行
+
+用法：python benchmarks/bench_schema_indexes.py [--scores 1000000] [--users 200] [--url sqlite:///bench.sqlite3]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+from time import perf_counter
+
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from osuawa.schema import create_tables, migrate
+
+DAY = 86400.0
+END_TS = 1.76e9
+POOLS = ["_DEFAULT_POOL", *("POOL%02d" % i for i in range(30))]
+
+# (名称, 语句, 参数的种类，见 make_params)
+QUERIES = [
+    ("scores of a user in 30 days", "SELECT * FROM SCORE WHERE USER_ID = :user AND TS >= :begin_date AND TS <= :end_date ORDER BY TS", "user_range"),
+    ("all scores of a user", "SELECT * FROM SCORE WHERE USER_ID = :user ORDER BY TS", "user"),
+    ("score ids of a user", "SELECT SCORE_ID FROM SCORE WHERE USER_ID = :user", "user"),
+    ("all users", "SELECT DISTINCT USER_ID FROM SCORE ORDER BY USER_ID", None),
+    ("beatmaps of a pool", "SELECT * FROM BEATMAP WHERE 1 = 1 AND POOL = :pool AND STATUS = :status", "pool"),
+    ("duplicate songs", "SELECT U_ARTIST, U_TITLE, COUNT(*) FROM BEATMAP GROUP BY U_ARTIST, U_TITLE HAVING COUNT(*) > 1", None),
+    ("user cache of a user", "SELECT * FROM USER_CACHE WHERE USER_ID = :user", "cache_user"),
+]
+
+
+def populate(engine, args: argparse.Namespace, rng: random.Random) -> None:
+    with engine.begin() as conn:
+        create_tables(conn)
+    # 成绩只写入查询涉及的列和少量常用列，其余为 NULL
+    insert_score = text("INSERT INTO SCORE (SCORE_ID, BID, USER_ID, SCORE, ACCURACY, PP, MODS, TS, RULESET_ID, B_STAR_RATING) VALUES (:score_id, :bid, :user, :score, :accuracy, :pp, :mods, :ts, 0, :b_star_rating)")
+    # 用户的成绩数量相差很大
+    weights = [1.0 / (i + 1) for i in range(args.users)]
+    for begin in range(0, args.scores, 50000):
+        users = rng.choices(range(1, args.users + 1), weights, k=min(50000, args.scores - begin))
+        rows = [
+            {
+                "score_id": begin + i + 1,
+                "bid": rng.randrange(1, 5000000),
+                "user": user,
+                "score": rng.randrange(1000000),
+                "accuracy": rng.random(),
+                "pp": rng.uniform(0.0, 800.0),
+                "mods": '[{"acronym": "HD"}]',
+                "ts": END_TS - rng.uniform(0.0, 3 * 365 * DAY),
+                "b_star_rating": rng.uniform(1.0, 10.0),
+            }
+            for i, user in enumerate(users)
+        ]
+        with engine.begin() as conn:
+            conn.execute(insert_score, rows)
+    insert_beatmap = text("INSERT INTO BEATMAP (BID, MODS, POOL, STATUS, U_ARTIST, U_TITLE, ADD_TS) VALUES (:bid, :mods, :pool, :status, :artist, :title, :ts)")
+    with engine.begin() as conn:
+        conn.execute(
+            insert_beatmap,
+            [{"bid": i + 1, "mods": "[]", "pool": rng.choice(POOLS), "status": rng.randrange(4), "artist": "artist %d" % rng.randrange(args.beatmaps // 2), "title": "title %d" % rng.randrange(8), "ts": END_TS} for i in range(args.beatmaps)],
+        )
+    insert_user = text("INSERT INTO USER_CACHE (USER_ID, USERNAME, AID, LAST_SEEN_TS) VALUES (:user, :username, :aid, :ts)")
+    with engine.begin() as conn:
+        conn.execute(insert_user, [{"user": i % args.cache_users + 1, "username": "user %d" % i, "aid": "%032x" % i, "ts": END_TS} for i in range(args.cache_users * 2)])
+
+
+def make_params(kind, args: argparse.Namespace, rng: random.Random) -> dict:
+    match kind:
+        case "user_range":
+            end_date = END_TS - rng.uniform(0.0, 365 * DAY)
+            return {"user": rng.randint(1, min(args.users, 20)), "begin_date": end_date - 30 * DAY, "end_date": end_date}
+        case "user":
+            return {"user": rng.randint(1, min(args.users, 20))}
+        case "pool":
+            return {"pool": rng.choice(POOLS), "status": rng.randrange(4)}
+        case "cache_user":
+            return {"user": rng.randint(1, args.cache_users)}
+        case _:
+            return {}
+
+
+def time_queries(engine, args: argparse.Namespace) -> dict[str, float]:
+    rng = random.Random(args.seed)
+    medians = {}
+    with engine.connect() as conn:
+        for name, statement, kind in QUERIES:
+            elapsed = []
+            for _ in range(args.repeat):
+                params = make_params(kind, args, rng)
+                start = perf_counter()
+                conn.execute(text(statement), params).all()
+                elapsed.append(perf_counter() - start)
+            medians[name] = statistics.median(elapsed)
+    return medians
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scores", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--beatmaps", type=int, default=20000)
+    parser.add_argument("--cache-users", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=20, help="executions of each query, the median is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="an empty database, defaults to a temporary SQLite file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(args.url or "sqlite:///%s" % os.path.join(directory, "bench.sqlite3"))
+        start = perf_counter()
+        populate(engine, args, random.Random(args.seed))
+        print("%s: %d scores of %d users, %d beatmaps, %d user cache rows (%.1f s)" % (engine.dialect.name, args.scores, args.users, args.beatmaps, args.cache_users * 2, perf_counter() - start))
+        before = time_queries(engine, args)
+        start = perf_counter()
+        old_version, version = migrate(engine)
+        print("migrated from version %d to %d (%.1f s)" % (old_version, version, perf_counter() - start))
+        after = time_queries(engine, args)
+        engine.dispose()
+
+    print("%-28s %12s %12s %8s" % ("query", "before (ms)", "after (ms)", "speedup"))
+    for name, _, _ in QUERIES:
+        print("%-28s %12.2f %12.2f %7.1fx" % (name, before[name] * 1e3, after[name] * 1e3, before[name] / after[name]))
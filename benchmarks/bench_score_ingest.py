@@ -0,0 +1,129 @@
+"""
+保存成绩（run_daemon._insert_scores）的等价性检查与基准测试
+
+随机生成若干 CompletedSimpleScoreInfo，分别用原先的做法（dataclasses.asdict 加上逐个字段转换的 dict_factory，再 executemany 一条带命名参数的 INSERT）
+和 score_table_row 加上 SQLiteScoreWriter 写入两个临时的 SQLite 数据库，确认两个 SCORE 表完全相同，并比较两者转换与写入的耗时。
+派生字段的计算两者相同，这里不包含在内，派生列只写入 DERIVED_VERSION
+
+需要 osu-tools 与 pythonnet，在项目根目录下运行
+
+用法：python benchmarks/bench_score_ingest.py [--scores 100000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+from dataclasses import asdict, fields
+from datetime import datetime, timezone
+from time import perf_counter
+
+import orjson
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bench_mods import DISTRIBUTION
+from osuawa.schema import migrate
+from osuawa.scorewriter import SCORE_WRITE_COLUMNS, SQLiteScoreWriter
+from osuawa.utils import CompletedSimpleScoreInfo, SCORE_DERIVED_COLUMNS, SCORE_DERIVED_VERSION, SCORE_TABLE_COLUMNS, score_table_row
+
+# 派生列只有 DERIVED_VERSION 不为 NULL
+DERIVED_VALUES = (*(None for _ in SCORE_DERIVED_COLUMNS[:-1]), SCORE_DERIVED_VERSION)
+
+
+def random_score(rng: random.Random, mods: list[dict]) -> CompletedSimpleScoreInfo:
+    values = []
+    for f in fields(CompletedSimpleScoreInfo):
+        match f.name:
+            case "_mods":
+                values.append(mods)
+            case "ts":
+                values.append(datetime.fromtimestamp(1.7e9 + rng.random() * 1e8, timezone.utc))
+            case "st":
+                values.append(None if rng.random() < 0.1 else datetime.fromtimestamp(1.7e9 + rng.random() * 1e8, timezone.utc))
+            case "statistics":
+                values.append({"great": rng.randrange(2000), "ok": rng.randrange(100), "meh": rng.randrange(10), "miss": rng.randrange(10), "good": 0, "perfect": None, "slider_tail_hit": rng.randrange(500)})
+            case "info":
+                values.append("Artist - Title [Diff\\%d]\t(mapper)" % rng.randrange(1000))
+            case _ if f.type is bool:
+                values.append(rng.random() < 0.3)
+            case _ if f.type is int:
+                values.append(rng.randrange(1000000))
+            case _:
+                values.append(None if "Optional" in str(f.type) and rng.random() < 0.1 else rng.uniform(0.0, 1000.0))
+    return CompletedSimpleScoreInfo(*values)
+
+
+def asdict_rows(scores: dict[str, CompletedSimpleScoreInfo]) -> list[dict]:
+    rows = []
+    for pk, _v in scores.items():
+        score = asdict(
+            _v,
+            dict_factory=lambda items: {k.lstrip("_"): None if v is None else v.timestamp() if isinstance(v, datetime) else int(v) if isinstance(v, bool) else orjson.dumps(v).decode("utf-8") if isinstance(v, (list, dict)) else v for k, v in items},
+        )
+        score["score_id"] = pk
+        score.update(zip((column.lower() for column in SCORE_DERIVED_COLUMNS), DERIVED_VALUES, strict=True))
+        rows.append(score)
+    return rows
+
+
+def asdict_write(engine, rows: list[dict]) -> int:
+    params = ["user" if column == "USER_ID" else column.lower() for column in SCORE_WRITE_COLUMNS]
+    with engine.begin() as conn:
+        return conn.execute(text("INSERT INTO SCORE (%s) VALUES (%s) ON CONFLICT (SCORE_ID) DO NOTHING" % (", ".join(SCORE_WRITE_COLUMNS), ", ".join(":%s" % param for param in params))), rows).rowcount
+
+
+def tuple_rows(scores: dict[str, CompletedSimpleScoreInfo]) -> list[tuple]:
+    return [(*score_table_row(pk, score), *DERIVED_VALUES) for pk, score in scores.items()]
+
+
+def tuple_write(engine, rows: list[tuple]) -> int:
+    with engine.begin() as conn:
+        return SQLiteScoreWriter().write(conn, rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scores", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    weights, combinations = zip(*DISTRIBUTION, strict=True)
+    scores = {str(i + 1): random_score(rng, list(mods)) for i, mods in enumerate(rng.choices(combinations, weights, k=args.scores))}
+
+    with tempfile.TemporaryDirectory() as directory:
+        engines = []
+        for name in ("asdict", "tuple"):
+            engine = create_engine("sqlite:///%s" % os.path.join(directory, "%s.sqlite3" % name))
+            migrate(engine)
+            engines.append(engine)
+        asdict_engine, tuple_engine = engines
+
+        start = perf_counter()
+        rows = asdict_rows(scores)
+        converted = perf_counter()
+        inserted = asdict_write(asdict_engine, rows)
+        asdict_times = (converted - start, perf_counter() - converted)
+        assert inserted == args.scores
+
+        start = perf_counter()
+        rows = tuple_rows(scores)
+        converted = perf_counter()
+        inserted = tuple_write(tuple_engine, rows)
+        tuple_times = (converted - start, perf_counter() - converted)
+        assert inserted == args.scores
+        # 重复的成绩被忽略
+        assert tuple_write(tuple_engine, rows[: args.scores // 10]) == 0
+
+        tables = []
+        for engine in engines:
+            with engine.connect() as conn:
+                tables.append(conn.execute(text("SELECT %s FROM SCORE ORDER BY SCORE_ID" % ", ".join(SCORE_WRITE_COLUMNS))).all())
+            engine.dispose()
+        assert tables[0] == tables[1]
+        print("%d scores x %d columns, tables identical" % (args.scores, len(SCORE_TABLE_COLUMNS) + len(SCORE_DERIVED_COLUMNS)))
+
+    print("%8s %12s %12s %12s %12s" % ("method", "convert (s)", "write (s)", "total (s)", "scores/s"))
+    for name, (convert_s, write_s) in (("asdict", asdict_times), ("tuple", tuple_times)):
+        print("%8s %12.3f %12.3f %12.3f %12.0f" % (name, convert_s, write_s, convert_s + write_s, args.scores / (convert_s + write_s)))
@@ -0,0 +1,40 @@
+"""
+把 .osu 文件从一个存储后端迁移到另一个，默认从 C.BEATMAPS_CACHE_DIRECTORY 中的散文件迁移到单个 SQLite 文件
+
+迁移完成后在 secrets.toml 的 [beatmap_files] 中设置 backend = "pack"，确认无误后再手动删除原目录
+
+用法：python migrate_beatmaps.py [--source ./static/beatmaps/] [--target ./.streamlit/.cache/beatmaps.sqlite3] [--reverse] [--vacuum]
+"""
+
+import argparse
+import os
+
+_ = lambda x: x  # dummy translation function
+from osuawa import C
+from osuawa.beatmapstore import DirectoryBeatmapStore, PackBeatmapStore, migrate_beatmap_store
+
+
+def print_progress(done: int, total: int) -> None:
+    if done == total or done % 1000 == 0:
+        print("%d/%d" % (done, total))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default=C.BEATMAPS_CACHE_DIRECTORY.value, help="directory of <bid>.osu files")
+    parser.add_argument("--target", default=os.path.join(C.CACHE_DIRECTORY.value, "beatmaps.sqlite3"), help="pack file")
+    parser.add_argument("--reverse", action="store_true", help="migrate from the pack file back to the directory")
+    parser.add_argument("--vacuum", action="store_true", help="drop unreferenced blobs from the pack file afterwards")
+    args = parser.parse_args()
+
+    directory_store = DirectoryBeatmapStore(args.source)
+    pack_store = PackBeatmapStore(args.target)
+    source, target = (pack_store, directory_store) if args.reverse else (directory_store, pack_store)
+    copied = migrate_beatmap_store(source, target, print_progress)
+    print("copied %d beatmaps" % copied)
+    if args.vacuum:
+        print("removed %d unreferenced blobs" % pack_store.vacuum())
+    size, count = directory_store.size_and_count()
+    print("directory: %.2f MiB, %d beatmaps" % (size / 1048576, count))
+    size, count = pack_store.size_and_count()
+    print("pack: %.2f MiB, %d beatmaps" % (size / 1048576, count))
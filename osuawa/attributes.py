@@ -0,0 +1,206 @@
+"""
+难度与表现属性的持久化存储
+
+以 (谱面 checksum, ruleset, 规范化的 mods 与 mod options, 计算器版本) 为键，保存星级、各项技能属性以及 100/92/81/67 的 if pp，
+并在前面加一层进程内的 LRU 缓存。谱面内容或 osu-tools 版本变化时键随之变化，旧记录自然不再命中
+
+osuawa.py 和 utils.py 的约定同样适用于本文件：不包含 i18n 相关文本和 streamlit 相关语句
+"""
+
+__all__ = (
+    "AttributeKey",
+    "AttributeStore",
+    "calculator_version",
+    "make_attribute_key",
+    "make_mods_key",
+)
+
+import glob
+import hashlib
+import os
+import os.path
+import sqlite3
+import threading
+import zlib
+from collections.abc import Iterable, Mapping
+from functools import cache
+from importlib.metadata import PackageNotFoundError, version
+from typing import Any, NamedTuple, Optional
+
+import numpy as np
+import orjson
+from cachetools import LRUCache
+
+
+class AttributeKey(NamedTuple):
+    checksum: str
+    ruleset_id: int
+    mods: str
+    calculator_version: str
+
+
+@cache
+def calculator_version() -> str:
+    """计算器版本：osupp 的版本加上 osu-tools 中 osu.Game 程序集的指纹
+
+    重新编译 osu-tools（例如跟进了难度算法的改动）后指纹会变化，存储中的旧属性随之失效
+    """
+    try:
+        osupp_version = version("osupp")
+    except PackageNotFoundError:
+        osupp_version = "unknown"
+    h = hashlib.sha1()
+    home = os.environ.get("OSU_TOOLS_HOME")
+    if home:
+        for path in sorted(glob.glob(os.path.join(home, "**", "osu.Game*.dll"), recursive=True)):
+            stat = os.stat(path)
+            h.update(("%s:%d:%d\n" % (os.path.relpath(path, home), stat.st_size, stat.st_mtime_ns)).encode())
+    return "%s+%s" % (osupp_version, h.hexdigest()[:12])
+
+
+def make_mods_key(mods: list[str], mod_options: list[str]) -> str:
+    """mods 与 mod options 的顺序不影响计算结果，因此排序后拼接"""
+    return "%s|%s" % (",".join(sorted(mods)), ",".join(sorted(mod_options)))
+
+
+def make_attribute_key(checksum: str, ruleset_id: int, mods: list[str], mod_options: list[str]) -> AttributeKey:
+    """生成属性存储的键
+
+    :param checksum: 谱面 .osu 文件的 md5
+    :param ruleset_id: 计算时使用的 ruleset（转谱时与谱面本身的不同）
+    :param mods: osu-tools 所能接受的 mods
+    :param mod_options: osu-tools 所能接受的 mod options
+    :return: 键
+    """
+    return AttributeKey(checksum, ruleset_id, make_mods_key(mods, mod_options), calculator_version())
+
+
+def _dumps(obj: Any) -> bytes:
+    return zlib.compress(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY), 1)
+
+
+def _loads(data: bytes) -> Any:
+    return orjson.loads(zlib.decompress(data))
+
+
+class AttributeStore(object):
+    """难度与表现属性的持久化存储，线程安全，多个进程可以共享同一个 SQLite 文件
+
+    每个键保存一份属性字典，以及可选的 strain 序列（体积较大，只在绘制难度曲线时读取，不进入 LRU）与 float32 的 pp 曲线（按 bid 批量读取）；
+    只保存谱面级别的属性，单个成绩的 pp 每次都由 osu-tools 计算
+
+    :param path: SQLite 文件路径
+    :param maxsize: LRU 缓存的条目数
+    """
+
+    def __init__(self, path: str, maxsize: int = 4096):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._lru: LRUCache = LRUCache(maxsize)
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS BEATMAP_ATTRIBUTES(CHECKSUM TEXT, RULESET_ID INT, MODS TEXT, CALCULATOR_VERSION TEXT, ATTRIBUTES BLOB, STRAINS BLOB, PRIMARY KEY (CHECKSUM, RULESET_ID, MODS, CALCULATOR_VERSION))")
+        # 旧版本创建的表没有 BID 与 PP_CURVE
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(BEATMAP_ATTRIBUTES)")}
+        for column, column_type in (("BID", "BIGINT"), ("PP_CURVE", "BLOB")):
+            if column not in columns:
+                self._conn.execute("ALTER TABLE BEATMAP_ATTRIBUTES ADD COLUMN %s %s" % (column, column_type))
+        self._conn.execute("CREATE INDEX IF NOT EXISTS BEATMAP_ATTRIBUTES_BID ON BEATMAP_ATTRIBUTES(BID)")
+        # 旧版本按成绩保存 pp 的表，条目数随成绩无限增长，且几乎不会命中
+        self._conn.execute("DROP TABLE IF EXISTS SCORE_PERFORMANCE")
+
+    def get(self, key: AttributeKey) -> Optional[dict[str, Any]]:
+        """读取属性
+
+        :param key: 键
+        :return: 属性字典，不存在时返回 None
+        """
+        with self._lock:
+            attributes = self._lru.get(key)
+            if attributes is None:
+                row = self._conn.execute("SELECT ATTRIBUTES FROM BEATMAP_ATTRIBUTES WHERE CHECKSUM = ? AND RULESET_ID = ? AND MODS = ? AND CALCULATOR_VERSION = ?", key).fetchone()
+                if row is None or row[0] is None:
+                    return None
+                attributes = self._lru[key] = _loads(row[0])
+        return attributes
+
+    def put(self, key: AttributeKey, attributes: Mapping[str, Any], bid: Optional[int] = None) -> None:
+        """写入属性，覆盖原有的属性字典，保留 strain 序列与 pp 曲线
+
+        :param key: 键
+        :param attributes: 属性字典
+        :param bid: 谱面 id，用于按 bid 读取 pp 曲线
+        """
+        attributes = dict(attributes)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO BEATMAP_ATTRIBUTES(CHECKSUM, RULESET_ID, MODS, CALCULATOR_VERSION, ATTRIBUTES, BID) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(CHECKSUM, RULESET_ID, MODS, CALCULATOR_VERSION) DO UPDATE SET ATTRIBUTES = excluded.ATTRIBUTES, BID = COALESCE(excluded.BID, BID)",
+                (*key, _dumps(attributes), bid),
+            )
+            self._lru[key] = attributes
+
+    def put_pp_curve(self, key: AttributeKey, bid: int, pp_curve: np.ndarray) -> None:
+        """写入 pp 曲线，保留属性字典与 strain 序列
+
+        :param key: 键
+        :param bid: 谱面 id，按 bid 读取曲线时需要
+        :param pp_curve: pp 曲线，以 float32 保存
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO BEATMAP_ATTRIBUTES(CHECKSUM, RULESET_ID, MODS, CALCULATOR_VERSION, BID, PP_CURVE) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(CHECKSUM, RULESET_ID, MODS, CALCULATOR_VERSION) DO UPDATE SET BID = excluded.BID, PP_CURVE = excluded.PP_CURVE",
+                (*key, bid, np.ascontiguousarray(pp_curve, dtype=np.float32).tobytes()),
+            )
+
+    def get_pp_curves(self, items: Iterable[tuple[int, int, str]]) -> dict[tuple[int, int, str], np.ndarray]:
+        """按 bid 批量读取当前计算器版本的 pp 曲线
+
+        同一谱面更新过（checksum 不同）时使用最后写入的曲线
+
+        :param items: (bid, ruleset_id, make_mods_key 的结果)
+        :return: (bid, ruleset_id, mods) 到一维 float32 数组的映射，不存在的项不包含在内
+        """
+        wanted = set(items)
+        bids = sorted({bid for bid, _, _ in wanted})
+        curves = {}
+        with self._lock:
+            for i in range(0, len(bids), 500):
+                chunk = bids[i : i + 500]
+                rows = self._conn.execute(
+                    "SELECT BID, RULESET_ID, MODS, PP_CURVE FROM BEATMAP_ATTRIBUTES WHERE BID IN (%s) AND CALCULATOR_VERSION = ? AND PP_CURVE IS NOT NULL ORDER BY ROWID" % ",".join("?" * len(chunk)),
+                    (*chunk, calculator_version()),
+                )
+                for bid, ruleset_id, mods, curve in rows:
+                    if (bid, ruleset_id, mods) in wanted:
+                        curves[(bid, ruleset_id, mods)] = np.frombuffer(curve, dtype=np.float32)
+        return curves
+
+    def get_strains(self, key: AttributeKey) -> Optional[dict[str, Any]]:
+        """读取 strain 序列
+
+        :param key: 键
+        :return: strain 序列，不存在时返回 None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT STRAINS FROM BEATMAP_ATTRIBUTES WHERE CHECKSUM = ? AND RULESET_ID = ? AND MODS = ? AND CALCULATOR_VERSION = ?", key).fetchone()
+        return None if row is None or row[0] is None else _loads(row[0])
+
+    def put_strains(self, key: AttributeKey, strains: Mapping[str, Any], bid: Optional[int] = None) -> None:
+        """写入 strain 序列
+
+        :param key: 键
+        :param strains: strain 序列
+        :param bid: 谱面 id，见 put
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO BEATMAP_ATTRIBUTES(CHECKSUM, RULESET_ID, MODS, CALCULATOR_VERSION, STRAINS, BID) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(CHECKSUM, RULESET_ID, MODS, CALCULATOR_VERSION) DO UPDATE SET STRAINS = excluded.STRAINS, BID = COALESCE(excluded.BID, BID)",
+                (*key, _dumps(dict(strains)), bid),
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM BEATMAP_ATTRIBUTES")
+            self._lru.clear()
@@ -0,0 +1,187 @@
+"""
+.osu 文件的下载与校验
+
+文件保存在可替换的存储后端中（见 beatmapstore.py），校验只需查一次存储后端的索引。
+下载是异步的，经过一个独立于 osu! api 的限速器，可以并发进行
+
+osuawa.py 和 utils.py 的约定同样适用于本文件：不包含 i18n 相关文本和 streamlit 相关语句
+"""
+
+__all__ = (
+    "BeatmapFileFetcher",
+    "create_beatmap_file_fetcher",
+)
+
+import asyncio
+import logging
+import threading
+from collections.abc import Callable, Iterable, Mapping
+from typing import Any, Optional
+
+from aiohttp import ClientSession
+from ossapi.ossapiv2_async import Beatmap
+
+from .beatmapstore import BeatmapStore, DirectoryBeatmapStore, create_beatmap_store
+from .ratelimit import RateLimiter, create_rate_limiter, parse_retry_after
+from .utils import C, headers
+
+logger = logging.getLogger(__name__)
+
+
+class BeatmapFileFetcher(object):
+    """.osu 文件的下载器
+
+    异步代码使用 fetch，线程中的同步代码使用 fetch_sync（即 utils.download_osu）。进程内默认共享一个实例，通过 set_default 替换
+
+    :param store: 存储后端，默认为 C.BEATMAPS_CACHE_DIRECTORY 中的 .osu 文件
+    :param rate_limiter: 下载使用的限速器，为 None 时不限速
+    """
+
+    _default: Optional["BeatmapFileFetcher"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, store: Optional[BeatmapStore] = None, rate_limiter: Optional[RateLimiter] = None):
+        self.store = store or DirectoryBeatmapStore()
+        self.rate_limiter = rate_limiter
+
+    @classmethod
+    def get_default(cls) -> "BeatmapFileFetcher":
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = create_beatmap_file_fetcher(None)
+            return cls._default
+
+    @classmethod
+    def set_default(cls, fetcher: "BeatmapFileFetcher") -> None:
+        with cls._default_lock:
+            cls._default = fetcher
+
+    def path(self, bid: int) -> str:
+        """获取可以交给 osu-tools 的真实文件路径，文件需要事先下载"""
+        return self.store.path(bid)
+
+    def checksum(self, bid: int) -> Optional[str]:
+        """读取已保存的 .osu 文件的 md5
+
+        :param bid: 谱面 id
+        :return: md5，不存在时返回 None
+        """
+        return self.store.checksum(bid)
+
+    def is_valid(self, beatmap: Beatmap) -> bool:
+        """已保存的 .osu 文件是否与谱面一致
+
+        谱面没有 checksum 时，只要文件存在就认为有效
+        """
+        checksum = self.store.checksum(beatmap.id)
+        return checksum is not None and (beatmap.checksum is None or checksum == beatmap.checksum)
+
+    async def _download(self, beatmap: Beatmap, session: ClientSession) -> bytes:
+        url = "https://osu.ppy.sh/osu/%d" % beatmap.id
+        rate_limiter = self.rate_limiter
+        attempt = 0
+        while True:
+            if rate_limiter is not None:
+                await rate_limiter.acquire()
+            async with session.get(url, headers=headers) as r:
+                if r.status != 429 or rate_limiter is None or attempt >= rate_limiter.max_retries:
+                    r.raise_for_status()
+                    return await r.read()
+                delay = rate_limiter.backoff(attempt, parse_retry_after(r.headers.get("Retry-After")))
+            logger.warning("rate limited by osu.ppy.sh, retrying %s in %.1fs (attempt %d)" % (url, delay, attempt + 1))
+            await rate_limiter.penalize(delay)
+            attempt += 1
+
+    async def fetch(self, beatmap: Beatmap, session: Optional[ClientSession] = None) -> str:
+        """确保谱面的 .osu 文件存在且有效，必要时下载
+
+        :param beatmap: 谱面
+        :param session: 使用的 aiohttp 会话，为 None 时临时创建一个
+        :return: .osu 文件路径
+        """
+        if await asyncio.to_thread(self.is_valid, beatmap):
+            return self.path(beatmap.id)
+        if session is None:
+            async with ClientSession() as session:
+                content = await self._download(beatmap, session)
+        else:
+            content = await self._download(beatmap, session)
+        checksum = await asyncio.to_thread(self.store.put, beatmap.id, content)
+        if beatmap.checksum is not None and checksum != beatmap.checksum:
+            # osu! 总是提供最新版本的谱面，api 返回的谱面信息可能已经过时
+            logger.warning("checksum mismatch for beatmap %d: expected %s, got %s" % (beatmap.id, beatmap.checksum, checksum))
+        return self.path(beatmap.id)
+
+    async def prefetch(self, beatmaps: Iterable[Beatmap], session: Optional[ClientSession] = None, concurrency: int = 16, progress: Optional[Callable[[int, int], Any]] = None) -> None:
+        """在计算之前确保一批谱面的 .osu 文件都存在且有效，并发下载缺失或过时的文件
+
+        单个文件下载失败不影响其他文件，全部结束后抛出第一个异常
+
+        :param beatmaps: 谱面，重复的谱面只下载一次
+        :param session: 使用的 aiohttp 会话，为 None 时临时创建一个
+        :param concurrency: 同时进行的下载数，请求频率仍由限速器决定
+        :param progress: 进度回调，参数为 (已完成的下载数, 需要下载的总数)
+        """
+        unique = {beatmap.id: beatmap for beatmap in beatmaps}
+        missing = await asyncio.to_thread(lambda: [beatmap for beatmap in unique.values() if not self.is_valid(beatmap)])
+        total = len(missing)
+        if total == 0:
+            return
+        logger.info("prefetching %d of %d beatmap files" % (total, len(unique)))
+        semaphore = asyncio.Semaphore(concurrency)
+        done = 0
+
+        async def fetch_one(beatmap: Beatmap, session_: ClientSession) -> None:
+            nonlocal done
+            async with semaphore:
+                try:
+                    await self.fetch(beatmap, session_)
+                finally:
+                    done += 1
+                    if progress is not None:
+                        progress(done, total)
+
+        async def fetch_all(session_: ClientSession) -> list:
+            return await asyncio.gather(*(fetch_one(beatmap, session_) for beatmap in missing), return_exceptions=True)
+
+        if session is None:
+            async with ClientSession() as session:
+                results = await fetch_all(session)
+        else:
+            results = await fetch_all(session)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            logger.warning("failed to prefetch %d of %d beatmap files" % (len(errors), total))
+            raise errors[0]
+
+    def fetch_sync(self, beatmap: Beatmap) -> str:
+        """fetch 的同步版本，不能在事件循环所在的线程中调用
+
+        文件有效时不启动事件循环
+        """
+        if self.is_valid(beatmap):
+            return self.path(beatmap.id)
+        return asyncio.run(self.fetch(beatmap))
+
+    def prefetch_sync(self, beatmaps: Iterable[Beatmap], progress: Optional[Callable[[int, int], Any]] = None) -> None:
+        """prefetch 的同步版本，不能在事件循环所在的线程中调用
+
+        所有文件都有效时不启动事件循环
+        """
+        missing = [beatmap for beatmap in {beatmap.id: beatmap for beatmap in beatmaps}.values() if not self.is_valid(beatmap)]
+        if missing:
+            asyncio.run(self.prefetch(missing, progress=progress))
+
+
+def create_beatmap_file_fetcher(config: Optional[Mapping[str, Any]]) -> BeatmapFileFetcher:
+    """根据 secrets.toml 中的 [beatmap_files] 配置创建 .osu 文件下载器
+
+    :param config: [beatmap_files] 配置，存储后端见 create_beatmap_store，[beatmap_files.ratelimit] 与 [ratelimit] 的格式相同，未配置时为每秒 2 个、突发 8 个的进程内限速
+    :return: 下载器
+    """
+    config = dict(config or {})
+    rate_limiter_config = dict(config.get("ratelimit") or {"rate": 2, "burst": 8})
+    if rate_limiter_config.get("backend") == "redis":
+        # 不与 osu! api 的请求共用令牌桶
+        rate_limiter_config.setdefault("prefix", C.RATE_LIMIT_PREFIX.value + "beatmaps:")
+    return BeatmapFileFetcher(create_beatmap_store(config), create_rate_limiter(rate_limiter_config))
@@ -0,0 +1,396 @@
+"""
+.osu 文件的存储后端
+
+- directory：每个谱面一个 bid.osu 文件（原先的方式），另外用一个 SQLite 索引记录每个文件的 md5、大小与修改时间
+- pack：所有谱面以 zlib 压缩后按 checksum 保存在同一个 SQLite 文件中，另有 bid 到 checksum 的索引。读取经过 SQLite 的内存映射，
+  osu-tools 需要真实的文件路径时，按 checksum 解压到一个有容量上限的临时目录中
+
+两种后端的校验都只需查一次内存中的索引（directory 还要 stat 一次文件）
+
+osuawa.py 和 utils.py 的约定同样适用于本文件：不包含 i18n 相关文本和 streamlit 相关语句
+"""
+
+__all__ = (
+    "BeatmapFileIndex",
+    "BeatmapStore",
+    "DirectoryBeatmapStore",
+    "PackBeatmapStore",
+    "create_beatmap_store",
+    "migrate_beatmap_store",
+)
+
+import hashlib
+import logging
+import os
+import os.path
+import re
+import sqlite3
+import tempfile
+import threading
+import zlib
+from collections.abc import Callable, Iterator, Mapping
+from contextlib import suppress
+from time import time
+from typing import Any, NamedTuple, Optional
+
+from .utils import C
+
+logger = logging.getLogger(__name__)
+
+
+def _write_atomic(path: str, content: bytes) -> None:
+    # 先写入同目录下的临时文件再重命名，中途失败不会留下不完整的文件
+    directory, filename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(".tmp", filename + ".", directory)
+    try:
+        with os.fdopen(fd, "wb") as fo_b:
+            fo_b.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class BeatmapFileEntry(NamedTuple):
+    checksum: str
+    size: int
+    mtime_ns: int
+
+
+class BeatmapFileIndex(object):
+    """bid 到 .osu 文件 md5 的索引，线程安全，启动时整体读入内存
+
+    :param path: SQLite 文件路径
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS BEATMAP_FILE(BID BIGINT PRIMARY KEY, CHECKSUM TEXT, SIZE BIGINT, MTIME_NS BIGINT)")
+        self._entries: dict[int, BeatmapFileEntry] = {bid: BeatmapFileEntry(*entry) for bid, *entry in self._conn.execute("SELECT BID, CHECKSUM, SIZE, MTIME_NS FROM BEATMAP_FILE")}
+
+    def get(self, bid: int) -> Optional[BeatmapFileEntry]:
+        return self._entries.get(bid)
+
+    def put(self, bid: int, entry: BeatmapFileEntry) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO BEATMAP_FILE(BID, CHECKSUM, SIZE, MTIME_NS) VALUES (?, ?, ?, ?)", (bid, *entry))
+            self._entries[bid] = entry
+
+    def put_many(self, entries: Mapping[int, BeatmapFileEntry]) -> None:
+        """在一个事务中写入多项"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO BEATMAP_FILE(BID, CHECKSUM, SIZE, MTIME_NS) VALUES (?, ?, ?, ?)", ((bid, *entry) for bid, entry in entries.items()))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._entries.update(entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def remove(self, bid: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM BEATMAP_FILE WHERE BID = ?", (bid,))
+            self._entries.pop(bid, None)
+
+    def size_and_count(self) -> tuple[int, int]:
+        entries = list(self._entries.values())
+        return sum(entry.size for entry in entries), len(entries)
+
+
+class BeatmapStore(object):
+    """.osu 文件的存储后端，线程安全"""
+
+    def checksum(self, bid: int) -> Optional[str]:
+        """读取已保存的 .osu 文件的 md5
+
+        :param bid: 谱面 id
+        :return: md5，不存在时返回 None
+        """
+        raise NotImplementedError
+
+    def read(self, bid: int) -> Optional[bytes]:
+        """读取 .osu 文件的内容
+
+        :param bid: 谱面 id
+        :return: 文件内容，不存在时返回 None
+        """
+        raise NotImplementedError
+
+    def put(self, bid: int, content: bytes) -> str:
+        """保存 .osu 文件，替换原有的版本
+
+        :param bid: 谱面 id
+        :param content: 文件内容
+        :return: md5
+        """
+        raise NotImplementedError
+
+    def path(self, bid: int) -> str:
+        """获取可以交给 osu-tools 的真实文件路径，需要事先保存
+
+        :param bid: 谱面 id
+        :return: 文件路径
+        """
+        raise NotImplementedError
+
+    def bids(self) -> Iterator[int]:
+        """已保存的所有谱面 id"""
+        raise NotImplementedError
+
+    def size_and_count(self) -> tuple[int, int]:
+        """占用的磁盘空间与保存的谱面数"""
+        raise NotImplementedError
+
+
+class DirectoryBeatmapStore(BeatmapStore):
+    """每个谱面一个 bid.osu 文件
+
+    :param directory: .osu 文件所在的目录
+    :param index_path: 索引的 SQLite 文件路径
+    """
+
+    def __init__(self, directory: str = C.BEATMAPS_CACHE_DIRECTORY.value, index_path: Optional[str] = None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.index = BeatmapFileIndex(index_path or os.path.join(C.CACHE_DIRECTORY.value, "beatmap_files.sqlite3"))
+        if len(self.index) == 0:
+            # 升级后第一次打开已有的目录时，索引还是空的，统计与校验都需要先补全
+            self.build_index()
+
+    def build_index(self) -> int:
+        """扫描目录，把索引中没有记录或者被改动过的文件加入索引
+
+        :return: 加入索引的文件数
+        """
+        entries = {}
+        for bid in self.bids():
+            path = self.path(bid)
+            try:
+                stat = os.stat(path)
+                entry = self.index.get(bid)
+                if entry is not None and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns:
+                    continue
+                with open(path, "rb") as fi_b:
+                    entries[bid] = BeatmapFileEntry(hashlib.md5(fi_b.read()).hexdigest(), stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                continue
+        if entries:
+            self.index.put_many(entries)
+            logger.info("indexed %d beatmap files in %s" % (len(entries), self.directory))
+        return len(entries)
+
+    def path(self, bid: int) -> str:
+        return os.path.join(self.directory, "%d.osu" % bid)
+
+    def checksum(self, bid: int) -> Optional[str]:
+        path = self.path(bid)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        entry = self.index.get(bid)
+        if entry is not None and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns:
+            return entry.checksum
+        # 索引中没有记录（旧版本下载的文件）或者文件被改动过，重新计算一次并记录下来
+        with open(path, "rb") as fi_b:
+            checksum = hashlib.md5(fi_b.read()).hexdigest()
+        self.index.put(bid, BeatmapFileEntry(checksum, stat.st_size, stat.st_mtime_ns))
+        return checksum
+
+    def read(self, bid: int) -> Optional[bytes]:
+        try:
+            with open(self.path(bid), "rb") as fi_b:
+                return fi_b.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, bid: int, content: bytes) -> str:
+        path = self.path(bid)
+        _write_atomic(path, content)
+        stat = os.stat(path)
+        checksum = hashlib.md5(content).hexdigest()
+        self.index.put(bid, BeatmapFileEntry(checksum, stat.st_size, stat.st_mtime_ns))
+        return checksum
+
+    def bids(self) -> Iterator[int]:
+        for entry in os.scandir(self.directory):
+            m = re.fullmatch(r"(\d+)\.osu", entry.name)
+            if m is not None and entry.is_file():
+                yield int(m.group(1))
+
+    def size_and_count(self) -> tuple[int, int]:
+        # 按索引统计，不遍历目录；打开时索引为空会先扫描一次目录，之后下载的文件都会写入索引
+        return self.index.size_and_count()
+
+
+class PackBeatmapStore(BeatmapStore):
+    """所有谱面压缩后保存在同一个 SQLite 文件中
+
+    同一内容（checksum）只保存一份，谱面更新后旧版本的数据由 vacuum 清理。交给 osu-tools 的文件解压到 path_directory 中，
+    以 checksum 命名，内容不会变化，超过 path_cache_size 个时删除较久未使用的文件
+
+    :param path: SQLite 文件路径
+    :param path_directory: 解压出的临时文件所在的目录
+    :param path_cache_size: 临时文件数的上限
+    :param path_cache_ttl: 临时文件至少保留的秒数，避免删除仍在等待计算的文件
+    :param mmap_size: SQLite 内存映射的字节数
+    """
+
+    def __init__(self, path: str, path_directory: Optional[str] = None, path_cache_size: int = 1024, path_cache_ttl: float = 600, mmap_size: int = 1 << 30):
+        self.pack_path = path
+        self.path_directory = path_directory or os.path.join(C.CACHE_DIRECTORY.value, "beatmap_paths")
+        self.path_cache_size = path_cache_size
+        self.path_cache_ttl = path_cache_ttl
+        os.makedirs(self.path_directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.execute("PRAGMA mmap_size=%d" % mmap_size)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS BEATMAP_BLOB(CHECKSUM TEXT PRIMARY KEY, SIZE BIGINT, DATA BLOB)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS BEATMAP_INDEX(BID BIGINT PRIMARY KEY, CHECKSUM TEXT)")
+        self._index: dict[int, str] = dict(self._conn.execute("SELECT BID, CHECKSUM FROM BEATMAP_INDEX").fetchall())
+        self._path_count = sum(1 for name in os.listdir(self.path_directory) if name.endswith(".osu"))
+
+    def checksum(self, bid: int) -> Optional[str]:
+        return self._index.get(bid)
+
+    def _read_blob(self, checksum: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute("SELECT DATA FROM BEATMAP_BLOB WHERE CHECKSUM = ?", (checksum,)).fetchone()
+        return None if row is None else zlib.decompress(row[0])
+
+    def read(self, bid: int) -> Optional[bytes]:
+        checksum = self._index.get(bid)
+        return None if checksum is None else self._read_blob(checksum)
+
+    def put(self, bid: int, content: bytes) -> str:
+        checksum = hashlib.md5(content).hexdigest()
+        data = zlib.compress(content, 6)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("INSERT OR IGNORE INTO BEATMAP_BLOB(CHECKSUM, SIZE, DATA) VALUES (?, ?, ?)", (checksum, len(content), data))
+                self._conn.execute("INSERT OR REPLACE INTO BEATMAP_INDEX(BID, CHECKSUM) VALUES (?, ?)", (bid, checksum))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._index[bid] = checksum
+        return checksum
+
+    def path(self, bid: int) -> str:
+        checksum = self._index.get(bid)
+        if checksum is None:
+            raise FileNotFoundError("beatmap %d is not in the store" % bid)
+        path = os.path.join(self.path_directory, "%s.osu" % checksum)
+        try:
+            # 更新修改时间，作为最近使用的时间
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+        content = self._read_blob(checksum)
+        if content is None:
+            raise FileNotFoundError("beatmap %d is not in the store" % bid)
+        _write_atomic(path, content)
+        with self._lock:
+            self._path_count += 1
+            trim = self._path_count > self.path_cache_size
+        if trim:
+            self._trim_paths()
+        return path
+
+    def _trim_paths(self) -> None:
+        entries = []
+        for entry in os.scandir(self.path_directory):
+            if entry.name.endswith(".osu"):
+                with suppress(FileNotFoundError):
+                    entries.append((entry.stat().st_mtime, entry.path))
+        entries.sort()
+        deadline = time() - self.path_cache_ttl
+        removed = 0
+        for mtime, path in entries[: max(0, len(entries) - self.path_cache_size)]:
+            if mtime > deadline:
+                break
+            with suppress(FileNotFoundError):
+                os.remove(path)
+                removed += 1
+        with self._lock:
+            self._path_count = len(entries) - removed
+
+    def bids(self) -> Iterator[int]:
+        return iter(list(self._index))
+
+    def size_and_count(self) -> tuple[int, int]:
+        size = 0
+        for path in (self.pack_path, self.pack_path + "-wal"):
+            with suppress(FileNotFoundError):
+                size += os.path.getsize(path)
+        return size, len(self._index)
+
+    def vacuum(self) -> int:
+        """删除不再被任何谱面引用的旧版本数据并整理 SQLite 文件
+
+        :return: 删除的数据条数
+        """
+        with self._lock:
+            removed = self._conn.execute("DELETE FROM BEATMAP_BLOB WHERE CHECKSUM NOT IN (SELECT CHECKSUM FROM BEATMAP_INDEX)").rowcount
+            self._conn.execute("VACUUM")
+        return removed
+
+
+def create_beatmap_store(config: Optional[Mapping[str, Any]]) -> BeatmapStore:
+    """根据 secrets.toml 中的 [beatmap_files] 配置创建 .osu 文件的存储后端
+
+    :param config: [beatmap_files] 配置，backend 可选 "directory"（默认）或 "pack"
+    :return: 存储后端
+    """
+    config = dict(config or {})
+    match config.get("backend", "directory"):
+        case "directory":
+            return DirectoryBeatmapStore(config.get("directory", C.BEATMAPS_CACHE_DIRECTORY.value), config.get("index_path"))
+        case "pack":
+            return PackBeatmapStore(
+                config.get("pack_path", os.path.join(C.CACHE_DIRECTORY.value, "beatmaps.sqlite3")),
+                config.get("path_directory"),
+                config.get("path_cache_size", 1024),
+                config.get("path_cache_ttl", 600),
+            )
+        case _ as backend:
+            raise ValueError("unknown beatmap store backend '%s'" % backend)
+
+
+def migrate_beatmap_store(source: BeatmapStore, target: BeatmapStore, progress: Optional[Callable[[int, int], Any]] = None) -> int:
+    """把 source 中的所有谱面复制到 target，target 中内容相同的谱面会被跳过
+
+    :param source: 原存储后端
+    :param target: 新存储后端
+    :param progress: 进度回调，参数为 (已处理的谱面数, 总数)
+    :return: 复制的谱面数
+    """
+    bids = list(source.bids())
+    copied = 0
+    for i, bid in enumerate(bids, 1):
+        checksum = source.checksum(bid)
+        if checksum is not None and checksum != target.checksum(bid):
+            content = source.read(bid)
+            if content is not None:
+                target.put(bid, content)
+                copied += 1
+        if progress is not None:
+            progress(i, len(bids))
+    return copied
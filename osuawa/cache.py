@@ -0,0 +1,197 @@
+"""
+async_cached_method 的二级（持久化）缓存
+
+二级缓存在进程之间共享（Streamlit 的各个会话与 daemon），因此只应当用于与用户无关的方法
+
+osuawa.py 和 utils.py 的约定同样适用于本文件：不包含 i18n 相关文本和 streamlit 相关语句
+"""
+
+__all__ = (
+    "CacheBackend",
+    "RedisCacheBackend",
+    "SqliteCacheBackend",
+    "create_cache_backend",
+    "dumps",
+    "loads",
+    "sizeof",
+)
+
+import io
+import os
+import os.path
+import pickle
+import sqlite3
+import sys
+import threading
+import zlib
+from collections.abc import Mapping
+from time import time
+from typing import Any, Optional
+
+from ossapi.ossapiv2_async import OssapiAsync
+from ossapi.utils import Model
+from redis import Redis
+
+from .utils import C
+
+# 持久化 id：ossapi 模型中的 _api 不参与序列化，反序列化时替换为当前实例的 api
+_API_PERSISTENT_ID = "ossapi"
+
+
+def _restore_model(cls: type, data: dict[str, Any]) -> Model:
+    # ossapi 的 Model 重写了 __getattribute__，默认的 pickle 协议无法还原，这里绕过 __init__ 直接写回数据
+    obj = cls.__new__(cls)
+    obj._ossapi_data = data
+    return obj
+
+
+class _ModelPickler(pickle.Pickler):
+    def persistent_id(self, obj: Any) -> Optional[str]:
+        if isinstance(obj, OssapiAsync):
+            return _API_PERSISTENT_ID
+        return None
+
+    def reducer_override(self, obj: Any) -> Any:
+        if isinstance(obj, Model):
+            return _restore_model, (type(obj), obj._ossapi_data)
+        return NotImplemented
+
+
+class _ModelUnpickler(pickle.Unpickler):
+    def __init__(self, file, api: Any):
+        super().__init__(file)
+        self._api = api
+
+    def persistent_load(self, pid: Any) -> Any:
+        if pid == _API_PERSISTENT_ID:
+            return self._api
+        raise pickle.UnpicklingError("unsupported persistent id %s" % pid)
+
+
+def _pickle(obj: Any) -> bytes:
+    buffer = io.BytesIO()
+    _ModelPickler(buffer, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return buffer.getvalue()
+
+
+def dumps(obj: Any) -> bytes:
+    """序列化（可能包含 ossapi 模型的）对象
+
+    :param obj: 对象
+    :return: 压缩后的字节串
+    """
+    return zlib.compress(_pickle(obj), 1)
+
+
+def sizeof(obj: Any) -> int:
+    """估算对象占用的字节数（未压缩的序列化结果的长度），用于按大小限制一级缓存
+
+    :param obj: 对象
+    :return: 字节数，无法序列化时退化为 ``sys.getsizeof``
+    """
+    try:
+        return len(_pickle(obj))
+    except Exception:
+        return sys.getsizeof(obj)
+
+
+def loads(data: bytes, api: Any = None) -> Any:
+    """反序列化 ``dumps`` 的结果
+
+    注意：pickle 只应该用于可信的数据源（本地的 Redis 或 SQLite 文件）
+
+    :param data: 字节串
+    :param api: 用于替换 ossapi 模型中 ``_api`` 的对象
+    :return: 对象
+    """
+    return _ModelUnpickler(io.BytesIO(zlib.decompress(data)), api).load()
+
+
+class CacheBackend(object):
+    """二级缓存后端，所有方法都是同步的，调用方负责将其放到线程中执行"""
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl: int) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class RedisCacheBackend(CacheBackend):
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = C.API_CACHE_PREFIX.value):
+        # 任务队列使用的连接开启了 decode_responses，这里需要单独的二进制连接
+        self._r = Redis.from_url(url, decode_responses=False)
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._r.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: int) -> None:
+        self._r.set(self.prefix + key, value, ex=ttl)
+
+    def delete(self, key: str) -> None:
+        self._r.delete(self.prefix + key)
+
+    def clear(self) -> None:
+        for key in self._r.scan_iter(match="%s*" % self.prefix):
+            self._r.delete(key)
+
+
+class SqliteCacheBackend(CacheBackend):
+    purge_interval = 256  # 每写入多少次清理一次过期记录
+
+    def __init__(self, path: str = os.path.join(C.CACHE_DIRECTORY.value, "api.sqlite3")):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._writes = 0
+        # 多个进程共享同一个文件，使用 WAL 减少读写互斥
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS API_CACHE(KEY TEXT PRIMARY KEY, VALUE BLOB, EXPIRES_AT REAL)")
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute("SELECT VALUE FROM API_CACHE WHERE KEY = ? AND EXPIRES_AT > ?", (key, time())).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, key: str, value: bytes, ttl: int) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO API_CACHE(KEY, VALUE, EXPIRES_AT) VALUES (?, ?, ?)", (key, value, time() + ttl))
+            self._writes += 1
+            if self._writes % self.purge_interval == 0:
+                self._conn.execute("DELETE FROM API_CACHE WHERE EXPIRES_AT <= ?", (time(),))
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM API_CACHE WHERE KEY = ?", (key,))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM API_CACHE")
+
+
+def create_cache_backend(config: Optional[Mapping[str, Any]]) -> Optional[CacheBackend]:
+    """根据 secrets.toml 中的 [cache] 配置创建二级缓存后端
+
+    :param config: [cache] 配置，backend 可选 "redis"、"sqlite" 或 "none"
+    :return: 缓存后端，未启用时返回 None
+    """
+    if not config:
+        return None
+    match config.get("backend", "none"):
+        case "redis":
+            return RedisCacheBackend(config.get("redis_url", "redis://localhost:6379/0"))
+        case "sqlite":
+            return SqliteCacheBackend(config.get("sqlite_path", os.path.join(C.CACHE_DIRECTORY.value, "api.sqlite3")))
+        case "none" | "" | None:
+            return None
+        case _ as backend:
+            raise ValueError("unknown cache backend '%s'" % backend)
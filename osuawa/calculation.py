@@ -0,0 +1,145 @@
+"""
+osu-tools 计算的执行后端
+
+pythonnet 与 osu-tools 的计算是同步的，放在线程中只能避免阻塞事件循环，同一进程内的计算仍然只能一个接一个地进行。
+进程池后端把计算分发到多个子进程中，每个子进程在启动时加载 osu-tools 并创建四个 ruleset 实例，之后的计算都复用它们
+
+osuawa.py 和 utils.py 的约定同样适用于本文件：不包含 i18n 相关文本和 streamlit 相关语句
+"""
+
+__all__ = (
+    "CalculationExecutor",
+    "InlineCalculationExecutor",
+    "ProcessCalculationExecutor",
+    "create_calculation_executor",
+)
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import types
+from collections.abc import Iterator, Mapping
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Any, Optional
+
+from .utils import PerformanceJob, PerformanceResult, RULESET_CALCULATORS, run_performance_job
+
+logger = logging.getLogger(__name__)
+
+# 子进程中复用的 ruleset 实例
+_rulesets: dict[int, Any] = {}
+
+
+def _init_worker() -> None:
+    # 反序列化 initializer 时子进程已经导入了 osuawa（加载 osu-tools），这里只需要创建 ruleset 实例；计算不需要 mod 表，子进程不会生成它们
+    for ruleset_id, (ruleset_type, _) in RULESET_CALCULATORS.items():
+        _rulesets[ruleset_id] = ruleset_type()
+
+
+def _run_job(job: PerformanceJob) -> PerformanceResult:
+    return run_performance_job(job, _rulesets.get(job.ruleset_id))
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+@contextmanager
+def _bare_main() -> Iterator[None]:
+    # spawn 启动的子进程会按照父进程的 __main__ 重新执行入口脚本，而 run_daemon.py 与 Streamlit 的页面脚本都没有 __name__ == "__main__" 的保护
+    # 启动子进程期间临时换上一个空的 __main__，子进程便不会执行它们
+    main = sys.modules["__main__"]
+    bare = types.ModuleType("__main__")
+    sys.modules["__main__"] = bare
+    try:
+        yield
+    finally:
+        # Streamlit 每次运行脚本都会替换 __main__，这期间被替换过就不再还原
+        if sys.modules.get("__main__") is bare:
+            sys.modules["__main__"] = main
+
+
+class CalculationExecutor(object):
+    """osu-tools 计算的执行后端"""
+
+    async def run(self, job: PerformanceJob) -> PerformanceResult:
+        """执行一次计算
+
+        :param job: 计算的输入，谱面文件需要事先下载
+        :return: 计算结果
+        """
+        raise NotImplementedError
+
+    def shutdown(self) -> None:
+        pass
+
+
+class InlineCalculationExecutor(CalculationExecutor):
+    """在本进程的线程中计算"""
+
+    async def run(self, job: PerformanceJob) -> PerformanceResult:
+        return await asyncio.to_thread(run_performance_job, job)
+
+
+class ProcessCalculationExecutor(CalculationExecutor):
+    """在进程池中计算，子进程在第一次计算时一次性启动
+
+    :param workers: 子进程数，默认为 CPU 核数（最多 4 个，每个子进程都要加载一份 .NET 运行时）
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # 已经加载了 .NET 运行时的进程不能安全地 fork，使用 spawn
+                pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker)
+                with _bare_main():
+                    # 没有空闲的子进程时，每次提交都会启动一个新的子进程，这样就在 _bare_main 中启动了全部子进程
+                    for _ in range(self.workers):
+                        pool.submit(_ping)
+                self._pool = pool
+                logger.info("calculation process pool started with %d workers" % self.workers)
+            return self._pool
+
+    async def run(self, job: PerformanceJob) -> PerformanceResult:
+        pool = self._get_pool()
+        try:
+            return await asyncio.wrap_future(pool.submit(_run_job, job))
+        except BrokenProcessPool:
+            # 子进程异常退出（例如 .NET 运行时崩溃），丢弃整个进程池，下一次计算时重建
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def create_calculation_executor(config: Optional[Mapping[str, Any]]) -> CalculationExecutor:
+    """根据 secrets.toml 中的 [calculation] 配置创建计算后端
+
+    :param config: [calculation] 配置，backend 可选 "process"（默认）或 "inline"，workers 为进程池的子进程数
+    :return: 计算后端
+    """
+    config = dict(config or {})
+    match config.get("backend", "process"):
+        case "process":
+            return ProcessCalculationExecutor(config.get("workers"))
+        case "inline":
+            return InlineCalculationExecutor()
+        case _ as backend:
+            raise ValueError("unknown calculation backend '%s'" % backend)
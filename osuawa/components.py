@@ -35,29 +35,29 @@ from streamlit import logger
 from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 from osuawa import C, OsuPlaylist, Osuawa
+from osuawa.beatmapfiles import BeatmapFileFetcher
 from osuawa.osuawa import CachedMixIn
+from osuawa.scoresnapshot import ScoreSnapshotStore, create_score_snapshot_store
 from osuawa.utils import (
-    CompletedSimpleScoreInfo,
     RedisTaskId,
-    ScoreStatistics,
+    SCORE_DERIVED_COLUMNS,
+    SCORE_TABLE_COLUMNS,
     SimpleDifficultyAttribute,
     _build_upsert,
+    _difficulty_attributes,
     _make_query_uppercase,
+    beatmap_attribute_key,
     calculate_performance,
-    catch_mod_entries,
-    catch_mod_indexes,
     download_osu,
     format_size,
     make_unstandardized_mods_from_lines,
+    get_attribute_store,
+    get_mod_entries,
+    get_mod_indexes,
     get_mod_type_mapping,
     get_size_and_count,
-    mania_mod_entries,
-    mania_mod_indexes,
-    osu_mod_entries,
-    osu_mod_indexes,
     push_task,
-    taiko_mod_entries,
-    taiko_mod_indexes,
+    scores_table_to_dataframe,
 )
 
 if TYPE_CHECKING:
@@ -181,7 +181,9 @@ def commands():
         Command("reg", _("Register command parser"), [JsonStr("obj", True)], 0, register_commands),
         Command("fman", "Show or clean files", [Str("action"), Str("filename", True)], 4, files_action),
         Command("logfilter", "Tail logs", [Int("n", True), Str("keyword", True)], 3, tail_log),
-        Command("apicache", "Show api cache", [], 3, CachedMixIn.get_cache),
+        Command("apicache", "Show api cache statistics", [], 3, CachedMixIn.get_cache_stats),
+        Command("migrate", "Run pending database schema migrations", [], 4, lambda: push_task_with_session_state("migrate")),
+        Command("ppcurves", "Compute pp curves of saved scores", [], 4, lambda: push_task_with_session_state("ppcurves")),
         Command("where", _("Get user info"), [Str("username")], 0, st.session_state.awa.get_user_info),
         Command("save", _("Save user's recent scores"), [Int("user")], 1, lambda user: push_task_with_session_state("save %d" % user)),
         Command("score", _("Get and display score"), [Int("score_id")], 0, st.session_state.awa.get_score),
@@ -206,11 +208,16 @@ def files_action(action: Literal["show", "clean"], filename: Optional[str] = Non
                 # 三个主要文件夹
                 # todo: components shelves 是否需要检查
                 ret_md += "## Storage\n\n"
-                for action_path in [C.OUTPUT_DIRECTORY.value, C.UPLOADED_DIRECTORY.value, C.BEATMAPS_CACHE_DIRECTORY.value]:
+                for action_path in [C.OUTPUT_DIRECTORY.value, C.UPLOADED_DIRECTORY.value]:
                     size, count = get_size_and_count(action_path)
                     size = format_size(size)
                     # - **action_path**: size, count
                     ret_md += f"- **{action_path}**: {size}, {count}\n\n"
+                # 谱面文件由存储后端按索引统计，不遍历目录
+                beatmap_store = BeatmapFileFetcher.get_default().store
+                size, count = beatmap_store.size_and_count()
+                size = format_size(size)
+                ret_md += f"- **beatmaps ({type(beatmap_store).__name__})**: {size}, {count}\n\n"
                 # 检查 *LCK ./*LCK
                 ret_md += "## Lock Files\n\n"
                 for action_path in os.listdir():
@@ -356,110 +363,58 @@ def register_commands(obj: Optional[dict] = None):
     return ret
 
 
-def get_scores_dataframe(user: int, date_range: Optional[tuple[date, date]] = None) -> pd.DataFrame:
-    with _conn.session as s:
-        if date_range is None:
-            res = s.execute(
-                text(
-                    """
-                    SELECT *
-                    FROM SCORE
-                    WHERE USER_ID = :user
-                    ORDER BY TS""",
-                ),
-                params={"user": user},
-            )
-        else:
-            begin_date_ts = datetime.combine(date_range[0], time.min).timestamp()
-            end_date_ts = datetime.combine(date_range[1], time.max).timestamp()
-            res = s.execute(
-                text(
-                    """
-                    SELECT *
-                    FROM SCORE
-                    WHERE USER_ID = :user
-                      AND TS >= :begin_date
-                      AND TS <= :end_date
-                    ORDER BY TS""",
-                ),
-                params={"user": user, "begin_date": begin_date_ts, "end_date": end_date_ts},
-            )
-        rows = res.fetchall()
-    # 处理 bool 和 datetime
-    completed_recent_scores_compact: dict[str, CompletedSimpleScoreInfo] = {
-        str(row[0]): CompletedSimpleScoreInfo(
-            # 基础字段
-            row[1],
-            row[2],
-            row[3],
-            row[4],
-            row[5],
-            bool(row[6]),
-            row[7],
-            orjson.loads(row[8]) if row[8] is not None else [],
-            datetime.fromtimestamp(row[9]),
-            (
-                ScoreStatistics(**orjson.loads(row[10]))
-                if row[10] is not None
-                else ScoreStatistics(
-                    miss=0,
-                    meh=0,
-                    ok=0,
-                    good=0,
-                    great=0,
-                    perfect=None,
-                    small_tick_hit=None,
-                    large_tick_hit=None,
-                    small_bonus=None,
-                    large_bonus=None,
-                    ignore_miss=None,
-                    ignore_hit=None,
-                    combo_break=None,
-                    slider_tail_hit=None,
+@st.cache_resource
+def get_score_snapshot_store() -> Optional[ScoreSnapshotStore]:
+    # 快照由后台程序在保存成绩后维护，页面只读取
+    return create_score_snapshot_store(st.secrets.get("score_snapshots"))
+
+
+def get_scores_dataframe(user: int, date_range: Optional[tuple[date, date]] = None, pp_if_accuracies: tuple[float, ...] = ()) -> pd.DataFrame:
+    if date_range is None:
+        begin_date_ts = end_date_ts = None
+    else:
+        begin_date_ts = datetime.combine(date_range[0], time.min).timestamp()
+        end_date_ts = datetime.combine(date_range[1], time.max).timestamp()
+    # 优先读取快照，只读取需要的列与时间范围内的行组
+    score_snapshot_store = get_score_snapshot_store()
+    # 同时读取入库时计算的派生字段
+    table_columns = [*SCORE_TABLE_COLUMNS, *SCORE_DERIVED_COLUMNS]
+    snapshot = None if score_snapshot_store is None else score_snapshot_store.read(user, begin_date_ts, end_date_ts, table_columns)
+    if snapshot is not None:
+        table = snapshot.to_pandas()
+    else:
+        # 按列读取，不逐行构造 CompletedSimpleScoreInfo
+        columns = ", ".join(table_columns)
+        with _conn.session as s:
+            if date_range is None:
+                table = pd.read_sql(
+                    text(
+                        """
+                        SELECT %s
+                        FROM SCORE
+                        WHERE USER_ID = :user
+                        ORDER BY TS"""
+                        % columns,
+                    ),
+                    s.connection(),
+                    params={"user": user},
                 )
-            ),
-            datetime.fromtimestamp(row[11]) if row[11] is not None else None,
-            row[12],
-            # 扩展字段
-            row[13],
-            row[14],
-            row[15],
-            row[16],
-            row[17],
-            bool(row[18]),
-            bool(row[19]),
-            bool(row[20]),
-            bool(row[21]),
-            bool(row[22]),
-            bool(row[23]),
-            bool(row[24]),
-            row[25],
-            row[26],
-            row[27],
-            row[28],
-            row[29],
-            row[30],
-            row[31],
-            row[32],
-            row[33],
-            row[34],
-            row[35],
-            row[36],
-            row[37],
-            row[38],
-            row[39],
-            row[40],
-            row[41],
-            row[42],
-            row[43],
-            row[44],
-            row[45],
-            row[46],
-            row[47],
-        )
-        for row in rows
-    }
-    return st.session_state.awa.create_scores_dataframe(completed_recent_scores_compact)
+            else:
+                table = pd.read_sql(
+                    text(
+                        """
+                        SELECT %s
+                        FROM SCORE
+                        WHERE USER_ID = :user
+                          AND TS >= :begin_date
+                          AND TS <= :end_date
+                        ORDER BY TS"""
+                        % columns,
+                    ),
+                    s.connection(),
+                    params={"user": user, "begin_date": begin_date_ts, "end_date": end_date_ts},
+                )
+    return st.session_state.awa.extend_scores_dataframe(scores_table_to_dataframe(table), pp_if_accuracies)
 
 
 def draw_strain_graph(bid: int, mod_settings: Optional[str] = None, ruleset_id: Optional[int] = None) -> Figure:
@@ -486,7 +441,6 @@ def draw_strain_graph(bid: int, mod_settings: Optional[str] = None, ruleset_id:
             pass
         case _:
             raise ValueError(_("invalid ruleset_id"))
-    download_osu(beatmap)
 
     if mod_settings is not None:
         mods = make_unstandardized_mods_from_lines("SP", mod_settings.replace(" ", "\n"))
@@ -497,8 +451,17 @@ def draw_strain_graph(bid: int, mod_settings: Optional[str] = None, ruleset_id:
     # 生成 osu_tools 所能接受的样式
     my_attr = SimpleDifficultyAttribute(beatmap.cs, beatmap.accuracy, beatmap.ar, beatmap.bpm or 0, beatmap.hit_length)
     my_attr.set_mods(mods)
-    calculator = calculate_performance(os.path.join(C.BEATMAPS_CACHE_DIRECTORY.value, "%s.osu" % beatmap.id), ruleset, my_attr.osu_tool_mods, my_attr.osu_tool_mod_options)
-    osupp_attr = next(calculator)
+    # strain 序列同样保存在属性存储中，重复查看同一谱面时不需要再次计算
+    store = get_attribute_store()
+    key = beatmap_attribute_key(beatmap, beatmap.mode_int if ruleset_id is None else ruleset_id, my_attr.osu_tool_mods, my_attr.osu_tool_mod_options)
+    osupp_attr = store.get_strains(key)
+    if osupp_attr is None:
+        calculator = calculate_performance(download_osu(beatmap), ruleset, my_attr.osu_tool_mods, my_attr.osu_tool_mod_options)
+        full_osupp_attr = next(calculator)
+        osupp_attr = {k: v for k, v in full_osupp_attr.items() if k.startswith("__ek_")}
+        store.put_strains(key, osupp_attr, beatmap.id)
+        if store.get(key) is None:
+            store.put(key, _difficulty_attributes(full_osupp_attr), beatmap.id)
     strains: dict[str, list[tuple[float, float]]] = osupp_attr["__ek_strains"]
     timelines = osupp_attr["__ek_time_until_first_strain_adj"] + osupp_attr["__ek_ms_per_strain"] * np.arange(osupp_attr["__ek_strain_count"])
     df_strain = pd.DataFrame({**strains, "time": timelines})
@@ -589,17 +552,15 @@ def push_task_with_session_state(task_command: str) -> str:
 def _mod_customization(key_suffix: int, ruleset: Literal["osu", "taiko", "catch", "mania"]) -> list[str]:
     match ruleset:
         case "osu":
-            all_mods = osu_mod_entries
-            all_mod_indexes = osu_mod_indexes
+            ruleset_id = 0
         case "taiko":
-            all_mods = taiko_mod_entries
-            all_mod_indexes = taiko_mod_indexes
+            ruleset_id = 1
         case "catch":
-            all_mods = catch_mod_entries
-            all_mod_indexes = catch_mod_indexes
+            ruleset_id = 2
         case "mania":
-            all_mods = mania_mod_entries
-            all_mod_indexes = mania_mod_indexes
+            ruleset_id = 3
+    all_mods = get_mod_entries(ruleset_id)
+    all_mod_indexes = get_mod_indexes(ruleset_id)
 
     _mod_key = "modgen_mod_%d" % key_suffix
     ret = []
@@ -12,52 +12,71 @@ __all__ = (
 )
 
 import asyncio
+import atexit
+import concurrent.futures
 import ctypes
 import datetime
 import functools
 import html
 import json
+import logging
 import os
 import os.path
 import platform
 import threading
 from asyncio import AbstractEventLoop, Task
-from collections.abc import Coroutine
-from dataclasses import fields
+from collections import deque
+from collections.abc import AsyncIterable, AsyncIterator, Awaitable, Callable, Coroutine, Iterable, Iterator, Mapping
+from contextlib import suppress
+from dataclasses import dataclass, field, fields, replace
 from functools import cached_property
 from itertools import chain
 from shutil import rmtree
 from threading import Lock
+from time import perf_counter
 from types import MappingProxyType
 from typing import Any, Literal, Never, Optional, cast, override
 
 import numpy as np
 import orjson
 import pandas as pd
+from aiohttp import ClientResponse, ClientSession, TCPConnector
 from cachetools import TTLCache
 from clayutil.futil import Downloader, Properties
 from clayutil.sutil import sha256sum
 from clayutil.validator import Integer
 from fontfallback import writing
+from oauthlib.oauth2 import OAuth2Error, TokenExpiredError
 from ossapi.models import MultiplayerScore, RoomPlaylistItem
-from ossapi.ossapiv2_async import Beatmap, Domain, GameMode, GameModeT, Grant, MultiplayerScores, OssapiAsync, Room, Scope, Score, User
+from ossapi.ossapiv2_async import Beatmap, Domain, GameMode, GameModeT, Grant, MultiplayerScores, OssapiAsync, ReauthenticationRequired, Room, Scope, Score, User
 
+from .beatmapfiles import BeatmapFileFetcher
+from .cache import CacheBackend, dumps as cache_dumps, loads as cache_loads, sizeof as cache_sizeof
+from .calculation import CalculationExecutor, ProcessCalculationExecutor
+from .ratelimit import RateLimiter, parse_retry_after
 from .utils import (
     C,
     CompletedPlaylistBeatmap,
     CompletedSimpleScoreInfo,
-    ExtendedSimpleScoreInfo,
     ParsedPlaylistBeatmap,
+    SCORE_DERIVED_FIELDS,
     SimpleDifficultyAttribute,
+    ScoreCalculation,
     SimpleScoreInfo,
+    apply_calculation_result,
+    apply_pp_curve_result,
     assets_dir,
-    calc_beatmap_attributes,
     calc_high_star_rating_text_color,
     calc_positive_percent,
+    calc_score_derived_columns,
     calc_star_rating_color,
-    calculate_difficulty,
-    download_osu,
+    encode_mod_combinations,
+    evaluate_pp_curves,
+    get_difficulty_attributes,
+    get_pp_curves,
+    group_score_calculations,
     headers,
+    prepare_pp_curve_calculations,
     simple_user_dict,
     strip_quotes,
     to_readable_mods,
@@ -69,6 +88,8 @@ from PIL import Image, ImageDraw, ImageEnhance, ImageFilter, ImageFont, Unidenti
 
 assert datetime
 
+logger = logging.getLogger(__name__)
+
 
 def _make_cached_method_key(
     class_name: str,
@@ -90,55 +111,403 @@ def _make_cached_method_key(
     )
 
 
-def async_cached_method(isolated: bool = False):
+class _LeaderCancelled(Exception):
+    """合并请求的发起者被取消，等待者应当重新发起请求"""
+
+
+async def _await_shared_future(shared: concurrent.futures.Future) -> Any:
+    waiter = asyncio.wrap_future(shared)
+    # 等待者被取消时不能取消共享的 future（shield），同时取回异常以避免 "exception was never retrieved" 警告
+    waiter.add_done_callback(lambda f: f.cancelled() or f.exception())
+    return await asyncio.shield(waiter)
+
+
+async def aiter_offset_pages[_T](fetch_page: Callable[[int], Awaitable[list[_T]]], page_size: int, window: int = 4) -> AsyncIterator[list[_T]]:
+    """按 offset 分页，按顺序逐页产出结果，同时保持至多 window 个页面请求在进行中
+
+    遇到第一个不满 page_size 的页面（包括空页面）即停止，空页面不会被产出；停止或被提前关闭时取消其后仍在进行的请求。
+    窗口从 1 开始，每收到一个满页翻倍直到 window，这样大多数只有一页的情况不会产生多余的请求
+
+    :param fetch_page: 接收 offset 并返回一页结果的协程函数
+    :param page_size: 每页的条目数
+    :param window: 同时进行的页面请求数，1 等价于逐页串行获取
+    :return: 异步迭代器，每次产出一页
+    """
+    if window < 1:
+        raise ValueError("window must be at least 1")
+    pending: deque[asyncio.Future[list[_T]]] = deque()
+    next_offset = 0
+    current_window = 1
+    try:
+        while True:
+            while len(pending) < current_window:
+                pending.append(asyncio.ensure_future(fetch_page(next_offset)))
+                next_offset += page_size
+            page = await pending.popleft()
+            if len(page) > 0:
+                yield page
+            if len(page) < page_size:
+                break
+            current_window = min(window, current_window * 2)
+    finally:
+        for future in pending:
+            future.cancel()
+        # 已经越过末尾的页面可能失败或被取消，这些结果都不再需要
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def paginate_offsets[_T](fetch_page: Callable[[int], Awaitable[list[_T]]], page_size: int, window: int = 4) -> list[_T]:
+    """按 offset 分页获取全部结果，参见 ``aiter_offset_pages``
+
+    :return: 按顺序拼接的结果
+    """
+    return [item async for page in aiter_offset_pages(fetch_page, page_size, window) for item in page]
+
+
+async def merge_aiters[_T](aiters: list[AsyncIterator[_T]], maxsize: int = 8) -> AsyncIterator[_T]:
+    """并发消费多个异步迭代器，按到达顺序产出它们的元素
+
+    内部队列有界，消费者跟不上时生产者会暂停；任一迭代器抛出异常时，取消其余迭代器并将异常抛给消费者
+
+    :param aiters: 异步迭代器
+    :param maxsize: 队列长度
+    :return: 异步迭代器
+    """
+    queue: asyncio.Queue[tuple[bool, Any]] = asyncio.Queue(maxsize)
+
+    async def pump(aiter: AsyncIterator[_T]) -> None:
+        try:
+            async for item in aiter:
+                await queue.put((False, item))
+        except Exception as e:
+            await queue.put((True, e))
+        else:
+            await queue.put((True, None))
+
+    tasks = [asyncio.ensure_future(pump(aiter)) for aiter in aiters]
+    remaining = len(tasks)
+    try:
+        while remaining > 0:
+            finished, item = await queue.get()
+            if not finished:
+                yield item
+            elif item is None:
+                remaining -= 1
+            else:
+                raise item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def async_cached_method(isolated: bool = False, persistent_ttl: Optional[int] = None):
+    """缓存异步方法的结果
+
+    每个方法拥有独立的一级缓存（进程内的 TTLCache），其策略由 ``CachePolicy`` 描述，可以通过 ``CachedMixIn.configure_policies`` 覆盖；
+    二级缓存（若已通过 ``CachedMixIn.set_persistent_cache`` 启用）在进程之间共享，读穿透、写穿透
+
+    缓存未命中时，同一个键的并发调用会被合并（single-flight）：第一个调用者负责查询二级缓存并执行方法，其余调用者等待它的结果
+
+    - 发起者抛出异常时，异常传递给所有正在等待的调用者，且不会被缓存，之后的调用重新发起请求
+    - 发起者被取消时，正在等待的调用者重新竞争，由其中一个重新发起请求
+    - 等待者被取消不影响发起者
+
+    :param isolated: 是否按 identifier 隔离，与用户相关的方法必须为 True
+    :param persistent_ttl: 二级缓存的过期时间（秒），None 表示不使用二级缓存
+    """
+
     def decorator(func):
+        method_name = func.__name__
+        CachedMixIn.register_policy(method_name, CachePolicy.default(isolated, persistent_ttl))
+
         @functools.wraps(func)
         async def wrapper(self: "CachedMixIn", *args: Any, **kwargs: Any):
-            cache = self._isolated_cache if isolated else self._global_cache
-
-            key = (
-                _make_cached_method_key(
-                    type(self).__qualname__,
-                    func.__name__,
-                    self.identifier,
-                    args,
-                    kwargs,
-                )
-                if isolated
-                else _make_cached_method_key(
-                    type(self).__qualname__,
-                    func.__name__,
-                    None,
-                    args,
-                    kwargs,
-                )
+            policy = CachedMixIn.get_policy(method_name)
+            cache = CachedMixIn._get_method_cache(method_name)
+            stats = CachedMixIn._get_method_stats(method_name)
+
+            key = _make_cached_method_key(
+                type(self).__qualname__,
+                method_name,
+                self.identifier if policy.isolated else None,
+                args,
+                kwargs,
             )
 
-            if key in cache:
-                return cache[key]
+            while True:
+                if key in cache:
+                    stats.hits += 1
+                    return cache[key]
+                with CachedMixIn._inflight_lock:
+                    shared = CachedMixIn._inflight.get(key)
+                    is_leader = shared is None
+                    if is_leader:
+                        shared = CachedMixIn._inflight[key] = concurrent.futures.Future()
+                if is_leader:
+                    break
+                stats.coalesced += 1
+                try:
+                    return await _await_shared_future(shared)
+                except _LeaderCancelled:
+                    stats.coalesced_retries += 1
+                except Exception:
+                    stats.coalesced_errors += 1
+                    raise
 
-            result = await func(self, *args, **kwargs)
-            cache[key] = result
-            return result
+            try:
+                result = None
+                found = False
+                if policy.persistent_ttl is not None:
+                    found, result = await self._persistent_get(key)
+                if found:
+                    stats.persistent_hits += 1
+                else:
+                    stats.misses += 1
+                    start = perf_counter()
+                    try:
+                        result = await func(self, *args, **kwargs)
+                    finally:
+                        stats.latencies.append(perf_counter() - start)
+                # 按大小计算容量时，超过 maxsize 的单个结果不进入一级缓存
+                with suppress(ValueError):
+                    cache[key] = result
+                if policy.persistent_ttl is not None and not found:
+                    await self._persistent_set(key, result, policy.persistent_ttl)
+            except Exception as e:
+                shared.set_exception(e)
+                raise
+            except BaseException:
+                shared.set_exception(_LeaderCancelled())
+                raise
+            else:
+                shared.set_result(result)
+                return result
+            finally:
+                with CachedMixIn._inflight_lock:
+                    CachedMixIn._inflight.pop(key, None)
 
         return wrapper
 
     return decorator
 
 
+@dataclass(frozen=True, slots=True)
+class CachePolicy:
+    """单个被缓存方法的一级缓存策略
+
+    :param maxsize: 容量，weighted 为 True 时单位是字节，否则是条目数
+    :param ttl: 一级缓存的过期时间（秒）
+    :param isolated: 是否按 identifier 隔离
+    :param weighted: 是否按结果序列化后的大小计算容量
+    :param persistent_ttl: 二级缓存的过期时间（秒），None 表示不使用二级缓存
+    """
+
+    maxsize: int
+    ttl: float
+    isolated: bool = False
+    weighted: bool = False
+    persistent_ttl: Optional[int] = None
+
+    def __post_init__(self):
+        if self.isolated and self.persistent_ttl is not None:
+            # 二级缓存在所有会话间共享，不允许存放与用户相关的数据
+            raise ValueError("isolated methods cannot be persisted")
+
+    @classmethod
+    def default(cls, isolated: bool = False, persistent_ttl: Optional[int] = None) -> "CachePolicy":
+        if isolated:
+            return cls(maxsize=256, ttl=120, isolated=True, persistent_ttl=persistent_ttl)
+        return cls(maxsize=1024, ttl=300, persistent_ttl=persistent_ttl)
+
+
+@dataclass(slots=True)
+class CachedMethodStats:
+    hits: int = 0  # 一级缓存命中次数
+    persistent_hits: int = 0  # 二级缓存命中次数
+    misses: int = 0  # 实际调用原始方法的次数
+    evictions: int = 0  # 因容量不足被淘汰的条目数
+    expirations: int = 0  # 过期被清理的条目数
+    coalesced: int = 0  # 被合并到进行中请求的调用次数
+    coalesced_errors: int = 0  # 被合并的调用中，收到发起者异常的次数
+    coalesced_retries: int = 0  # 因发起者被取消而重新竞争的次数
+    latencies: deque[float] = field(default_factory=lambda: deque(maxlen=1024))  # 最近若干次原始方法调用的耗时（秒）
+
+
+class _MethodCache(TTLCache):
+    """记录淘汰与过期次数的 TTLCache"""
+
+    def __init__(self, policy: CachePolicy, stats: CachedMethodStats):
+        super().__init__(maxsize=policy.maxsize, ttl=policy.ttl, getsizeof=cache_sizeof if policy.weighted else None)
+        self.stats = stats
+
+    @override
+    def popitem(self):
+        item = super().popitem()
+        self.stats.evictions += 1
+        return item
+
+    @override
+    def expire(self, time=None):
+        expired = super().expire(time)
+        self.stats.expirations += len(expired)
+        return expired
+
+
 class CachedMixIn:
-    _global_cache = TTLCache(maxsize=1024, ttl=300)
-    _isolated_cache = TTLCache(maxsize=256, ttl=120)
+    _policies: dict[str, CachePolicy] = {}  # 装饰器注册的默认策略
+    _policy_overrides: dict[str, CachePolicy] = {}  # 配置文件覆盖的策略
+    _method_caches: dict[str, _MethodCache] = {}
+    _persistent_cache: Optional[CacheBackend] = None
+    # 进行中的请求在进程内共享（不同会话可能运行在不同线程的事件循环中），因此使用 concurrent.futures.Future
+    _inflight: dict[str, concurrent.futures.Future] = {}
+    _inflight_lock = Lock()
+    _method_stats: dict[str, CachedMethodStats] = {}
 
     def __init__(self):
         self.identifier: Optional[int] = None
 
     @classmethod
     def get_cache(cls):
-        return MappingProxyType({"global": dict(CachedMixIn._global_cache), "isolated": dict(CachedMixIn._isolated_cache)})
+        return MappingProxyType({method_name: dict(cache) for method_name, cache in CachedMixIn._method_caches.items()})
+
+    @classmethod
+    def get_cache_stats(cls) -> pd.DataFrame:
+        """按方法统计缓存情况
+
+        :return: 每个被缓存方法一行，延迟的单位是毫秒。bytes 只对 weighted 的缓存给出（即 currsize），其余的缓存逐个序列化的开销太大，显示为 "-"
+        """
+        rows = []
+        for method_name in sorted(CachedMixIn._policies):
+            policy = CachedMixIn.get_policy(method_name)
+            stats = CachedMixIn._get_method_stats(method_name)
+            cache = CachedMixIn._method_caches.get(method_name)
+            latencies = np.array(stats.latencies) * 1000
+            lookups = stats.hits + stats.persistent_hits + stats.misses
+            rows.append(
+                {
+                    "method": method_name,
+                    "isolated": policy.isolated,
+                    "maxsize": policy.maxsize,
+                    "weighted": policy.weighted,
+                    "ttl": policy.ttl,
+                    "persistent_ttl": policy.persistent_ttl,
+                    "entries": 0 if cache is None else sum(1 for _ in cache),  # len 会把已过期但尚未清除的项也算进去
+                    "bytes": (0 if cache is None else cache.currsize) if policy.weighted else "-",
+                    "hits": stats.hits,
+                    "persistent_hits": stats.persistent_hits,
+                    "misses": stats.misses,
+                    "hit_ratio": (stats.hits + stats.persistent_hits) / lookups if lookups else np.nan,
+                    "evictions": stats.evictions,
+                    "expirations": stats.expirations,
+                    "coalesced": stats.coalesced,
+                    "coalesced_errors": stats.coalesced_errors,
+                    "coalesced_retries": stats.coalesced_retries,
+                    "p50_ms": np.percentile(latencies, 50) if len(latencies) else np.nan,
+                    "p95_ms": np.percentile(latencies, 95) if len(latencies) else np.nan,
+                }
+            )
+        return pd.DataFrame(rows).set_index("method") if rows else pd.DataFrame()
+
+    @staticmethod
+    def _get_method_stats(method_name: str) -> CachedMethodStats:
+        with CachedMixIn._inflight_lock:
+            return CachedMixIn._method_stats.setdefault(method_name, CachedMethodStats())
+
+    @staticmethod
+    def _get_method_cache(method_name: str) -> _MethodCache:
+        cache = CachedMixIn._method_caches.get(method_name)
+        if cache is None:
+            stats = CachedMixIn._get_method_stats(method_name)
+            with CachedMixIn._inflight_lock:
+                cache = CachedMixIn._method_caches.setdefault(method_name, _MethodCache(CachedMixIn.get_policy(method_name), stats))
+        return cache
+
+    @classmethod
+    def register_policy(cls, method_name: str, policy: CachePolicy) -> None:
+        CachedMixIn._policies[method_name] = policy
+
+    @classmethod
+    def get_policy(cls, method_name: str) -> CachePolicy:
+        return CachedMixIn._policy_overrides.get(method_name) or CachedMixIn._policies[method_name]
+
+    @classmethod
+    def configure_policies(cls, config: Optional[Mapping[str, Mapping[str, Any]]]) -> None:
+        """根据 secrets.toml 中的 [cache.policies] 覆盖方法的缓存策略，已有的一级缓存会被丢弃
+
+        :param config: 方法名到策略字段（maxsize、ttl、isolated、weighted、persistent_ttl）的映射
+        """
+        overrides: dict[str, CachePolicy] = {}
+        for method_name, fields_override in (config or {}).items():
+            if method_name not in CachedMixIn._policies:
+                raise ValueError("unknown cached method '%s'" % method_name)
+            default_policy = CachedMixIn._policies[method_name]
+            policy = replace(default_policy, **fields_override)
+            if default_policy.isolated and not policy.isolated:
+                raise ValueError("cached method '%s' must be isolated" % method_name)
+            overrides[method_name] = policy
+        with CachedMixIn._inflight_lock:
+            CachedMixIn._policy_overrides = overrides
+            CachedMixIn._method_caches.clear()
+
+    @classmethod
+    def set_persistent_cache(cls, backend: Optional[CacheBackend]) -> None:
+        """设置进程内所有实例共享的二级缓存后端，None 表示禁用"""
+        CachedMixIn._persistent_cache = backend
+
+    def _cache_api(self) -> Any:
+        """反序列化二级缓存时，用于替换 ossapi 模型中 ``_api`` 的对象"""
+        return None
+
+    async def _persistent_get(self, key: str) -> tuple[bool, Any]:
+        backend = CachedMixIn._persistent_cache
+        if backend is None:
+            return False, None
+        # 二级缓存出错时退化为直接请求，而不是让整个调用失败
+        try:
+            data = await asyncio.to_thread(backend.get, key)
+            if data is None:
+                return False, None
+            return True, cache_loads(data, self._cache_api())
+        except Exception as e:
+            logger.warning("failed to read persistent cache %s: %s" % (key, e))
+            return False, None
+
+    async def _persistent_set(self, key: str, value: Any, ttl: int) -> None:
+        backend = CachedMixIn._persistent_cache
+        if backend is None:
+            return
+        try:
+            await asyncio.to_thread(backend.set, key, cache_dumps(value), ttl)
+        except Exception as e:
+            logger.warning("failed to write persistent cache %s: %s" % (key, e))
+
+
+_background_loop: Optional[AbstractEventLoop] = None
+_background_loop_lock = Lock()
+
+
+def get_background_loop() -> AbstractEventLoop:
+    """获取进程内共享的事件循环，首次调用时在后台守护线程中启动
+
+    所有 Streamlit 会话与 daemon 共用这一个事件循环，从而可以共享 aiohttp 的连接池
+    """
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None or _background_loop.is_closed():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="osuawa-event-loop", daemon=True).start()
+            _background_loop = loop
+        return _background_loop
 
 
 class Awapi(OssapiAsync):
+    rate_limiter: Optional[RateLimiter] = RateLimiter()
+    connection_limit = 32  # 共享连接池的最大连接数
+    # aiohttp 的会话只能在创建它的事件循环中使用，因此按事件循环区分
+    _client_sessions: dict[AbstractEventLoop, ClientSession] = {}
+    _client_sessions_lock = Lock()
+
     def __init__(
         self,
         client_id: int,
@@ -164,9 +533,110 @@ class Awapi(OssapiAsync):
     def _new_authorization_grant(self, client_id, client_secret, redirect_uri, scopes) -> Never:
         raise NotImplementedError("new authorization grant not allowed")
 
+    @classmethod
+    def get_client_session(cls) -> ClientSession:
+        """获取当前事件循环上所有实例共享的 aiohttp 会话，请求之间复用 keep-alive 连接"""
+        loop = asyncio.get_running_loop()
+        with Awapi._client_sessions_lock:
+            session = Awapi._client_sessions.get(loop)
+            if session is None or session.closed:
+                session = ClientSession(connector=TCPConnector(limit=cls.connection_limit, keepalive_timeout=30))
+                Awapi._client_sessions[loop] = session
+        return session
+
+    @classmethod
+    def close_client_sessions(cls, timeout: float = 5) -> None:
+        """关闭所有共享的 aiohttp 会话，在进程退出时调用"""
+        with Awapi._client_sessions_lock:
+            sessions = list(Awapi._client_sessions.items())
+            Awapi._client_sessions.clear()
+        for loop, session in sessions:
+            if session.closed or loop.is_closed():
+                continue
+            with suppress(Exception):
+                if loop.is_running():
+                    asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout)
+                else:
+                    loop.run_until_complete(session.close())
+
+    @classmethod
+    def set_rate_limiter(cls, rate_limiter: Optional[RateLimiter]) -> None:
+        """设置进程内所有实例共享的限速器，None 表示不限速"""
+        Awapi.rate_limiter = rate_limiter
+
+    async def _limited_request(self, method: str, url: str, aiohttp_session: ClientSession, params: dict, data: dict) -> ClientResponse:
+        rate_limiter = Awapi.rate_limiter
+        if rate_limiter is None:
+            return await self.session.request_async(method, url, session=aiohttp_session, params=params, data=data)
+        attempt = 0
+        while True:
+            await rate_limiter.acquire()
+            r = await self.session.request_async(method, url, session=aiohttp_session, params=params, data=data)
+            if r.status != 429:
+                return r
+            delay = rate_limiter.backoff(attempt, parse_retry_after(r.headers.get("Retry-After")))
+            # 先归还连接，再决定是否放弃，否则最后一次 429 的连接要等到 GC 时才回到共享的连接池
+            r.release()
+            if attempt >= rate_limiter.max_retries:
+                r.raise_for_status()
+            logger.warning("rate limited by osu! api, retrying %s in %.1fs (attempt %d)" % (url, delay, attempt + 1))
+            # 冷却时间对所有共享限速器的请求生效，之后的 acquire 会一并等待
+            await rate_limiter.penalize(delay)
+            attempt += 1
+
+    @override
+    async def _request(self, type_, method, url, params=None, data=None):
+        # 与 OssapiAsync._request 基本一致，区别在于：
+        # 1. 使用共享的 aiohttp 会话，而不是每个请求新建一个会话
+        # 2. 每次实际发送请求前都要经过限速器，并且在收到 429 时退避重试
+        self._clear_type_hints_cache()
+        params = self._format_params(params or {})
+        data = self._format_params(data or {})
+        aiohttp_session = self.get_client_session()
+
+        async def make_request():
+            return await self._limited_request(method, "%s%s" % (self.base_url, url), aiohttp_session, params, data)
+
+        async def reauthenticate_and_retry():
+            if self.access_token_passed:
+                raise ReauthenticationRequired()
+            self.session = self._new_grant()
+            return await make_request()
+
+        try:
+            r = await make_request()
+        except TokenExpiredError:
+            if self.grant is not Grant.CLIENT_CREDENTIALS:
+                raise
+            self.session = self._new_client_grant(self.client_id, self.client_secret)
+            r = await make_request()
+        except OAuth2Error as e:
+            if e.description != "The refresh token is invalid.":
+                raise
+            r = await reauthenticate_and_retry()
+
+        url_ = str(r.real_url)
+        # 读取完整的响应体后连接会自动归还连接池
+        json_ = await r.json(encoding=None)
+        if json_ == {"authentication": "basic"}:
+            r = await reauthenticate_and_retry()
+            json_ = await r.json(encoding=None)
+
+        self._check_response(json_, url_)
+        return self._instantiate_type(type_, json_)
+
+
+atexit.register(Awapi.close_client_sessions)
+
 
 class Osuawa(CachedMixIn):
     tz = "Asia/Shanghai"
+    # 谱面实体缓存，按 bid 索引，所有实例共享；二级缓存中对应的键为 beatmap:<bid>
+    _beatmap_cache = TTLCache(maxsize=4096, ttl=3600)
+    beatmap_persistent_ttl = 21600
+    pagination_window = 4  # 按 offset 分页时同时进行的页面请求数
+    run_coro_timeout = 600  # run_coro 的默认超时时间（秒）
+    calculation_executor: CalculationExecutor = ProcessCalculationExecutor()  # 进程内所有实例共享的 osu-tools 计算后端
     common_mods = {
         "NM",
         "NF",
@@ -186,9 +656,12 @@ class Osuawa(CachedMixIn):
         "V2",
     }
 
-    def __init__(self, loop: AbstractEventLoop, client_id, client_secret, redirect_url, scopes, domain, token_key: str, oauth_token: Optional[str], oauth_refresh_token: Optional[str], *, debugging_mode: bool = False):
+    def __init__(self, loop: Optional[AbstractEventLoop], client_id, client_secret, redirect_url, scopes, domain, token_key: str, oauth_token: Optional[str], oauth_refresh_token: Optional[str], *, debugging_mode: bool = False):
+        """
+        :param loop: 执行协程的事件循环，None 表示使用进程内共享的后台事件循环
+        """
         super().__init__()
-        self.loop: AbstractEventLoop = loop
+        self.loop: AbstractEventLoop = get_background_loop() if loop is None else loop
         # 不再暴露 api，而是使用 async_cached_method 包裹用得到的方法，避免直接调用原始方法
         # 后续可能针对 post 请求单独建立函数映射
         # 对于 get_me 等和用户相关的方法，必须将 isolated 设置为 True
@@ -205,6 +678,17 @@ class Osuawa(CachedMixIn):
     def __debugging_expose_api(self):
         self._api = self.__api
 
+    @override
+    def _cache_api(self) -> Any:
+        return self.__api
+
+    @classmethod
+    def set_calculation_executor(cls, calculation_executor: CalculationExecutor) -> None:
+        """设置进程内所有实例共享的计算后端"""
+        if Osuawa.calculation_executor is not calculation_executor:
+            Osuawa.calculation_executor.shutdown()
+        Osuawa.calculation_executor = calculation_executor
+
     # 以下为对原始 api 方法的包裹
     # 虽然后续许多数据都要转换为自定义类，但是为了代码清晰，`api_` 前缀表示原始 api 方法，并为了兼容性收窄了参数类型
 
@@ -216,25 +700,37 @@ class Osuawa(CachedMixIn):
     async def api_friends(self):
         return await self.__api.friends()
 
-    @async_cached_method()
+    @async_cached_method(persistent_ttl=600)
     async def api_user(self, user: int | str, *, mode: Optional[GameModeT] = None, key: Optional[Literal["id", "username"]] = None) -> User:
         return await self.__api.user(user, mode=mode, key=key)
 
+    # 谱面由谱面实体缓存负责持久化，这两个方法本身不再使用二级缓存
     @async_cached_method()
     async def api_beatmap(self, beatmap_id: int) -> Beatmap:
-        return await self.__api.beatmap(beatmap_id)
+        cached_beatmaps = await self._get_cached_beatmaps([beatmap_id])
+        if beatmap_id in cached_beatmaps:
+            return cached_beatmaps[beatmap_id]
+        beatmap = await self.__api.beatmap(beatmap_id)
+        await self._remember_beatmaps([beatmap])
+        return beatmap
 
     @async_cached_method()
     async def api_beatmaps(self, beatmap_ids: list[int]) -> list[Beatmap]:
-        return await self.__api.beatmaps(beatmap_ids)
+        beatmaps = await self.__api.beatmaps(beatmap_ids)
+        await self._remember_beatmaps(beatmaps)
+        return beatmaps
 
-    @async_cached_method()
+    @async_cached_method(persistent_ttl=86400)
     async def api_score(self, score_id: int) -> Score:
-        return await self.__api.score(score_id)
+        score = await self.__api.score(score_id)
+        await self._remember_scores_beatmaps([score])
+        return score
 
     @async_cached_method()
     async def api_beatmap_user_scores(self, beatmap_id: int, user_id: int, *, mode: Optional[GameModeT] = None) -> list[Score]:
-        return await self.__api.beatmap_user_scores(beatmap_id, user_id, mode=mode)
+        user_scores = await self.__api.beatmap_user_scores(beatmap_id, user_id, mode=mode)
+        await self._remember_scores_beatmaps(user_scores)
+        return user_scores
 
     @async_cached_method()
     async def api_user_scores(
@@ -247,9 +743,11 @@ class Osuawa(CachedMixIn):
         limit: Optional[int] = None,
         offset: Optional[int] = None,
     ) -> list[Score]:
-        return await self.__api.user_scores(user_id, type_, include_fails=include_fails, mode=mode, limit=limit, offset=offset)
+        user_scores = await self.__api.user_scores(user_id, type_, include_fails=include_fails, mode=mode, limit=limit, offset=offset)
+        await self._remember_scores_beatmaps(user_scores)
+        return user_scores
 
-    @async_cached_method()
+    @async_cached_method(persistent_ttl=300)
     async def api_room(self, room_id: int) -> Room:
         return await self.__api.room(room_id)
 
@@ -264,16 +762,100 @@ class Osuawa(CachedMixIn):
     ) -> MultiplayerScores:
         return await self.__api.multiplayer_scores(room_id, playlist_id, limit=limit, cursor_string=cursor_string)
 
-    def run_coro[_T](self, coro: Coroutine[Any, Any, _T]) -> _T:
-        """统一的协程执行方法"""
+    # 谱面实体缓存
+
+    @staticmethod
+    def _is_complete_beatmap(beatmap: Any) -> bool:
+        # 只缓存完整的谱面：计算需要 checksum，生成课题需要内嵌的 beatmapset（异步 api 无法惰性获取）
+        return isinstance(beatmap, Beatmap) and beatmap.checksum is not None and beatmap._beatmapset is not None
+
+    async def _remember_beatmaps(self, beatmaps: list[Beatmap]) -> None:
+        complete_beatmaps = [b for b in beatmaps if self._is_complete_beatmap(b)]
+        for b in complete_beatmaps:
+            Osuawa._beatmap_cache[b.id] = b
+        if complete_beatmaps and CachedMixIn._persistent_cache is not None:
+            await asyncio.gather(*[self._persistent_set("beatmap:%d" % b.id, b, self.beatmap_persistent_ttl) for b in complete_beatmaps])
+
+    async def _remember_scores_beatmaps(self, scores: list[Score]) -> None:
+        beatmaps: list[Beatmap] = []
+        for score in scores:
+            b = score.beatmap
+            if b is None:
+                continue
+            if b._beatmapset is None and score.beatmapset is not None:
+                # 成绩中的谱面不内嵌 beatmapset，而是与之并列；这里复制一份，不修改原成绩
+                b = Beatmap(**{**b._ossapi_data, "_beatmapset": score.beatmapset})
+            beatmaps.append(b)
+        await self._remember_beatmaps(beatmaps)
+
+    async def _get_cached_beatmaps(self, bids: list[int]) -> dict[int, Beatmap]:
+        """从谱面实体缓存中获取谱面，一级缓存未命中的再查询二级缓存
+
+        :param bids: 谱面 id
+        :return: 命中的谱面
+        """
+        beatmaps_dict: dict[int, Beatmap] = {}
+        missing_bids: list[int] = []
+        for bid in dict.fromkeys(bids):
+            b = Osuawa._beatmap_cache.get(bid)
+            if b is None:
+                missing_bids.append(bid)
+            else:
+                beatmaps_dict[bid] = b
+        if missing_bids and CachedMixIn._persistent_cache is not None:
+            results = await asyncio.gather(*[self._persistent_get("beatmap:%d" % bid) for bid in missing_bids])
+            for bid, (found, b) in zip(missing_bids, results, strict=True):
+                if found:
+                    Osuawa._beatmap_cache[bid] = b
+                    beatmaps_dict[bid] = b
+        return beatmaps_dict
+
+    def run_coro[_T](self, coro: Coroutine[Any, Any, _T], timeout: Optional[float] = None) -> _T:
+        """统一的协程执行方法
+
+        :param coro: 协程
+        :param timeout: 超时时间（秒），None 表示使用 ``run_coro_timeout``，超时后协程会被取消并抛出 TimeoutError
+        :return: 协程的结果
+        """
+        if timeout is None:
+            timeout = self.run_coro_timeout
         if self.loop.is_running():
-            # 如果循环正在运行（比如在异步环境中）
-            # 使用 run_coroutine_threadsafe 或 create_task
+            try:
+                running_loop = asyncio.get_running_loop()
+            except RuntimeError:
+                running_loop = None
+            if running_loop is self.loop:
+                # 在事件循环所在的线程中同步等待它自己会死锁
+                coro.close()
+                raise RuntimeError("run_coro cannot be called from its own event loop")
+            # 后台事件循环在其他线程中运行，提交后阻塞等待结果
             future = asyncio.run_coroutine_threadsafe(coro, self.loop)
-            return future.result()  # 这会阻塞直到完成
+            try:
+                return future.result(timeout)
+            except TimeoutError:
+                future.cancel()
+                raise
         else:
             # 循环存在但未运行，直接使用 run_until_complete
-            return self.loop.run_until_complete(coro)
+            return self.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+    def run_aiter[_T](self, aiter: AsyncIterator[_T]) -> Iterator[_T]:
+        """同步地逐个取出异步迭代器的元素，使调用方（例如 streamlit 页面）可以在元素之间处理部分结果"""
+
+        async def next_item() -> _T:
+            return await anext(aiter)
+
+        try:
+            while True:
+                try:
+                    yield self.run_coro(next_item())
+                except StopAsyncIteration:
+                    return
+        finally:
+            # 调用方提前结束迭代时，关闭异步迭代器以取消其中仍在进行的请求
+            aclose = getattr(aiter, "aclose", None)
+            if aclose is not None:
+                self.run_coro(aclose())
 
     @cached_property
     def user(self) -> tuple[int, str]:
@@ -291,18 +873,30 @@ class Osuawa(CachedMixIn):
         return (await self.api_user(user, key="id")).username
 
     async def async_get_beatmaps_dict(self, bids: list[int]) -> dict[int, Beatmap]:
-        bids = list(set(bids))
+        """获取谱面，先查询谱面实体缓存，只有缺失的谱面才会每 50 个一批请求
+
+        :param bids: 谱面 id，可以重复
+        :return: bid 到谱面的映射，不存在的谱面不包含在内
+        """
+        beatmaps_dict = await self._get_cached_beatmaps(bids)
+        # 排序使相同的缺失集合得到相同的请求，从而命中 api_beatmaps 的缓存或合并进行中的请求
+        missing_bids = sorted(set(bids) - beatmaps_dict.keys())
         cut_bids: list[list[int]] = []
-        for i in range(0, len(bids), 50):
-            cut_bids.append(list(bids[i : i + 50]))
+        for i in range(0, len(missing_bids), 50):
+            cut_bids.append(missing_bids[i : i + 50])
         tasks: list[Task[list[Beatmap]]] = []
         async with asyncio.TaskGroup() as tg:
-            for bids in cut_bids:
-                tasks.append(tg.create_task(self.api_beatmaps(bids)))
-        results = [task.result() for task in tasks]
-        return {b.id: b for bs in results for b in bs}
+            for chunk in cut_bids:
+                tasks.append(tg.create_task(self.api_beatmaps(chunk)))
+        for task in tasks:
+            beatmaps_dict.update({b.id: b for b in task.result()})
+        return beatmaps_dict
 
-    def create_scores_dataframe(self, scores_compact: dict[str, CompletedSimpleScoreInfo]) -> pd.DataFrame:
+    def create_scores_dataframe(self, scores_compact: dict[str, CompletedSimpleScoreInfo], pp_if_accuracies: Iterable[float] = ()) -> pd.DataFrame:
+        """
+        :param scores_compact: 补全后的成绩
+        :param pp_if_accuracies: 额外计算的 if 准确率（%），对每个准确率 X 追加 b_pp_Xif 与 pp_Xpct 两列，由属性存储中的 pp 曲线插值得到，不调用 osu-tools
+        """
         df = pd.DataFrame.from_dict(
             scores_compact,
             orient="index",
@@ -310,34 +904,91 @@ class Osuawa(CachedMixIn):
         )
         df.reset_index(inplace=True)
         df.rename(columns={"index": "score_id"}, inplace=True)
-        df["ts"] = cast(pd.Series, pd.to_datetime(df["ts"], utc=True)).dt.tz_convert(self.tz)
-        df["st"] = cast(pd.Series, pd.to_datetime(df["st"], utc=True)).dt.tz_convert(self.tz)
-        ec = ExtendedSimpleScoreInfo.__slots__
-        df[ec[0]] = df["ts"].dt.hour * 3600 + df["ts"].dt.minute * 60 + df["ts"].dt.second
-        # todo: 这里要不要考虑除零问题？
-        df[ec[1]] = df["pp"] / df["b_pp_100if"]
-        df[ec[2]] = df["pp_aim"] / df["b_pp_100if_aim"]
-        df[ec[3]] = df["pp_speed"] / df["b_pp_100if_speed"]
-        df[ec[4]] = df["pp_accuracy"] / df["b_pp_100if_accuracy"]
-        df[ec[5]] = df["pp"] / df["b_pp_92if"]
-        df[ec[6]] = df["pp"] / df["b_pp_81if"]
-        df[ec[7]] = df["pp"] / df["b_pp_67if"]
-        df[ec[8]] = df["max_combo"] / df["b_max_combo"]
-        df[ec[9]] = df["b_max_combo"] / df["hit_length"]
-        df[ec[10]] = df["b_aim_difficulty"] / np.log1p(df["density"])
-        df[ec[11]] = df["b_speed_difficulty"] / np.log1p(df["density"])
-        df[ec[12]] = df["b_aim_difficulty"] / df["b_speed_difficulty"]
-        df[ec[13]] = np.where(df["is_nf"], df["score"] * 2, df["score"])
-        df[ec[14]] = df["_mods"].apply(lambda x: "; ".join(to_readable_mods(x)))
-        df[ec[15]] = df["_mods"].map(lambda mods: ({m["acronym"] for m in mods} <= self.common_mods))
+        return self.extend_scores_dataframe(df, pp_if_accuracies)
+
+    def extend_scores_dataframe(self, df: pd.DataFrame, pp_if_accuracies: Iterable[float] = ()) -> pd.DataFrame:
+        """在基础的成绩 DataFrame 上转换时区并追加 ExtendedSimpleScoreInfo 的字段
+
+        从 SCORE 表读取的成绩已经包含入库时计算的 SCORE_DERIVED_FIELDS，这里只计算与时区有关的 time 和与 mod 表有关的 mods_mask
+
+        :param df: 列为 score_id 与 CompletedSimpleScoreInfo 的字段的 DataFrame，可以来自 create_scores_dataframe 或 utils.scores_table_to_dataframe，会被原地修改
+        :param pp_if_accuracies: 见 create_scores_dataframe
+        """
+        # 统一为微秒精度，不同的构造方式和 pandas 版本推断出的精度不同
+        df["ts"] = cast(pd.Series, pd.to_datetime(df["ts"], utc=True)).dt.as_unit("us").dt.tz_convert(self.tz)
+        df["st"] = cast(pd.Series, pd.to_datetime(df["st"], utc=True)).dt.as_unit("us").dt.tz_convert(self.tz)
+        df["time"] = df["ts"].dt.hour * 3600 + df["ts"].dt.minute * 60 + df["ts"].dt.second
+        # 先移除已有的派生字段再追加，保持 ExtendedSimpleScoreInfo 中的字段顺序
+        derived = pd.DataFrame({name: df.pop(name) for name in SCORE_DERIVED_FIELDS}) if all(name in df.columns for name in SCORE_DERIVED_FIELDS) else calc_score_derived_columns(df, self.common_mods)
+        for name in SCORE_DERIVED_FIELDS:
+            df[name] = derived[name]
+        # mods 保存为 category 类型，缩写集合保存为 mods_mask 位掩码，设置只在 df.attrs["mod_combinations"] 中为每种组合保存一份
+        df["mods"] = df["mods"].astype("category")
+        codes, combinations = encode_mod_combinations(df)
+        df["mods_mask"] = np.array([c.mods_mask for c in combinations], dtype=np.uint64)[codes]
+        df.attrs["mod_combinations"] = tuple(combinations)
+        pp_if_accuracies = list(pp_if_accuracies)
+        if pp_if_accuracies and len(df) > 0:
+            curves = get_pp_curves(df["bid"], df["ruleset_id"], df["_mods"])
+            for accuracy in pp_if_accuracies:
+                df["b_pp_%gif" % accuracy] = evaluate_pp_curves(curves, accuracy)
+                df["pp_%gpct" % accuracy] = df["pp"] / df["b_pp_%gif" % accuracy]
         return df
 
     def get_user_info(self, username: str) -> dict[str, Any]:
         return self.run_coro(self.async_get_user_info(username))
 
-    async def complete_scores_compact(self, scores_compact: dict[str, SimpleScoreInfo]) -> dict[str, CompletedSimpleScoreInfo]:
+    async def complete_scores_compact(self, scores_compact: dict[str, SimpleScoreInfo], progress: Optional[Callable[[int, int], Any]] = None) -> dict[str, CompletedSimpleScoreInfo]:
+        """补全成绩，这会覆盖成绩原本的 pp
+
+        :param scores_compact: 成绩
+        :param progress: 谱面文件下载的进度回调，参数为 (已完成的下载数, 需要下载的总数)
+        :return: 补全后的成绩
+        """
         beatmaps_dict = await self.async_get_beatmaps_dict([x.bid for x in scores_compact.values()])
-        return {score_id: calc_beatmap_attributes(beatmaps_dict[scores_compact[score_id].bid], scores_compact[score_id]) for score_id in scores_compact}
+        # 先一次性并发下载所有谱面文件，之后的查询与计算都不再等待网络
+        await BeatmapFileFetcher.get_default().prefetch(beatmaps_dict.values(), Awapi.get_client_session(), progress=progress)
+        # 查询属性存储与准备谱面文件路径是同步阻塞的，放到线程中执行；osu-tools 的计算交给计算后端，避免阻塞事件循环上的其他请求
+        calculations = await asyncio.to_thread(lambda: {score_id: ScoreCalculation.prepare(beatmaps_dict[score.bid], score) for score_id, score in scores_compact.items()})
+        # 同一 (谱面, mods) 的成绩合并为一次计算
+        groups = await asyncio.to_thread(group_score_calculations, calculations.values())
+        results = await asyncio.gather(*(Osuawa.calculation_executor.run(group.job) for group in groups))
+        await asyncio.to_thread(lambda: [apply_calculation_result(group, result) for group, result in zip(groups, results, strict=True)])
+        return {score_id: calculation.complete() for score_id, calculation in calculations.items()}
+
+    async def complete_pp_curves(self, items: list[tuple[int, int, list[dict[str, Any]]]], progress: Optional[Callable[[int, int], Any]] = None) -> int:
+        """计算 pp 曲线并写入属性存储，供 extend_scores_dataframe 的 pp_if_accuracies 使用
+
+        :param items: (bid, ruleset_id, 成绩的 mods)，通常是已经保存的成绩中尚无曲线的组合
+        :param progress: 谱面文件下载的进度回调，参数为 (已完成的下载数, 需要下载的总数)
+        :return: 计算的曲线数
+        """
+        beatmaps_dict = await self.async_get_beatmaps_dict(list({bid for bid, _, _ in items}))
+        await BeatmapFileFetcher.get_default().prefetch(beatmaps_dict.values(), Awapi.get_client_session(), progress=progress)
+        calculations = await asyncio.to_thread(prepare_pp_curve_calculations, beatmaps_dict, items)
+        results = await asyncio.gather(*(Osuawa.calculation_executor.run(calculation.job) for calculation in calculations))
+        await asyncio.to_thread(lambda: [apply_pp_curve_result(calculation, result) for calculation, result in zip(calculations, results, strict=True)])
+        return len(calculations)
+
+    async def aiter_complete_scores(self, pages: AsyncIterable[list[Score] | list[MultiplayerScore]], depth: int = 2) -> AsyncIterator[dict[str, CompletedSimpleScoreInfo]]:
+        """流水线式地补全成绩：在上游继续获取第 N+1 页的同时，获取第 N 页的谱面并计算 pp
+
+        :param pages: 按页产出成绩的异步迭代器，例如 ``aiter_recent_scores``
+        :param depth: 同时处理中的页数
+        :return: 异步迭代器，按上游的顺序每次产出一页补全后的成绩
+        """
+        pending: deque[Task[dict[str, CompletedSimpleScoreInfo]]] = deque()
+        try:
+            async for page in pages:
+                pending.append(asyncio.create_task(self.complete_scores_compact({str(score.id): SimpleScoreInfo.from_score(score) for score in page})))
+                if len(pending) >= depth:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
 
     async def async_get_friends(self) -> list[dict[str, Any]]:
         friends = await self.api_friends()
@@ -368,11 +1019,11 @@ class Osuawa(CachedMixIn):
             user: int = self.user[0]
         return self.create_scores_dataframe(self.run_coro(self.async_get_user_beatmap_scores(beatmap, user)))
 
-    async def async_get_recent_scores(self, user: int, include_fails: bool = True, mode: GameMode = GameMode.OSU) -> list[Score]:
-        user_scores = []
-        offset = 0
-        while True:
-            user_scores_recent = await self.api_user_scores(
+    def aiter_recent_scores(self, user: int, include_fails: bool = True, mode: GameMode = GameMode.OSU) -> AsyncIterator[list[Score]]:
+        """按页产出用户的最近成绩"""
+
+        async def fetch_page(offset: int) -> list[Score]:
+            return await self.api_user_scores(
                 user_id=user,
                 type_="recent",
                 mode=mode,
@@ -380,12 +1031,11 @@ class Osuawa(CachedMixIn):
                 limit=50,
                 offset=offset,
             )
-            if len(user_scores_recent) == 0:
-                break
-            user_scores.extend(user_scores_recent)
-            offset += 50
 
-        return user_scores
+        return aiter_offset_pages(fetch_page, 50, self.pagination_window)
+
+    async def async_get_recent_scores(self, user: int, include_fails: bool = True, mode: GameMode = GameMode.OSU) -> list[Score]:
+        return [score async for page in self.aiter_recent_scores(user, include_fails, mode) for score in page]
 
     async def async_get_rooms(self, room_ids: list[int]) -> list[Room]:
         tasks: list[Task[Room]] = []
@@ -399,8 +1049,9 @@ class Osuawa(CachedMixIn):
         rooms = await self.async_get_rooms(room_ids)
         return list(chain.from_iterable([room.playlist for room in rooms]))
 
-    async def async_get_playlist_scores(self, room_id: int, playlist_id: int) -> list[MultiplayerScore]:
-        playlist_scores: list[MultiplayerScore] = []
+    async def aiter_playlist_scores(self, room_id: int, playlist_id: int) -> AsyncIterator[list[MultiplayerScore]]:
+        """按页产出房间中一个谱面的成绩"""
+        # cursor_string 只能从上一页得到，无法并行请求后续页面，只能逐页获取
         cursor_string = None
         while True:
             playlist_cur_scores = await self.api_multiplayer_scores(
@@ -408,20 +1059,23 @@ class Osuawa(CachedMixIn):
                 playlist_id,
                 cursor_string=cursor_string,
             )
-            playlist_scores.extend(playlist_cur_scores.scores)
+            if len(playlist_cur_scores.scores) > 0:
+                yield playlist_cur_scores.scores
             cursor_string = playlist_cur_scores.cursor_string
             if cursor_string == "" or cursor_string is None:
                 break
-        return playlist_scores
 
-    async def async_get_rooms_scores(self, room_ids: list[int]) -> list[MultiplayerScore]:
+    async def async_get_playlist_scores(self, room_id: int, playlist_id: int) -> list[MultiplayerScore]:
+        return [score async for page in self.aiter_playlist_scores(room_id, playlist_id) for score in page]
+
+    async def aiter_rooms_scores(self, room_ids: list[int]) -> AsyncIterator[list[MultiplayerScore]]:
+        """并发获取多个房间所有谱面的成绩，按到达顺序逐页产出"""
         room_playlists = await self.async_get_room_playlists(room_ids)
-        tasks: list[Task[list[MultiplayerScore]]] = []
-        async with asyncio.TaskGroup() as tg:
-            for room_playlist in room_playlists:
-                tasks.append(tg.create_task(self.async_get_playlist_scores(room_playlist.room_id, room_playlist.id)))
-        playlists_scores = [task.result() for task in tasks]
-        return list(chain.from_iterable(playlists_scores))
+        async for page in merge_aiters([self.aiter_playlist_scores(room_playlist.room_id, room_playlist.id) for room_playlist in room_playlists]):
+            yield page
+
+    async def async_get_rooms_scores(self, room_ids: list[int]) -> list[MultiplayerScore]:
+        return [score async for page in self.aiter_rooms_scores(room_ids) for score in page]
 
 
 def cut_text(draw: ImageDraw.ImageDraw, font, text: str, length_limit: float, use_dots: bool) -> str:
@@ -660,15 +1314,17 @@ class OsuPlaylist(object):
                 raise ValueError("custom mod cannot be used other than slot_mod %s" % _mod["acronym"])
 
         # 下载谱面与计算难度
-        download_osu(b)
+        # 谱面文件通常已经在 playlist_task 中预先下载，这里只是校验
+        # 计算是同步阻塞的，放到线程中执行，避免阻塞共享事件循环上其他会话的请求
+        await BeatmapFileFetcher.get_default().fetch(b, Awapi.get_client_session())
         my_attr = SimpleDifficultyAttribute(b.cs, b.accuracy, b.ar, b.bpm or 0, b.hit_length)
         my_attr.set_mods(mods)
         mods_ready: list[str] = to_readable_mods(my_attr.standardized_mods)  # 准备给用户看的 Mods 表现形式
-        osupp_attr = calculate_difficulty(beatmap_path=os.path.join(C.BEATMAPS_CACHE_DIRECTORY.value, "%s.osu" % b.id), mods=my_attr.osu_tool_mods, mod_options=my_attr.osu_tool_mod_options)
+        osupp_attr = await asyncio.to_thread(get_difficulty_attributes, b, my_attr.osu_tool_mods, my_attr.osu_tool_mod_options)
         stars1 = osupp_attr["star_rating"]
         stars2 = None
         if is_fm:
-            osupp_attr_fm = calculate_difficulty(beatmap_path=os.path.join(C.BEATMAPS_CACHE_DIRECTORY.value, "%s.osu" % b.id), mods=my_attr.osu_tool_mods + ["HR"], mod_options=my_attr.osu_tool_mod_options)
+            osupp_attr_fm = await asyncio.to_thread(get_difficulty_attributes, b, my_attr.osu_tool_mods + ["HR"], my_attr.osu_tool_mod_options)
             stars2 = osupp_attr_fm["star_rating"]
         cs = "%s" % round(my_attr.cs, 2)
         ar = "0" if my_attr.ar is None else "%s" % round(my_attr.ar, 2)
@@ -851,7 +1507,9 @@ class OsuPlaylist(object):
                 completed_beatmap[column] = element[column]
         return completed_beatmap
 
-    async def playlist_task(self) -> list[CompletedPlaylistBeatmap]:
+    async def playlist_task(self, progress: Optional[Callable[[int, int], Any]] = None) -> list[CompletedPlaylistBeatmap]:
+        # 先一次性并发下载所有谱面文件，各个 beatmap_task 中的计算不再等待网络
+        await BeatmapFileFetcher.get_default().prefetch((element["beatmap"] for element in self.beatmap_list), Awapi.get_client_session(), progress=progress)
         tasks: list[Task[CompletedPlaylistBeatmap]] = []
         async with asyncio.TaskGroup() as tg:
             for i in range(len(self.beatmap_list)):
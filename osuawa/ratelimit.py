@@ -0,0 +1,194 @@
+"""
+osu! api 请求的限速器
+
+Streamlit 的各个会话与 daemon 各自持有 Awapi 实例，限速器在进程内共享，并可以通过 Redis 在进程之间共享同一个令牌桶
+
+osuawa.py 和 utils.py 的约定同样适用于本文件：不包含 i18n 相关文本和 streamlit 相关语句
+"""
+
+__all__ = (
+    "RateLimiter",
+    "RedisRateLimiter",
+    "create_rate_limiter",
+    "parse_retry_after",
+)
+
+import asyncio
+import logging
+import random
+import threading
+from collections.abc import Mapping
+from email.utils import parsedate_to_datetime
+from time import monotonic, time
+from typing import Any, Optional
+
+from redis import Redis, RedisError
+
+from .utils import C
+
+logger = logging.getLogger(__name__)
+
+# 取出一个令牌，返回需要等待的秒数（令牌不足时预支，等待时间由欠下的令牌数决定），同时考虑共享的冷却时间
+# 使用 Redis 服务器的时间，避免各进程时钟不一致
+_ACQUIRE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+local wait = 0
+if tokens < 0 then
+    wait = -tokens / rate
+end
+local cooldown = tonumber(redis.call('GET', KEYS[2]) or '0')
+if cooldown - now > wait then
+    wait = cooldown - now
+end
+return tostring(wait)
+"""
+
+# 延长共享的冷却时间（只延长，不缩短）
+_PENALIZE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local until_ = now + tonumber(ARGV[1])
+local cooldown = tonumber(redis.call('GET', KEYS[1]) or '0')
+if until_ > cooldown then
+    redis.call('SET', KEYS[1], tostring(until_), 'PX', math.ceil(tonumber(ARGV[1]) * 1000))
+end
+return 1
+"""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 响应头
+
+    :param value: 秒数或 HTTP 日期
+    :return: 需要等待的秒数，无法解析时返回 None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    """进程内的令牌桶限速器，线程安全，可以被运行在不同事件循环中的会话共享
+
+    :param rate: 每秒补充的令牌数，即长期的请求预算
+    :param burst: 令牌桶容量，即允许的突发请求数
+    :param max_retries: 收到 429 后最多重试的次数
+    :param backoff_base: 指数退避的初始等待时间（秒）
+    :param backoff_max: 指数退避的最长等待时间（秒）
+    """
+
+    def __init__(self, rate: float = 16, burst: int = 64, max_retries: int = 5, backoff_base: float = 1, backoff_max: float = 60):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst must be at least 1")
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated_at = monotonic()
+        self._cooldown_until = 0.0
+
+    def _reserve(self) -> float:
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate) - 1
+            self._updated_at = now
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._cooldown_until - now)
+
+    def _penalize(self, delay: float) -> None:
+        with self._lock:
+            self._cooldown_until = max(self._cooldown_until, monotonic() + delay)
+
+    async def acquire(self) -> None:
+        """取出一个令牌，令牌不足或处于冷却时间时等待"""
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def penalize(self, delay: float) -> None:
+        """收到 429 后，让所有共享此限速器的请求暂停
+
+        :param delay: 暂停的秒数
+        """
+        self._penalize(delay)
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """计算第 attempt 次重试前的等待时间
+
+        有 Retry-After 时以其为准并附加少量抖动，否则使用带抖动的指数退避，避免多个请求同时重试
+
+        :param attempt: 重试次数，从 0 开始
+        :param retry_after: Retry-After 指定的秒数
+        :return: 等待的秒数
+        """
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.backoff_base)
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        return random.uniform(delay / 2, delay)
+
+
+class RedisRateLimiter(RateLimiter):
+    """通过 Redis 在进程之间共享的令牌桶限速器，Redis 不可用时退化为进程内限速"""
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = C.RATE_LIMIT_PREFIX.value, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._r = Redis.from_url(url, decode_responses=True)
+        self._bucket_key = prefix + "bucket"
+        self._cooldown_key = prefix + "cooldown"
+        self._acquire_script = self._r.register_script(_ACQUIRE_SCRIPT)
+        self._penalize_script = self._r.register_script(_PENALIZE_SCRIPT)
+
+    async def acquire(self) -> None:
+        try:
+            wait = float(await asyncio.to_thread(self._acquire_script, keys=[self._bucket_key, self._cooldown_key], args=[self.rate, self.burst]))
+        except RedisError as e:
+            logger.warning("redis rate limiter unavailable, falling back to local: %s" % e)
+            wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def penalize(self, delay: float) -> None:
+        self._penalize(delay)
+        try:
+            await asyncio.to_thread(self._penalize_script, keys=[self._cooldown_key], args=[delay])
+        except RedisError as e:
+            logger.warning("failed to share rate limit cooldown: %s" % e)
+
+
+def create_rate_limiter(config: Optional[Mapping[str, Any]]) -> Optional[RateLimiter]:
+    """根据 secrets.toml 中的 [ratelimit] 配置创建限速器
+
+    :param config: [ratelimit] 配置，backend 可选 "redis"、"local" 或 "none"，未配置时使用默认的进程内限速器
+    :return: 限速器，禁用时返回 None
+    """
+    config = dict(config or {})
+    backend = config.pop("backend", "local")
+    redis_url = config.pop("redis_url", "redis://localhost:6379/0")
+    match backend:
+        case "redis":
+            return RedisRateLimiter(redis_url, **config)
+        case "local":
+            return RateLimiter(**config)
+        case "none" | "" | None:
+            return None
+        case _:
+            raise ValueError("unknown rate limiter backend '%s'" % backend)
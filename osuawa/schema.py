@@ -0,0 +1,153 @@
+"""
+主数据库（SQLAlchemy 连接的 sqlite、mysql 或 postgresql）的表结构与版本迁移
+
+CREATE_TABLES 是版本 0 的表结构，之后对表结构的修改都追加到 MIGRATIONS 中，MIGRATIONS[i] 把版本从 i 升级到 i + 1，已经发布的迁移不能再修改。
+当前版本记录在表 SCHEMA_VERSION 中。后台程序启动时自动执行尚未执行的迁移，也可以通过 migrate 命令手动执行
+
+每个迁移在单独的事务中执行。MySQL 的 DDL 会隐式提交，中途失败的迁移无法回滚，因此新的迁移尽量只包含一条语句
+
+osuawa.py 和 utils.py 的约定同样适用于本文件：不包含 i18n 相关文本和 streamlit 相关语句
+"""
+
+__all__ = (
+    "CREATE_TABLES",
+    "MIGRATIONS",
+    "Migration",
+    "create_tables",
+    "get_schema_version",
+    "migrate",
+)
+
+from collections.abc import Callable, Mapping, Sequence
+from typing import Any, NamedTuple, Optional
+
+from sqlalchemy import Connection, Engine, text
+
+# 数据库需要以下表和字段
+# 1. 表 BEATMAP，字段固定为 BID, SID, INFO, SKILL_SLOT, SR, BPM, HIT_LENGTH, MAX_COMBO, CS, AR, OD, MODS, NOTES, STATUS, COMMENTS, POOL, SUGGESTOR, RAW_MODS, ADD_TS, U_ARTIST, U_TITLE （一个经过修改的课题字段，后续可以复用生成课题的代码，逻辑是一样的），使用 BID + MODS 作为主键
+# 2. 表 SCORE，字段与 CompletedSimpleScoreInfo 大体一致，另附加 SCORE_ID 字段作为主键
+# 3. 表 USER_CACHE，字段固定为 USER_ID, USERNAME, AID, LAST_SEEN_TS，AID 为主键
+# 4. 表 SCORE_WATERMARK，字段固定为 USER_ID, SCORE_ID, TS，记录每个用户上一次完整同步时最新的成绩，USER_ID 为主键
+CREATE_TABLES = [
+    "CREATE TABLE IF NOT EXISTS BEATMAP(BID BIGINT, SID BIGINT, INFO TEXT, SKILL_SLOT TEXT, SR TEXT, BPM TEXT, HIT_LENGTH TEXT, MAX_COMBO TEXT, CS TEXT, AR TEXT, OD TEXT, MODS VARCHAR(255), NOTES TEXT, STATUS INT, COMMENTS TEXT, POOL TEXT, SUGGESTOR TEXT, RAW_MODS TEXT, ADD_TS REAL, U_ARTIST TEXT, U_TITLE TEXT, PRIMARY KEY (BID, MODS));",
+    "CREATE TABLE IF NOT EXISTS SCORE(SCORE_ID BIGINT, BID BIGINT, USER_ID BIGINT, SCORE INT, ACCURACY REAL, MAX_COMBO INT, PASSED INT, PP REAL, MODS TEXT, TS REAL, STATISTICS TEXT, ST REAL, RULESET_ID INT, \
+CS REAL, HIT_WINDOW REAL, PREEMPT REAL, BPM REAL, HIT_LENGTH INT, IS_NF INT, IS_HD INT, IS_HIGH_AR INT, IS_LOW_AR INT, IS_VERY_LOW_AR INT, IS_SPEED_UP INT, IS_SPEED_DOWN INT, INFO TEXT, ORIGINAL_DIFFICULTY REAL, B_STAR_RATING REAL, B_MAX_COMBO INT, B_AIM_DIFFICULTY REAL, B_AIM_DIFFICULT_SLIDER_COUNT REAL, B_SPEED_DIFFICULTY REAL, B_SPEED_NOTE_COUNT REAL, B_SLIDER_FACTOR REAL, B_AIM_TOP_WEIGHTED_SLIDER_FACTOR REAL, B_SPEED_TOP_WEIGHTED_SLIDER_FACTOR REAL, B_AIM_DIFFICULT_STRAIN_COUNT REAL, B_SPEED_DIFFICULT_STRAIN_COUNT REAL, PP_AIM REAL, PP_SPEED REAL, PP_ACCURACY REAL, B_PP_100IF_AIM REAL, B_PP_100IF_SPEED REAL, B_PP_100IF_ACCURACY REAL, B_PP_100IF REAL, B_PP_92IF REAL, B_PP_81IF REAL, B_PP_67IF REAL, PRIMARY KEY (SCORE_ID));",
+    "CREATE TABLE IF NOT EXISTS USER_CACHE(USER_ID BIGINT, USERNAME TEXT, AID VARCHAR(36), LAST_SEEN_TS REAL, PRIMARY KEY (AID));",
+    "CREATE TABLE IF NOT EXISTS SCORE_WATERMARK(USER_ID BIGINT, SCORE_ID BIGINT, TS REAL, PRIMARY KEY (USER_ID));",
+]
+
+
+class Migration(NamedTuple):
+    description: str
+    statements: Callable[[str], list[str]]  # dialect（sqlalchemy 的 dialect 名称，如 sqlite、mysql、postgresql） -> 依次执行的语句
+
+
+def _create_index(name: str, table: str, columns: Sequence[str], prefix_lengths: Optional[Mapping[str, int]] = None) -> Callable[[str], list[str]]:
+    """创建索引的迁移
+
+    :param name: 索引名
+    :param table: 表名
+    :param columns: 索引的列
+    :param prefix_lengths: TEXT 列在 MySQL 中只能按前缀建立索引，这里给出前缀的长度
+    """
+
+    def statements(dialect: str) -> list[str]:
+        match dialect:
+            case "mysql":
+                # MySQL 不支持 CREATE INDEX IF NOT EXISTS
+                prefix_lengths_ = prefix_lengths or {}
+                return ["CREATE INDEX %s ON %s (%s)" % (name, table, ", ".join("%s(%d)" % (column, prefix_lengths_[column]) if column in prefix_lengths_ else column for column in columns))]
+            case _:
+                return ["CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (name, table, ", ".join(columns))]
+
+    return statements
+
+
+def _add_columns(table: str, columns: Sequence[tuple[str, str]]) -> Callable[[str], list[str]]:
+    """添加列的迁移
+
+    MySQL 的每条 DDL 都会隐式提交，逐列添加时中途失败会留下一部分列，重试时报错 Duplicate column，因此 mysql 和 postgresql 在一条语句中添加所有列；
+    SQLite 的 ALTER TABLE 每条只能添加一列，但 DDL 可以在事务中回滚
+
+    :param table: 表名
+    :param columns: (列名, 类型)
+    """
+
+    def statements(dialect: str) -> list[str]:
+        match dialect:
+            case "sqlite":
+                return ["ALTER TABLE %s ADD COLUMN %s %s" % (table, column, column_type) for column, column_type in columns]
+            case _:
+                return ["ALTER TABLE %s %s" % (table, ", ".join("ADD COLUMN %s %s" % (column, column_type) for column, column_type in columns))]
+
+    return statements
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(
+        "store derived score columns, existing rows need a backfill",
+        _add_columns(
+            "SCORE",
+            [
+                ("PP_PCT", "REAL"),
+                ("PP_AIM_PCT", "REAL"),
+                ("PP_SPEED_PCT", "REAL"),
+                ("PP_ACCURACY_PCT", "REAL"),
+                ("PP_92PCT", "REAL"),
+                ("PP_81PCT", "REAL"),
+                ("PP_67PCT", "REAL"),
+                ("COMBO_PCT", "REAL"),
+                ("DENSITY", "REAL"),
+                ("AIM_DENSITY_RATIO", "REAL"),
+                ("SPEED_DENSITY_RATIO", "REAL"),
+                ("AIM_SPEED_RATIO", "REAL"),
+                ("SCORE_NF", "BIGINT"),
+                ("READABLE_MODS", "TEXT"),
+                ("ONLY_COMMON_MODS", "INT"),
+                ("DERIVED_VERSION", "INT"),
+            ],
+        ),
+    ),
+    # 按用户和时间范围读取成绩、列出所有用户（SELECT DISTINCT USER_ID）、同步快照时按用户查询成绩 id，USER_ID 开头的索引可以同时满足
+    Migration("index SCORE by (USER_ID, TS)", _create_index("IX_SCORE_USER_ID_TS", "SCORE", ["USER_ID", "TS"])),
+    # 课题页面按 POOL 和 STATUS 筛选
+    Migration("index BEATMAP by (POOL, STATUS)", _create_index("IX_BEATMAP_POOL_STATUS", "BEATMAP", ["POOL", "STATUS"], {"POOL": 64})),
+    # 课题页面按曲目查找重复的谱面（GROUP BY U_ARTIST, U_TITLE）
+    Migration("index BEATMAP by (U_ARTIST, U_TITLE)", _create_index("IX_BEATMAP_U_ARTIST_U_TITLE", "BEATMAP", ["U_ARTIST", "U_TITLE"], {"U_ARTIST": 128, "U_TITLE": 128})),
+    # 登录与注销时按 USER_ID 查询和删除
+    Migration("index USER_CACHE by USER_ID", _create_index("IX_USER_CACHE_USER_ID", "USER_CACHE", ["USER_ID"])),
+]
+
+
+def create_tables(conn: Connection) -> None:
+    """创建版本 0 的表和 SCHEMA_VERSION 表"""
+    for statement in CREATE_TABLES:
+        conn.execute(text(statement))
+    conn.execute(text("CREATE TABLE IF NOT EXISTS SCHEMA_VERSION(VERSION INT);"))
+
+
+def get_schema_version(conn: Connection) -> int:
+    """当前的表结构版本，需要先调用 create_tables"""
+    return conn.execute(text("SELECT MAX(VERSION) FROM SCHEMA_VERSION")).scalar() or 0
+
+
+def migrate(engine: Engine, progress: Optional[Callable[[int, Migration], Any]] = None) -> tuple[int, int]:
+    """创建表并执行尚未执行的迁移
+
+    :param engine: 数据库
+    :param progress: 每执行完一个迁移后的回调，参数为 (迁移后的版本, 迁移)
+    :return: (迁移前的版本, 迁移后的版本)
+    """
+    with engine.begin() as conn:
+        create_tables(conn)
+        version = get_schema_version(conn)
+    if version > len(MIGRATIONS):
+        raise RuntimeError("the database schema version %d is newer than this program (%d)" % (version, len(MIGRATIONS)))
+    for i in range(version, len(MIGRATIONS)):
+        with engine.begin() as conn:
+            for statement in MIGRATIONS[i].statements(engine.dialect.name):
+                conn.execute(text(statement))
+            conn.execute(text("INSERT INTO SCHEMA_VERSION (VERSION) VALUES (:version)"), {"version": i + 1})
+        if progress is not None:
+            progress(i + 1, MIGRATIONS[i])
+    return version, len(MIGRATIONS)
@@ -0,0 +1,206 @@
+"""
+每个用户的成绩快照
+
+后台程序每次保存成绩后，把 SCORE 表中新增的行以 Parquet 文件的形式追加到用户的快照目录中，页面只需按列、按时间范围读取快照，
+不必每次都查询数据库并重建全部成绩。快照按 TS 排序写入，时间范围的过滤可以借助行组的统计信息跳过无关的行组
+
+快照目录中的 manifest.json 列出了当前有效的分片，是唯一的提交点：写入新分片或合并分片时，先写好文件，再原子地替换 manifest.json。
+只允许一个进程（后台程序）写入，读取可以在任意进程中进行
+
+快照中的列与 SCORE 表相同（bool 保存为整数，时间保存为时间戳，mods 与 statistics 保存为 JSON 文本），读取后同样交给 utils.scores_table_to_dataframe 转换。
+旧版本的分片中缺少的列读取为 NULL
+
+osuawa.py 和 utils.py 的约定同样适用于本文件：不包含 i18n 相关文本和 streamlit 相关语句
+"""
+
+__all__ = (
+    "SCORE_SNAPSHOT_SCHEMA",
+    "ScoreSnapshotStore",
+    "create_score_snapshot_store",
+)
+
+import logging
+import os
+import os.path
+import threading
+from collections.abc import Iterable, Mapping, Sequence
+from contextlib import suppress
+from dataclasses import fields
+from datetime import datetime
+from shutil import rmtree
+from time import time_ns
+from types import NoneType, UnionType
+from typing import Any, Optional, Union, get_args, get_origin
+
+import orjson
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+
+from .beatmapstore import _write_atomic
+from .utils import C, CompletedSimpleScoreInfo, ExtendedSimpleScoreInfo, SCORE_DERIVED_COLUMNS, SCORE_DERIVED_FIELDS, SCORE_TABLE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+
+def _arrow_type(field_type: Any) -> pa.DataType:
+    # 与 SCORE 表中的类型保持一致
+    if get_origin(field_type) in (Union, UnionType):
+        field_type = next(arg for arg in get_args(field_type) if arg is not NoneType)
+    if field_type in (int, bool):
+        return pa.int64()
+    if field_type in (float, datetime):
+        return pa.float64()
+    return pa.string()
+
+
+_EXTENDED_FIELD_TYPES = {f.name: f.type for f in fields(ExtendedSimpleScoreInfo)}
+SCORE_SNAPSHOT_SCHEMA = pa.schema(
+    [
+        pa.field(SCORE_TABLE_COLUMNS[0], pa.int64()),
+        *(pa.field(column, _arrow_type(f.type)) for column, f in zip(SCORE_TABLE_COLUMNS[1:], fields(CompletedSimpleScoreInfo), strict=True)),
+        *(pa.field(column, _arrow_type(_EXTENDED_FIELD_TYPES[name])) for column, name in zip(SCORE_DERIVED_COLUMNS[:-1], SCORE_DERIVED_FIELDS, strict=True)),
+        pa.field(SCORE_DERIVED_COLUMNS[-1], pa.int64()),
+    ],
+)
+
+
+class ScoreSnapshotStore(object):
+    """每个用户一个目录的成绩快照
+
+    :param directory: 快照根目录
+    :param max_parts: 分片数超过该值时合并为一个文件
+    :param row_group_size: 每个行组的最大行数，越小则按时间范围读取时跳过的数据越多
+    """
+
+    def __init__(self, directory: str = os.path.join(C.CACHE_DIRECTORY.value, "scores"), max_parts: int = 16, row_group_size: int = 8192):
+        self.directory = directory
+        self.max_parts = max_parts
+        self.row_group_size = row_group_size
+        self._lock = threading.Lock()
+        # 读取时使用内存映射
+        self._filesystem = pyarrow.fs.LocalFileSystem(use_mmap=True)
+
+    def _user_directory(self, user: int) -> str:
+        return os.path.join(self.directory, str(user))
+
+    def _read_manifest(self, user: int) -> Optional[list[str]]:
+        try:
+            with open(os.path.join(self._user_directory(user), "manifest.json"), "rb") as fi_b:
+                return orjson.loads(fi_b.read())["parts"]
+        except FileNotFoundError:
+            return None
+
+    def _write_manifest(self, user: int, parts: list[str]) -> None:
+        _write_atomic(os.path.join(self._user_directory(user), "manifest.json"), orjson.dumps({"parts": parts}))
+
+    def _write_part(self, user: int, table: pa.Table) -> str:
+        name = "part-%d.parquet" % time_ns()
+        path = os.path.join(self._user_directory(user), name)
+        tmp_path = path + ".tmp"
+        try:
+            pq.write_table(table.sort_by("TS"), tmp_path, row_group_size=self.row_group_size, compression="zstd")
+            os.replace(tmp_path, path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+        return name
+
+    def exists(self, user: int) -> bool:
+        return self._read_manifest(user) is not None
+
+    def read(self, user: int, begin_ts: Optional[float] = None, end_ts: Optional[float] = None, columns: Optional[Sequence[str]] = None) -> Optional[pa.Table]:
+        """读取用户的快照
+
+        :param user: 用户
+        :param begin_ts: TS 的下界（包含）
+        :param end_ts: TS 的上界（包含）
+        :param columns: 需要的列，默认为全部
+        :return: 按 TS 排序的成绩，快照不存在时返回 None
+        """
+        expression = None
+        if begin_ts is not None:
+            expression = ds.field("TS") >= begin_ts
+        if end_ts is not None:
+            expression = ds.field("TS") <= end_ts if expression is None else expression & (ds.field("TS") <= end_ts)
+        columns = list(columns or SCORE_SNAPSHOT_SCHEMA.names)
+        # 读取期间分片可能恰好被合并删除，此时重新读取 manifest.json
+        for _ in range(3):
+            parts = self._read_manifest(user)
+            if parts is None:
+                return None
+            user_directory = self._user_directory(user)
+            try:
+                dataset = ds.dataset([os.path.join(user_directory, part) for part in parts], schema=SCORE_SNAPSHOT_SCHEMA, format="parquet", filesystem=self._filesystem)
+                table = dataset.to_table(columns=list(dict.fromkeys([*columns, "TS"])), filter=expression)
+            except FileNotFoundError:
+                continue
+            return table.sort_by("TS").select(columns)
+        raise RuntimeError("the score snapshot of user %d keeps changing" % user)
+
+    def score_ids(self, user: int) -> set[int]:
+        """快照中已有的成绩 id，快照不存在时为空集"""
+        table = self.read(user, columns=[SCORE_TABLE_COLUMNS[0]])
+        return set() if table is None else set(table.column(0).to_pylist())
+
+    def append(self, user: int, rows: Iterable[Sequence[Any]]) -> int:
+        """追加成绩，只能在一个进程中调用
+
+        :param user: 用户
+        :param rows: 按 SCORE_TABLE_COLUMNS + SCORE_DERIVED_COLUMNS 的顺序从 SCORE 表中查询出的行
+        :return: 追加的行数
+        """
+        columns = list(zip(*rows, strict=True))
+        if not columns:
+            return 0
+        table = pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, SCORE_SNAPSHOT_SCHEMA, strict=True)], schema=SCORE_SNAPSHOT_SCHEMA)
+        with self._lock:
+            os.makedirs(self._user_directory(user), exist_ok=True)
+            parts = self._read_manifest(user) or []
+            parts.append(self._write_part(user, table))
+            self._write_manifest(user, parts)
+            if len(parts) > self.max_parts:
+                self._compact(user, parts)
+        return table.num_rows
+
+    def compact(self, user: int) -> None:
+        """把用户快照的所有分片合并为一个文件"""
+        with self._lock:
+            parts = self._read_manifest(user)
+            if parts is not None:
+                self._compact(user, parts)
+
+    def _compact(self, user: int, parts: list[str]) -> None:
+        user_directory = self._user_directory(user)
+        table = ds.dataset([os.path.join(user_directory, part) for part in parts], schema=SCORE_SNAPSHOT_SCHEMA, format="parquet").to_table()
+        part = self._write_part(user, table)
+        self._write_manifest(user, [part])
+        # 正在读取旧分片的进程会重新读取 manifest.json；Windows 上仍被映射的文件无法删除，留到下一次合并
+        for filename in os.listdir(user_directory):
+            if filename.endswith(".parquet") and filename != part:
+                with suppress(OSError):
+                    os.remove(os.path.join(user_directory, filename))
+        logger.info("compacted %d parts of the score snapshot of user %d (%d rows)" % (len(parts), user, table.num_rows))
+
+    def remove(self, user: int) -> None:
+        """删除用户的快照，下次同步时重新生成"""
+        with self._lock:
+            rmtree(self._user_directory(user), ignore_errors=True)
+
+
+def create_score_snapshot_store(config: Optional[Mapping[str, Any]]) -> Optional[ScoreSnapshotStore]:
+    """根据 secrets.toml 中的 [score_snapshots] 配置创建成绩快照
+
+    :param config: [score_snapshots] 配置
+    :return: 成绩快照，enabled 为 false 时返回 None
+    """
+    config = dict(config or {})
+    if not config.get("enabled", True):
+        return None
+    return ScoreSnapshotStore(
+        config.get("directory", os.path.join(C.CACHE_DIRECTORY.value, "scores")),
+        config.get("max_parts", 16),
+        config.get("row_group_size", 8192),
+    )
@@ -0,0 +1,125 @@
+"""
+成绩批量写入 SCORE 表
+
+后台程序保存成绩时，先用 utils.score_table_row 把成绩直接转换为元组，再按数据库选择写入方式，SCORE_ID 已经存在的成绩被忽略：
+
+- SQLite：在调用方的事务中 executemany
+- MySQL：多行 VALUES 分批 INSERT IGNORE
+- PostgreSQL：COPY 到临时表，再 INSERT ... SELECT ... ON CONFLICT DO NOTHING
+
+osuawa.py 和 utils.py 的约定同样适用于本文件：不包含 i18n 相关文本和 streamlit 相关语句
+"""
+
+__all__ = (
+    "MySQLScoreWriter",
+    "PostgreSQLScoreWriter",
+    "SCORE_WRITE_COLUMNS",
+    "SQLiteScoreWriter",
+    "ScoreWriter",
+    "create_score_writer",
+)
+
+import io
+from collections.abc import Sequence
+from itertools import chain
+from typing import Any
+
+from sqlalchemy import Connection, Engine
+
+from .utils import SCORE_DERIVED_COLUMNS, SCORE_TABLE_COLUMNS
+
+# 写入的行按此顺序排列
+SCORE_WRITE_COLUMNS = [*SCORE_TABLE_COLUMNS, *SCORE_DERIVED_COLUMNS]
+
+
+class ScoreWriter(object):
+    """把成绩写入 SCORE 表，SCORE_ID 已经存在的成绩被忽略
+
+    :param batch_size: 每条语句最多写入的行数（只对需要分批的数据库有效）
+    """
+
+    def __init__(self, batch_size: int = 1000):
+        self.batch_size = batch_size
+
+    def write(self, conn: Connection, rows: Sequence[Sequence[Any]]) -> int:
+        """写入成绩
+
+        :param conn: 数据库连接，在调用方的事务中写入
+        :param rows: 按 SCORE_WRITE_COLUMNS 排列的行
+        :return: 实际插入的行数
+        """
+        raise NotImplementedError
+
+
+class SQLiteScoreWriter(ScoreWriter):
+    def write(self, conn: Connection, rows: Sequence[Sequence[Any]]) -> int:
+        if len(rows) == 0:
+            return 0
+        statement = "INSERT INTO SCORE (%s) VALUES (%s) ON CONFLICT (SCORE_ID) DO NOTHING" % (", ".join(SCORE_WRITE_COLUMNS), ", ".join("?" * len(SCORE_WRITE_COLUMNS)))
+        return conn.exec_driver_sql(statement, list(rows)).rowcount
+
+
+class MySQLScoreWriter(ScoreWriter):
+    def write(self, conn: Connection, rows: Sequence[Sequence[Any]]) -> int:
+        placeholders = "(%s)" % ", ".join(["%s"] * len(SCORE_WRITE_COLUMNS))
+        count = 0
+        for i in range(0, len(rows), self.batch_size):
+            batch = rows[i : i + self.batch_size]
+            statement = "INSERT IGNORE INTO SCORE (%s) VALUES %s" % (", ".join(SCORE_WRITE_COLUMNS), ", ".join([placeholders] * len(batch)))
+            count += conn.exec_driver_sql(statement, tuple(chain.from_iterable(batch))).rowcount
+        return count
+
+
+def _copy_text(value: Any) -> str:
+    # COPY 的 text 格式：\N 表示 NULL，反斜杠、制表符与换行需要转义
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class PostgreSQLScoreWriter(ScoreWriter):
+    def write(self, conn: Connection, rows: Sequence[Sequence[Any]]) -> int:
+        if len(rows) == 0:
+            return 0
+        columns = ", ".join(SCORE_WRITE_COLUMNS)
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join(map(_copy_text, row)))
+            buffer.write("\n")
+        # 临时表只在当前事务中存在
+        conn.exec_driver_sql("CREATE TEMPORARY TABLE SCORE_STAGING (LIKE SCORE INCLUDING DEFAULTS) ON COMMIT DROP")
+        copy_statement = "COPY SCORE_STAGING (%s) FROM STDIN" % columns
+        cursor = conn.connection.cursor()
+        try:
+            match conn.dialect.driver:
+                case "psycopg2":
+                    buffer.seek(0)
+                    cursor.copy_expert(copy_statement, buffer)
+                case "psycopg":
+                    with cursor.copy(copy_statement) as copy:
+                        copy.write(buffer.getvalue())
+                case _ as driver:
+                    raise ValueError("COPY is not supported by the driver '%s'" % driver)
+        finally:
+            cursor.close()
+        count = conn.exec_driver_sql("INSERT INTO SCORE (%s) SELECT %s FROM SCORE_STAGING ON CONFLICT (SCORE_ID) DO NOTHING" % (columns, columns)).rowcount
+        # 同一事务中可能再次写入
+        conn.exec_driver_sql("DROP TABLE SCORE_STAGING")
+        return count
+
+
+def create_score_writer(engine: Engine) -> ScoreWriter:
+    """根据数据库的 dialect 创建成绩写入方式
+
+    :param engine: 数据库
+    :return: 成绩写入方式
+    """
+    match engine.dialect.name:
+        case "sqlite":
+            return SQLiteScoreWriter()
+        case "mysql":
+            return MySQLScoreWriter()
+        case "postgresql":
+            return PostgreSQLScoreWriter()
+        case _ as dialect:
+            raise ValueError("unknown dialect '%s'" % dialect)
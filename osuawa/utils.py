@@ -6,13 +6,15 @@ import contextlib
 import os
 import re
 import uuid
+from collections.abc import Iterable, Mapping
 from dataclasses import dataclass, fields
 from datetime import datetime, timezone
 from enum import Enum, unique
+from functools import cache, lru_cache
 from math import log10, sqrt
+from operator import attrgetter
 from random import shuffle
-from threading import BoundedSemaphore
-from time import sleep, time, time_ns
+from time import time, time_ns
 from typing import Any, Literal, NamedTuple, NewType, Optional, TypedDict, Union, cast, get_args, get_origin
 
 import numpy as np
@@ -20,8 +22,7 @@ import orjson
 import pandas as pd
 import typing_extensions
 from PerformanceCalculator import ProcessorWorkingBeatmap
-from clayutil.futil import Downloader, Properties
-from clayutil.sutil import md5sum
+from clayutil.futil import Properties
 from ossapi.models import MultiplayerScore
 from ossapi.ossapiv2_async import Beatmap, Score, User, UserCompact
 from osu.Game.Rulesets.Catch import CatchRuleset
@@ -33,6 +34,8 @@ from osupp.performance import CatchPerformance, ManiaPerformance, OsuPerformance
 from osupp.util import validate_mod_setting_value
 from redis import Redis
 
+from .attributes import AttributeKey, AttributeStore, calculator_version, make_attribute_key, make_mods_key
+
 assert calculate_difficulty, calculate_performance
 
 headers = {
@@ -40,20 +43,99 @@ headers = {
     "User-Agent": "osuawa",
 }
 LANGUAGES = ["en_US", "zh_CN"]
-osu_mod_entries = get_all_mods(OsuRuleset())
-osu_mod_indexes = {mod_entry["Acronym"]: mod_entry for mod_entry in osu_mod_entries}
-_osu_mod_settings_mapping = {mod_entry["Acronym"]: dict((s["Name"], s) for s in mod_entry["Settings"]) for mod_entry in osu_mod_entries}
-taiko_mod_entries = get_all_mods(TaikoRuleset())
-taiko_mod_indexes = {mod_entry["Acronym"]: mod_entry for mod_entry in taiko_mod_entries}
-_taiko_mod_settings_mapping = {mod_entry["Acronym"]: dict((s["Name"], s) for s in mod_entry["Settings"]) for mod_entry in taiko_mod_entries}
-catch_mod_entries = get_all_mods(CatchRuleset())
-catch_mod_indexes = {mod_entry["Acronym"]: mod_entry for mod_entry in catch_mod_entries}
-_catch_mod_settings_mapping = {mod_entry["Acronym"]: dict((s["Name"], s) for s in mod_entry["Settings"]) for mod_entry in catch_mod_entries}
-mania_mod_entries = get_all_mods(ManiaRuleset())
-mania_mod_indexes = {mod_entry["Acronym"]: mod_entry for mod_entry in mania_mod_entries}
-_mania_mod_settings_mapping = {mod_entry["Acronym"]: dict((s["Name"], s) for s in mod_entry["Settings"]) for mod_entry in mania_mod_entries}
-
-sem = BoundedSemaphore()
+
+
+@cache
+def get_mod_entries(ruleset_id: Literal[0, 1, 2, 3]) -> list[dict[str, Any]]:
+    """读取 ruleset 的所有 mods，第一次使用时才生成
+
+    通过 pythonnet 反射生成 mod 表很慢，生成后按 osu-tools 的版本缓存到磁盘上，之后启动的进程直接读取
+
+    :param ruleset_id: 游戏模式 ID
+    :return: osupp.difficulty.get_all_mods 的结果
+    """
+    path = os.path.join(C.CACHE_DIRECTORY.value, "mods", "%d-%s.json" % (ruleset_id, calculator_version()))
+    try:
+        with open(path, "rb") as fi_b:
+            return orjson.loads(fi_b.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        pass
+    match ruleset_id:
+        case 0:
+            mod_entries = get_all_mods(OsuRuleset())
+        case 1:
+            mod_entries = get_all_mods(TaikoRuleset())
+        case 2:
+            mod_entries = get_all_mods(CatchRuleset())
+        case 3:
+            mod_entries = get_all_mods(ManiaRuleset())
+        case _:
+            raise ValueError("unknown ruleset id %s" % ruleset_id)
+    # 先写入临时文件再重命名，多个进程同时生成时也不会读到不完整的文件
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+    with open(tmp_path, "wb") as fo_b:
+        fo_b.write(orjson.dumps(mod_entries))
+    os.replace(tmp_path, path)
+    return mod_entries
+
+
+@cache
+def get_mod_indexes(ruleset_id: Literal[0, 1, 2, 3]) -> dict[str, dict[str, Any]]:
+    """acronym -> mod"""
+    return {mod_entry["Acronym"]: mod_entry for mod_entry in get_mod_entries(ruleset_id)}
+
+
+# mods 位掩码的最高位表示 ruleset 中不存在的 mod
+MODS_MASK_UNKNOWN = 1 << 63
+
+
+@cache
+def get_mod_bits(ruleset_id: Literal[0, 1, 2, 3]) -> dict[str, int]:
+    """acronym -> mods 位掩码中的位
+
+    按缩写排序依次分配，只在同一 ruleset 与同一版本的 osu-tools 中有意义，不要保存到数据库
+    """
+    acronyms = sorted(get_mod_indexes(ruleset_id))
+    if len(acronyms) > 63:
+        raise ValueError("ruleset %d has too many mods for a 64-bit mask" % ruleset_id)
+    return {acronym: 1 << i for i, acronym in enumerate(acronyms)}
+
+
+def calc_mods_mask(acronyms: Iterable[str], ruleset_id: Literal[0, 1, 2, 3]) -> int:
+    """把 mods 的缩写转换为位掩码，不存在的 mod 记为 MODS_MASK_UNKNOWN"""
+    bits = get_mod_bits(ruleset_id)
+    mask = 0
+    for acronym in acronyms:
+        mask |= bits.get(acronym, MODS_MASK_UNKNOWN)
+    return mask
+
+
+@cache
+def _get_mod_settings_mapping(ruleset_id: Literal[0, 1, 2, 3]) -> dict[str, dict[str, dict[str, Any]]]:
+    # acronym -> setting name -> setting
+    return {mod_entry["Acronym"]: dict((s["Name"], s) for s in mod_entry["Settings"]) for mod_entry in get_mod_entries(ruleset_id)}
+
+
+# 兼容原先在导入时生成的模块变量，访问时才生成
+_LAZY_MOD_TABLES = {
+    "osu_mod_entries": (get_mod_entries, 0),
+    "osu_mod_indexes": (get_mod_indexes, 0),
+    "taiko_mod_entries": (get_mod_entries, 1),
+    "taiko_mod_indexes": (get_mod_indexes, 1),
+    "catch_mod_entries": (get_mod_entries, 2),
+    "catch_mod_indexes": (get_mod_indexes, 2),
+    "mania_mod_entries": (get_mod_entries, 3),
+    "mania_mod_indexes": (get_mod_indexes, 3),
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name in _LAZY_MOD_TABLES:
+        getter, ruleset_id = _LAZY_MOD_TABLES[name]
+        return getter(ruleset_id)
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
 
 TYPE_MAPPING: dict[type, str] = {
     int: "INT",
@@ -77,9 +159,12 @@ class C(Enum):
 
     OAUTH_TOKEN_DIRECTORY = "./.streamlit/.oauth/"
     COMPONENTS_SHELVES_DIRECTORY = "./.streamlit/.components/"
+    CACHE_DIRECTORY = "./.streamlit/.cache/"
 
     TASK_QUEUE = "awatasks:queue"
     TASK_STATUS = "awatask:status:{task_id}"
+    API_CACHE_PREFIX = "awacache:"
+    RATE_LIMIT_PREFIX = "awaratelimit:"
 
     SLOT_MAX_LEN = 5
 
@@ -273,132 +358,144 @@ def _check_index_range(v: int, max_index: int, setting_name: str, acronym: str):
         raise ValueError("setting '%s' of mod '%s' out of range" % (setting_name, acronym))
 
 
+MOD_TYPE_ORDER = ["DifficultyReduction", "DifficultyIncrease", "Automation", "Conversion", "Fun", "System"]
+
+
+class _ModSettingSpec(NamedTuple):
+    type: Literal["boolean", "number", "string", "enum"]
+    enum_lookup: Optional[dict[str, str]]  # 枚举值 -> 索引字符串，与 list.index 一样取第一次出现的位置
+    enum_count: int
+
+
+class _ModSpec(NamedTuple):
+    type: str
+    type_rank: int  # 在 MOD_TYPE_ORDER 中的位置，未知的类型为 -1
+    settings: dict[str, _ModSettingSpec]
+
+
+@cache
+def _compile_mod_specs(ruleset_id: Literal[0, 1, 2, 3]) -> dict[str, _ModSpec]:
+    # 每个 ruleset 只编译一次：设置的类型与枚举值的查找表
+    mod_settings_mapping, mod_indexes = _get_mod_settings_mapping(ruleset_id), get_mod_indexes(ruleset_id)
+    specs = {}
+    for acronym, settings in mod_settings_mapping.items():
+        setting_specs = {}
+        for setting_name, setting in settings.items():
+            enum_values = setting["EnumValues"] if setting["Type"] == "enum" else None
+            enum_lookup = None
+            if enum_values is not None:
+                enum_lookup = {}
+                for i, enum_value in enumerate(enum_values):
+                    enum_lookup.setdefault(enum_value, str(i))
+            setting_specs[setting_name] = _ModSettingSpec(setting["Type"], enum_lookup, 0 if enum_values is None else len(enum_values))
+        mod_type = mod_indexes[acronym]["Type"]
+        specs[acronym] = _ModSpec(mod_type, MOD_TYPE_ORDER.index(mod_type) if mod_type in MOD_TYPE_ORDER else -1, setting_specs)
+    return specs
+
+
+def _clean_mod_setting_value(setting_value: Any, spec: _ModSettingSpec, setting_name: str, acronym: str) -> Any:
+    if not validate_mod_setting_value(setting_value, spec.type):
+        raise ValueError("setting '%s' for mod '%s' should be of type '%s'" % (setting_name, acronym, spec.type))
+    if spec.type == "boolean":
+        return "true" if setting_value else "false"  # if bool(a) is True, then a is "true"
+    if spec.type != "enum":
+        return setting_value
+    # 强制要求枚举型用字符串整型表示
+    if spec.enum_lookup is None:
+        raise ValueError("undefined enum values for setting '%s' of mod '%s'" % (setting_name, acronym))
+    elif spec.enum_count == 0:  # 这种情况应该不会出现，但是还是进行安全检查
+        raise ValueError("empty enum values for setting '%s' of mod '%s'" % (setting_name, acronym))
+    # 这里可能有 4 种情况：
+    # 1. setting_value 是整型 => 检查是否越界，转换为字符串
+    # 2. setting_value 是浮点型/布尔型 => 直接拒绝
+    # 3. setting_value 是整型字符串 => 转换为整型并与 1 相同
+    # 4. setting_value 是枚举型定义的对应字符串 => 查找索引并转换为字符串
+    if isinstance(setting_value, int):
+        _check_index_range(setting_value, spec.enum_count, setting_name, acronym)  # 检查是否越界
+        return str(setting_value)
+    elif isinstance(setting_value, (float, bool)):
+        raise ValueError("unexpected enum value %s for setting '%s' of mod '%s'" % (setting_value, setting_name, acronym))
+    elif setting_value in spec.enum_lookup:
+        return spec.enum_lookup[setting_value]
+    elif setting_value.isdigit():
+        # 这里要确保前导 0 被正确剔除，如 "01" -> "1"
+        int_setting_value = int(setting_value)
+        _check_index_range(int_setting_value, spec.enum_count, setting_name, acronym)
+        return str(int_setting_value)
+    raise ValueError("unknown enum value %s for setting '%s' of mod '%s'" % (setting_value, setting_name, acronym))
+
+
+# 冻结后的 mods：((acronym, ((setting_name, setting_value, type(setting_value)), ...)), ...)
+# 带上值的类型，避免 True 与 1、1 与 1.0 这样相等但校验结果不同的值共用缓存
+type FrozenMods = tuple[tuple[str, tuple[tuple[str, Any, type], ...]], ...]
+
+
+def freeze_mods(mods: list[dict[str, Any]]) -> FrozenMods:
+    """把标准 mods 列表转换为可哈希的形式，保留 mods 与设置的顺序"""
+    return tuple((mod["acronym"], tuple((k, v, type(v)) for k, v in mod.get("settings", {}).items())) for mod in mods)
+
+
+@lru_cache(maxsize=1024)
+def _transform_frozen_mods(frozen_mods: FrozenMods, ruleset_id: Literal[0, 1, 2, 3]) -> tuple[tuple[tuple[str, tuple[tuple[str, Any], ...]], ...], tuple[str, ...], tuple[str, ...]]:
+    # 返回不可变的结果，由调用者复制成列表与字典
+    mod_specs = _compile_mod_specs(ruleset_id)
+    transformed = []
+    osu_tool_mods = []
+    osu_tool_mod_options = []
+    for acronym, settings in frozen_mods:
+        mod_spec = mod_specs.get(acronym)
+        if mod_spec is None:
+            raise ValueError("unknown mod '%s'" % acronym)
+        cleaned_settings = []
+        for setting_name, setting_value, _ in settings:
+            setting_spec = mod_spec.settings.get(setting_name)
+            if setting_spec is None:
+                raise ValueError("unknown setting '%s' for mod '%s'" % (setting_name, acronym))
+            setting_value = _clean_mod_setting_value(setting_value, setting_spec, setting_name, acronym)
+            cleaned_settings.append((setting_name, setting_value))
+            osu_tool_mod_options.append("%s_%s=%s" % (acronym, setting_name, setting_value))
+        if mod_spec.type_rank < 0:
+            raise ValueError("unknown mod type '%s' for mod '%s'" % (mod_spec.type, acronym))
+        transformed.append((mod_spec.type_rank, acronym, tuple(cleaned_settings)))
+        osu_tool_mods.append(acronym)
+    # standardized_mods 的顺序如下：
+    # 1. 首先按照 MOD_TYPE_ORDER 把所有 mods 分堆
+    # 2. 每一堆内，按照 acronym 字符串排序（稳定排序，acronym 相同时保持输入顺序）
+    # 3. 拼接所有堆，得到 standardized_mods
+    transformed.sort(key=lambda x: (x[0], x[1]))
+    return tuple((acronym, settings) for _, acronym, settings in transformed), tuple(osu_tool_mods), tuple(osu_tool_mod_options)
+
+
 class SimpleDifficultyAttribute(object):
 
     @classmethod
     def validate_and_transform_mods(cls, mods: list[dict[str, Any]], ruleset_id: Optional[Literal[0, 1, 2, 3]] = None, beatmap_path: Optional[str] = None) -> tuple[list[dict[str, Any]], dict[str, Any], list[str], list[str]]:
         """验证并转换标准 mods 列表
 
+        同一 ruleset 下相同的 mods 只验证一次，结果保存在 LRU 缓存中
+
         :param mods: 模组列表
         :param ruleset_id: 游戏模式 ID，若为 None 则默认使用当前谱面的模式 ID
         :param beatmap_path: 谱面文件路径
         :return: (standardized_mods（已排序的）, {acronym, settings}, osu_tool_mods（与输入顺序一致）, osu_tool_mod_options（与输入顺序一致）)
         """
-        match ruleset_id:
-            case 0:
-                ruleset_mod_settings_mapping = _osu_mod_settings_mapping
-                ruleset_mod_indexes = osu_mod_indexes
-            case 1:
-                ruleset_mod_settings_mapping = _taiko_mod_settings_mapping
-                ruleset_mod_indexes = taiko_mod_indexes
-            case 2:
-                ruleset_mod_settings_mapping = _catch_mod_settings_mapping
-                ruleset_mod_indexes = catch_mod_indexes
-            case 3:
-                ruleset_mod_settings_mapping = _mania_mod_settings_mapping
-                ruleset_mod_indexes = mania_mod_indexes
-            case _:
-                if beatmap_path is None:
-                    raise ValueError("cannot determine the ruleset")
-                working_beatmap = ProcessorWorkingBeatmap(beatmap_path)
-                ruleset_id: Literal[0, 1, 2, 3] = cast(
-                    Literal[0, 1, 2, 3],
-                    working_beatmap.BeatmapInfo.Ruleset.OnlineID,
-                )
-                return cls.validate_and_transform_mods(mods, ruleset_id)
-
-        # standardized_mods 的顺序如下：
-        # 1. 首先把所有 mods 分为五堆："DifficultyReduction", "DifficultyIncrease", "Automation", "Conversion", "Fun", "System"
-        # 2. 每一堆内，按照 acronym 字符串排序
-        # 3. 拼接所有堆，得到 standardized_mods
-        _mods_dr, _mods_di, _mods_au, _mods_co, _mods_fu, _mods_sy = [], [], [], [], [], []
-
-        standardized_mods = []
-        mods_dict = {}  # {acronym, settings}
-        osu_tool_mods: list[str] = []
-        osu_tool_mod_options: list[str] = []
-
-        # 需要两次遍历 mods，第一次用来验证和转换，第二次用来排序和分堆
-        for mod in mods:
-            acronym = mod["acronym"]
-            if acronym not in ruleset_mod_settings_mapping:
-                raise ValueError("unknown mod '%s'" % acronym)
-            _settings = mod.get("settings", {})
-            del mod
-            cleaned_settings = {}
-
-            # 开始 mod_setting 验证和转换
-            for setting_name, setting_value in _settings.items():
-                if setting_name not in ruleset_mod_settings_mapping[acronym]:
-                    raise ValueError("unknown setting '%s' for mod '%s'" % (setting_name, acronym))
-                expected_type: Literal["boolean", "number", "string", "enum"] = ruleset_mod_settings_mapping[acronym][setting_name]["Type"]
-                if not validate_mod_setting_value(setting_value, expected_type):
-                    raise ValueError(
-                        "setting '%s' for mod '%s' should be of type '%s'"
-                        % (
-                            setting_name,
-                            acronym,
-                            expected_type,
-                        ),
-                    )
-                if expected_type == "boolean":
-                    setting_value = "true" if setting_value else "false"  # if bool(a) is True, then a is "true"
-                elif expected_type == "enum":
-                    # 强制要求枚举型用字符串整型表示
-                    enum_values = ruleset_mod_settings_mapping[acronym][setting_name]["EnumValues"]
-                    if enum_values is None:
-                        raise ValueError("undefined enum values for setting '%s' of mod '%s'" % (setting_name, acronym))
-                    elif len(enum_values) == 0:  # 这种情况应该不会出现，但是还是进行安全检查
-                        raise ValueError("empty enum values for setting '%s' of mod '%s'" % (setting_name, acronym))
-                    # 这里可能有 4 种情况：
-                    # 1. setting_value 是整型 => 检查是否越界，转换为字符串
-                    # 2. setting_value 是浮点型/布尔型 => 直接拒绝
-                    # 3. setting_value 是整型字符串 => 转换为整型并与 1 相同
-                    # 4. setting_value 是枚举型定义的对应字符串 => 查找索引并转换为字符串
-                    if isinstance(setting_value, int):
-                        _check_index_range(setting_value, len(enum_values), setting_name, acronym)  # 检查是否越界
-                        setting_value = str(setting_value)
-                    elif isinstance(setting_value, (float, bool)):
-                        raise ValueError("unexpected enum value %s for setting '%s' of mod '%s'" % (setting_value, setting_name, acronym))
-                    else:
-                        if setting_value in enum_values:
-                            setting_value = str(enum_values.index(setting_value))
-                        else:
-                            if setting_value.isdigit():
-                                # 这里要确保前导 0 被正确剔除，如 "01" -> "1"
-                                int_setting_value = int(setting_value)
-                                _check_index_range(int_setting_value, len(enum_values), setting_name, acronym)
-                                setting_value = str(int_setting_value)
-                            else:
-                                raise ValueError("unknown enum value %s for setting '%s' of mod '%s'" % (setting_value, setting_name, acronym))
-                cleaned_settings[setting_name] = setting_value
-                osu_tool_mod_options.append("%s_%s=%s" % (acronym, setting_name, setting_value))
-
-            del _settings
-            mod = {"acronym": acronym, "settings": cleaned_settings}  # redefine mod
-            mods_dict[acronym] = cleaned_settings
-            osu_tool_mods.append(acronym)
-
-            _type = ruleset_mod_indexes[acronym]["Type"]
-            match _type:
-                case "DifficultyReduction":
-                    _mods_dr.append(mod)
-                case "DifficultyIncrease":
-                    _mods_di.append(mod)
-                case "Automation":
-                    _mods_au.append(mod)
-                case "Conversion":
-                    _mods_co.append(mod)
-                case "Fun":
-                    _mods_fu.append(mod)
-                case "System":
-                    _mods_sy.append(mod)
-                case _:
-                    raise ValueError("unknown mod type '%s' for mod '%s'" % (_type, acronym))
-        for _mods in [_mods_dr, _mods_di, _mods_au, _mods_co, _mods_fu, _mods_sy]:
-            standardized_mods.extend(sorted(_mods, key=lambda x: x["acronym"]))
-
-        return standardized_mods, mods_dict, osu_tool_mods, osu_tool_mod_options
+        if ruleset_id not in (0, 1, 2, 3):
+            if beatmap_path is None:
+                raise ValueError("cannot determine the ruleset")
+            working_beatmap = ProcessorWorkingBeatmap(beatmap_path)
+            ruleset_id: Literal[0, 1, 2, 3] = cast(
+                Literal[0, 1, 2, 3],
+                working_beatmap.BeatmapInfo.Ruleset.OnlineID,
+            )
+            return cls.validate_and_transform_mods(mods, ruleset_id)
+
+        transformed, osu_tool_mods, osu_tool_mod_options = _transform_frozen_mods(freeze_mods(mods), ruleset_id)
+        # 缓存中的结果是共享的，返回给调用者的是新的列表与字典
+        standardized_mods = [{"acronym": acronym, "settings": dict(settings)} for acronym, settings in transformed]
+        # acronym 重复时后者覆盖前者（排序是稳定的，transformed 中同一 acronym 的顺序与输入一致）
+        last_settings = dict(transformed)
+        mods_dict = {acronym: dict(last_settings[acronym]) for acronym in osu_tool_mods}  # {acronym, settings}
+        return standardized_mods, mods_dict, list(osu_tool_mods), list(osu_tool_mod_options)
 
     def __init__(self, cs: float, accuracy: float, ar: float, bpm: float, hit_length: int, ruleset_id: Literal[0, 1, 2, 3] = 0):
         self.cs = cs
@@ -471,6 +568,149 @@ class SimpleDifficultyAttribute(object):
         self.hit_length = round(self.hit_length / self.magnitude)
 
 
+# encode_mods 生成的 mod 矩阵的列
+MOD_MATRIX_COLUMNS = ["is_nf", "is_hd", "difficulty_mod", "da_cs", "da_accuracy", "da_ar", "magnitude"]
+# difficulty_mod 列的取值，与 set_mods 一样 HR、EZ、DA 只有一个生效
+_DIFFICULTY_MOD_NONE, _DIFFICULTY_MOD_HR, _DIFFICULTY_MOD_EZ, _DIFFICULTY_MOD_DA = 0, 1, 2, 3
+
+
+@lru_cache(maxsize=1024)
+def _encode_frozen_mods(frozen_mods: FrozenMods, ruleset_id: Literal[0, 1, 2, 3]) -> tuple[float, ...]:
+    mods = [{"acronym": acronym, "settings": {k: v for k, v, _ in settings}} for acronym, settings in frozen_mods]
+    mods_dict = SimpleDifficultyAttribute.validate_and_transform_mods(mods, ruleset_id)[1]
+    # 与 set_mods 的判断顺序保持一致
+    da_cs = da_accuracy = da_ar = np.nan
+    if "HR" in mods_dict:
+        difficulty_mod = _DIFFICULTY_MOD_HR
+    elif "EZ" in mods_dict:
+        difficulty_mod = _DIFFICULTY_MOD_EZ
+    elif "DA" in mods_dict:
+        difficulty_mod = _DIFFICULTY_MOD_DA
+        da_cs = mods_dict["DA"].get("circle_size", np.nan)
+        da_accuracy = mods_dict["DA"].get("overall_difficulty", np.nan)
+        da_ar = mods_dict["DA"].get("approach_rate", np.nan)
+    else:
+        difficulty_mod = _DIFFICULTY_MOD_NONE
+    magnitude = 1.0
+    if "DT" in mods_dict:
+        magnitude = mods_dict["DT"].get("speed_change", 1.5)
+    elif "NC" in mods_dict:
+        magnitude = mods_dict["NC"].get("speed_change", 1.5)
+    elif "HT" in mods_dict:
+        magnitude = mods_dict["HT"].get("speed_change", 0.75)
+    elif "DC" in mods_dict:
+        magnitude = mods_dict["DC"].get("speed_change", 0.75)
+    elif "WU" in mods_dict:
+        magnitude = 2.0 / (mods_dict["WU"].get("initial_rate", 1.0) + mods_dict["WU"].get("final_rate", 1.5))
+    elif "WD" in mods_dict:
+        magnitude = 2.0 / (mods_dict["WD"].get("initial_rate", 1.0) + mods_dict["WD"].get("final_rate", 0.75))
+    return float("NF" in mods_dict), float("HD" in mods_dict), float(difficulty_mod), da_cs, da_accuracy, da_ar, magnitude
+
+
+def encode_mods(mods: Iterable[list[dict[str, Any]]], ruleset_ids: Optional[Iterable[int]] = None) -> np.ndarray:
+    """把一批成绩的 mods 编码为 mod 矩阵，供 calc_mod_adjusted_attributes 使用
+
+    相同的 mods 只解析一次
+
+    :param mods: 每个成绩的标准 mods 列表
+    :param ruleset_ids: 每个成绩的 ruleset，默认均为 0（与 SimpleDifficultyAttribute 的默认值一致）
+    :return: 形状为 (n, len(MOD_MATRIX_COLUMNS)) 的 float64 矩阵
+    """
+    mods = list(mods)
+    ruleset_ids = [0] * len(mods) if ruleset_ids is None else list(ruleset_ids)
+    rows = [_encode_frozen_mods(freeze_mods(score_mods), ruleset_id) for score_mods, ruleset_id in zip(mods, ruleset_ids, strict=True)]
+    return np.array(rows, dtype=np.float64).reshape(len(rows), len(MOD_MATRIX_COLUMNS))
+
+
+def calc_mod_adjusted_attributes(cs: np.ndarray, accuracy: np.ndarray, ar: np.ndarray, bpm: np.ndarray, hit_length: np.ndarray, mod_matrix: np.ndarray) -> dict[str, np.ndarray]:
+    """SimpleDifficultyAttribute.set_mods 的批量版本，一次计算所有成绩经过 mods 调整后的属性
+
+    与逐个调用 set_mods 的结果逐位一致
+
+    :param cs: 谱面原始的 CS
+    :param accuracy: 谱面原始的 OD
+    :param ar: 谱面原始的 AR
+    :param bpm: 谱面原始的 BPM
+    :param hit_length: 谱面原始的长度（秒）
+    :param mod_matrix: encode_mods 的结果
+    :return: 列名到数组的映射，列名与 SimpleDifficultyAttribute 的属性一致
+    """
+    cs, accuracy, ar, bpm = (np.asarray(x, dtype=np.float64) for x in (cs, accuracy, ar, bpm))
+    hit_length = np.asarray(hit_length, dtype=np.float64)
+    is_nf, is_hd, difficulty_mod, da_cs, da_accuracy, da_ar, magnitude = mod_matrix.T
+
+    is_hr = difficulty_mod == _DIFFICULTY_MOD_HR
+    is_ez = difficulty_mod == _DIFFICULTY_MOD_EZ
+    is_da = difficulty_mod == _DIFFICULTY_MOD_DA
+    cs = np.select([is_hr, is_ez, is_da & ~np.isnan(da_cs)], [np.minimum(cs * 1.3, 10.0), cs * 0.5, da_cs], cs)
+    accuracy = np.select([is_hr, is_ez, is_da & ~np.isnan(da_accuracy)], [np.minimum(accuracy * 1.4, 10.0), accuracy * 0.5, da_accuracy], accuracy)
+    ar = np.select([is_hr, is_ez, is_da & ~np.isnan(da_ar)], [np.minimum(ar * 1.4, 10.0), ar * 0.5, da_ar], ar)
+
+    # 以下与 calc_hit_window、calc_accuracy、calc_preempt、calc_ar 的运算顺序相同，保证结果逐位一致
+    hit_window = (80.0 - 6.0 * accuracy) / magnitude
+    accuracy = (80.0 - hit_window) / 6.0
+    preempt = np.where(ar < 5.0, 1200.0 + 600.0 * (5.0 - ar) / 5.0, 1200.0 - 750 * (ar - 5.0) / 5.0) / magnitude
+    ar = np.where(preempt > 1200.0, 5.0 - (preempt - 1200.0) / 600 * 5.0, 5.0 + (1200.0 - preempt) / 750 * 5.0)
+    is_high_ar = preempt <= 450.0
+    is_low_ar = ~is_high_ar & (preempt >= 675.0) & (preempt < 900.0)
+    is_very_low_ar = ~is_high_ar & (preempt >= 900.0)
+    return {
+        "cs": cs,
+        "accuracy": accuracy,
+        "hit_window": hit_window,
+        "ar": ar,
+        "preempt": preempt,
+        "bpm": bpm * magnitude,
+        # np.round 与 round 一样四舍六入五成双
+        "hit_length": np.round(hit_length / magnitude).astype(np.int64),
+        "magnitude": magnitude,
+        "is_nf": is_nf.astype(bool),
+        "is_hd": is_hd.astype(bool),
+        "is_high_ar": is_high_ar,
+        "is_low_ar": is_low_ar,
+        "is_very_low_ar": is_very_low_ar,
+        "is_speed_up": magnitude > 1.0,
+        "is_speed_down": magnitude < 1.0,
+    }
+
+
+# SimpleDifficultyAttribute 中经过 mods 调整并保存在 SCORE 表中的字段
+MOD_ADJUSTED_FIELDS = ["cs", "hit_window", "preempt", "bpm", "hit_length", "is_nf", "is_hd", "is_high_ar", "is_low_ar", "is_very_low_ar", "is_speed_up", "is_speed_down"]
+
+
+def recalc_mod_adjusted_columns(df: pd.DataFrame, beatmaps: Mapping[int, Beatmap]) -> np.ndarray:
+    """按谱面的原始属性与成绩的 mods 批量重新计算 MOD_ADJUSTED_FIELDS，用于重新分析已经保存的成绩
+
+    与保存成绩时（ScoreCalculation.prepare）一样以 ruleset 0 解析 mods
+
+    :param df: 成绩 DataFrame，例如 scores_table_to_dataframe 的结果，会被原地修改
+    :param beatmaps: bid 到谱面的映射，不在其中的成绩（例如谱面已被删除）保留原值
+    :return: 长度为 len(df) 的布尔数组，表示哪些行的值发生了变化（浮点数按相对误差 1e-6 比较，以兼容以单精度保存 REAL 的数据库）
+    """
+    has_beatmap = df["bid"].isin(list(beatmaps)).to_numpy()
+    changed = np.zeros(len(df), dtype=bool)
+    if not has_beatmap.any():
+        return changed
+    base = [beatmaps[bid] for bid in df.loc[has_beatmap, "bid"]]
+    adjusted = calc_mod_adjusted_attributes(
+        np.array([b.cs for b in base], dtype=np.float64),
+        np.array([b.accuracy for b in base], dtype=np.float64),
+        np.array([b.ar for b in base], dtype=np.float64),
+        np.array([b.bpm or 0 for b in base], dtype=np.float64),
+        np.array([b.hit_length for b in base], dtype=np.float64),
+        encode_mods(df.loc[has_beatmap, "_mods"]),
+    )
+    for name in MOD_ADJUSTED_FIELDS:
+        new = adjusted[name]
+        if new.dtype == np.bool_:
+            changed[has_beatmap] |= df.loc[has_beatmap, name].to_numpy(dtype=bool) != new
+        else:
+            old = pd.to_numeric(df.loc[has_beatmap, name], errors="coerce").to_numpy(dtype=np.float64)
+            changed[has_beatmap] |= ~np.isclose(old, new, rtol=1e-6, atol=0.0)
+        df.loc[has_beatmap, name] = new
+    return changed
+
+
 class ScoreStatistics(TypedDict):
     miss: int
     meh: int
@@ -629,6 +869,206 @@ class ExtendedSimpleScoreInfo(CompletedSimpleScoreInfo):
     score_nf: int
     mods: str
     only_common_mods: bool
+    mods_mask: int
+
+
+# SCORE 表中依次与 score_id 和 CompletedSimpleScoreInfo 的字段对应的列
+SCORE_TABLE_COLUMNS = ["SCORE_ID", *("USER_ID" if f.name == "user" else f.name.lstrip("_").upper() for f in fields(CompletedSimpleScoreInfo))]
+_SCORE_TABLE_BOOL_COLUMNS = [f.name for f in fields(CompletedSimpleScoreInfo) if f.type is bool]
+# score_table_row 中需要转换的字段在 CompletedSimpleScoreInfo 中的位置
+_get_score_table_values = attrgetter(*(f.name for f in fields(CompletedSimpleScoreInfo)))
+_SCORE_TABLE_BOOL_INDEXES = [i for i, f in enumerate(fields(CompletedSimpleScoreInfo)) if f.type is bool]
+_SCORE_TABLE_DATETIME_INDEXES = [i for i, f in enumerate(fields(CompletedSimpleScoreInfo)) if datetime in (f.type, *get_args(f.type))]
+_SCORE_TABLE_JSON_INDEXES = [i for i, f in enumerate(fields(CompletedSimpleScoreInfo)) if get_origin(f.type) is list or typing_extensions.is_typeddict(f.type)]
+# ExtendedSimpleScoreInfo 中在入库时计算并保存到 SCORE 表的字段（time 与显示的时区有关，mods_mask 与 mod 表有关，仍在读取时计算）
+SCORE_DERIVED_FIELDS = [f.name for f in fields(ExtendedSimpleScoreInfo) if f.name not in {g.name for g in fields(CompletedSimpleScoreInfo)} | {"time", "mods_mask"}]
+# SCORE 表中依次与 SCORE_DERIVED_FIELDS 对应的列（mods 已被占用，改称 READABLE_MODS），最后一列记录计算时的 SCORE_DERIVED_VERSION，为 NULL 表示尚未计算
+SCORE_DERIVED_COLUMNS = [*("READABLE_MODS" if name == "mods" else name.upper() for name in SCORE_DERIVED_FIELDS), "DERIVED_VERSION"]
+# 派生字段的计算方式改变时递增，较低版本的行需要重新计算
+SCORE_DERIVED_VERSION = 1
+# 旧版本保存的成绩可能没有 statistics
+_EMPTY_SCORE_STATISTICS = orjson.dumps(
+    ScoreStatistics(
+        miss=0,
+        meh=0,
+        ok=0,
+        good=0,
+        great=0,
+        perfect=None,
+        small_tick_hit=None,
+        large_tick_hit=None,
+        small_bonus=None,
+        large_bonus=None,
+        ignore_miss=None,
+        ignore_hit=None,
+        combo_break=None,
+        slider_tail_hit=None,
+    ),
+).decode("utf-8")
+
+
+def _loads_json_column(values: pd.Series, default: str) -> list[Any]:
+    # 拼接成一个 JSON 数组后一次解析，比逐行 orjson.loads 快得多
+    return orjson.loads("[%s]" % ",".join(values.fillna(default)))
+
+
+def _loads_shared_json_column(values: pd.Series, default: str) -> list[Any]:
+    # 用于重复很多的列：只解析不同的值，相同的值共享同一个对象，不能原地修改
+    codes, uniques = pd.factorize(values.fillna(default))
+    decoded = orjson.loads("[%s]" % ",".join(uniques))
+    return [decoded[code] for code in codes.tolist()]
+
+
+def _timestamps_to_datetimes(values: pd.Series) -> pd.Series:
+    # 与 datetime.fromtimestamp(x).astimezone(timezone.utc) 的结果一致：整数秒向零截断，小数部分四舍六入五成双到微秒
+    ts = values.to_numpy(dtype=np.float64, na_value=np.nan)
+    nat = np.isnan(ts)
+    seconds = np.trunc(np.where(nat, 0.0, ts))
+    microseconds = seconds.astype(np.int64) * 1000000 + np.round((np.where(nat, 0.0, ts) - seconds) * 1e6).astype(np.int64)
+    datetimes = microseconds.astype("datetime64[us]")
+    datetimes[nat] = np.datetime64("NaT", "us")
+    return pd.Series(datetimes, index=values.index).dt.tz_localize(timezone.utc)
+
+
+def scores_table_to_dataframe(table: pd.DataFrame) -> pd.DataFrame:
+    """把按 SCORE_TABLE_COLUMNS（可以再接上 SCORE_DERIVED_COLUMNS）从 SCORE 表中查询出的列转换为成绩 DataFrame
+
+    结果与 ``Osuawa.create_scores_dataframe`` 由 CompletedSimpleScoreInfo 构造的基础 DataFrame 相同，但不需要逐行构造 dataclass。
+    所有行的派生字段都已按当前的 SCORE_DERIVED_VERSION 计算时，还会包含 SCORE_DERIVED_FIELDS，``Osuawa.extend_scores_dataframe`` 不再重新计算
+
+    :param table: SCORE 表中的列，列的顺序与 SCORE_TABLE_COLUMNS（和 SCORE_DERIVED_COLUMNS）一致，列名不限
+    :return: 列为 score_id 与 CompletedSimpleScoreInfo 的字段（和 SCORE_DERIVED_FIELDS）的 DataFrame
+    """
+    df = table.iloc[:, : len(SCORE_TABLE_COLUMNS)].set_axis(["score_id", *(f.name for f in fields(CompletedSimpleScoreInfo))], axis=1).reset_index(drop=True)
+    df["score_id"] = df["score_id"].astype(str)
+    for column in _SCORE_TABLE_BOOL_COLUMNS:
+        df[column] = df[column].fillna(0).astype(bool)
+    df["_mods"] = _loads_shared_json_column(df["_mods"], "[]")
+    df["statistics"] = _loads_json_column(df["statistics"], _EMPTY_SCORE_STATISTICS)
+    df["ts"] = _timestamps_to_datetimes(df["ts"])
+    df["st"] = _timestamps_to_datetimes(df["st"])
+    if table.shape[1] > len(SCORE_TABLE_COLUMNS):
+        derived = table.iloc[:, len(SCORE_TABLE_COLUMNS) :].set_axis([*SCORE_DERIVED_FIELDS, "derived_version"], axis=1).reset_index(drop=True)
+        # 回填完成之前混有未计算的行，此时全部重新计算
+        if (derived["derived_version"] == SCORE_DERIVED_VERSION).all():
+            for name in SCORE_DERIVED_FIELDS:
+                df[name] = derived[name]
+            df["only_common_mods"] = df["only_common_mods"].fillna(0).astype(bool)
+    return df
+
+
+def score_table_row(score_id: int | str, score: CompletedSimpleScoreInfo) -> tuple[Any, ...]:
+    """把成绩转换为 SCORE 表中按 SCORE_TABLE_COLUMNS 排列的一行，是 scores_table_to_dataframe 的逆过程
+
+    bool 保存为整数，时间保存为时间戳，mods 与 statistics 保存为 JSON 文本
+    """
+    values = list(_get_score_table_values(score))
+    for i in _SCORE_TABLE_BOOL_INDEXES:
+        if values[i] is not None:
+            values[i] = int(values[i])
+    for i in _SCORE_TABLE_DATETIME_INDEXES:
+        if values[i] is not None:
+            values[i] = values[i].timestamp()
+    for i in _SCORE_TABLE_JSON_INDEXES:
+        if values[i] is not None:
+            values[i] = orjson.dumps(values[i]).decode()
+    return int(score_id), *values
+
+
+def _factorize_mods(mods: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    # 按对象对标准 mods 列表编号，返回 (每行的编号, 每个编号第一次出现的位置)
+    # 从 SCORE 表读取的相同 mods 共享同一个对象，由 dataclass 构造时每行各自编号，结果都是正确的
+    codes, _ = pd.factorize(mods.map(id))
+    _, first = np.unique(codes, return_index=True)
+    return codes, first
+
+
+def calc_score_derived_columns(df: pd.DataFrame, common_mods: Iterable[str]) -> pd.DataFrame:
+    """计算 SCORE_DERIVED_FIELDS，入库时与读取旧数据时共用
+
+    除零得到的无穷大记为缺失值
+
+    :param df: 列为 CompletedSimpleScoreInfo 的字段的 DataFrame
+    :param common_mods: 常见 mods 的缩写
+    :return: 与 df 的索引相同、列为 SCORE_DERIVED_FIELDS 的 DataFrame
+    """
+    common_mods = frozenset(common_mods)
+    derived = pd.DataFrame(index=df.index)
+    derived["pp_pct"] = df["pp"] / df["b_pp_100if"]
+    derived["pp_aim_pct"] = df["pp_aim"] / df["b_pp_100if_aim"]
+    derived["pp_speed_pct"] = df["pp_speed"] / df["b_pp_100if_speed"]
+    derived["pp_accuracy_pct"] = df["pp_accuracy"] / df["b_pp_100if_accuracy"]
+    derived["pp_92pct"] = df["pp"] / df["b_pp_92if"]
+    derived["pp_81pct"] = df["pp"] / df["b_pp_81if"]
+    derived["pp_67pct"] = df["pp"] / df["b_pp_67if"]
+    derived["combo_pct"] = df["max_combo"] / df["b_max_combo"]
+    derived["density"] = (df["b_max_combo"] / df["hit_length"]).replace([np.inf, -np.inf], np.nan)
+    derived["aim_density_ratio"] = df["b_aim_difficulty"] / np.log1p(derived["density"])
+    derived["speed_density_ratio"] = df["b_speed_difficulty"] / np.log1p(derived["density"])
+    derived["aim_speed_ratio"] = df["b_aim_difficulty"] / df["b_speed_difficulty"]
+    ratios = SCORE_DERIVED_FIELDS[: SCORE_DERIVED_FIELDS.index("score_nf")]
+    derived[ratios] = derived[ratios].replace([np.inf, -np.inf], np.nan)
+    derived["score_nf"] = np.where(df["is_nf"], df["score"] * 2, df["score"])
+    # 不同的 mods 组合很少，每种组合只转换一次
+    codes, first = _factorize_mods(df["_mods"])
+    unique_mods = [df["_mods"].iat[i] for i in first]
+    derived["mods"] = np.array(["; ".join(to_readable_mods(mods)) for mods in unique_mods], dtype=object)[codes]
+    derived["only_common_mods"] = np.array([{m["acronym"] for m in mods} <= common_mods for mods in unique_mods], dtype=bool)[codes]
+    return derived[SCORE_DERIVED_FIELDS]
+
+
+class ModCombination(NamedTuple):
+    """成绩中的一种 mods 组合，设置只在这里保存一份"""
+
+    ruleset_id: int
+    mods: str  # 可读的 mods，与 ruleset_id 一起唯一确定组合
+    acronyms: frozenset[str]
+    mods_mask: int
+    settings: list[dict[str, Any]]  # 标准 mods 列表
+
+
+def encode_mod_combinations(df: pd.DataFrame) -> tuple[np.ndarray, list[ModCombination]]:
+    """对成绩中不同的 mods 组合编号
+
+    :param df: 包含 ruleset_id、_mods 与 mods（可读的 mods，可以是 category 类型）列的 DataFrame
+    :return: (每个成绩的组合编号, 按编号排列的组合)
+    """
+    readable_codes, _ = pd.factorize(df["mods"])
+    ruleset_ids = df["ruleset_id"].to_numpy(dtype=np.int64)
+    codes, _ = pd.factorize(readable_codes.astype(np.int64) * 4 + ruleset_ids)
+    _, first = np.unique(codes, return_index=True)
+    combinations = []
+    for i in first.tolist():
+        settings = df["_mods"].iat[i]
+        acronyms = frozenset(m["acronym"] for m in settings)
+        combinations.append(ModCombination(int(ruleset_ids[i]), df["mods"].iat[i], acronyms, calc_mods_mask(acronyms, int(ruleset_ids[i])), settings))
+    return codes, combinations
+
+
+def filter_mods(data: pd.DataFrame, required: Iterable[str] = (), excluded: Iterable[str] = ()) -> pd.Series:
+    """按 mods 的缩写筛选成绩，在 mods_mask 列上向量化计算
+
+    :param data: 包含 ruleset_id 与 mods_mask 列的 DataFrame
+    :param required: 必须全部包含的 mods 的缩写
+    :param excluded: 不能包含的 mods 的缩写
+    :return: 与 data 的索引相同的布尔 Series
+    """
+    required = list(required)
+    excluded = list(excluded)
+    ruleset_ids = data["ruleset_id"].to_numpy(dtype=np.int64)
+    masks = data["mods_mask"].to_numpy(dtype=np.uint64)
+    result = np.ones(len(data), dtype=bool)
+    for ruleset_id in np.unique(ruleset_ids).tolist():
+        rows = ruleset_ids == ruleset_id
+        bits = get_mod_bits(ruleset_id)
+        # ruleset 中不存在的 mod 不可能被包含，也不必排除
+        if any(acronym not in bits for acronym in required):
+            result[rows] = False
+            continue
+        required_mask = np.uint64(calc_mods_mask(required, ruleset_id))
+        excluded_mask = np.uint64(calc_mods_mask([acronym for acronym in excluded if acronym in bits], ruleset_id))
+        result[rows] = ((masks[rows] & required_mask) == required_mask) & ((masks[rows] & excluded_mask) == 0)
+    return pd.Series(result, index=data.index)
 
 
 # noinspection PyTypedDict
@@ -738,152 +1178,437 @@ def push_task(r: Redis, task_command: str) -> RedisTaskId:
     return RedisTaskId(task_id)
 
 
-def download_osu(beatmap: Beatmap):
-    need_download = False
-    if not os.path.exists(os.path.join(C.BEATMAPS_CACHE_DIRECTORY.value, "%s.osu" % beatmap.id)):
-        need_download = True
-    else:
-        with open(os.path.join(C.BEATMAPS_CACHE_DIRECTORY.value, "%s.osu" % beatmap.id), "rb") as fi_b:
-            if beatmap.checksum != md5sum(fi_b.read()):
-                need_download = True
-    if need_download:
-        with sem:
-            sleep(1)
-            Downloader(C.BEATMAPS_CACHE_DIRECTORY.value).start("https://osu.ppy.sh/osu/%d" % beatmap.id, "%s.osu" % beatmap.id, headers)
-            sleep(0.5)
+def download_osu(beatmap: Beatmap) -> str:
+    """确保谱面的 .osu 文件存在且有效，必要时下载，供线程中的同步代码使用，异步代码应直接使用 BeatmapFileFetcher.fetch
 
+    :param beatmap: 谱面
+    :return: .osu 文件路径
+    """
+    # beatmapfiles 依赖 utils，在这里导入以避免循环导入
+    from .beatmapfiles import BeatmapFileFetcher
 
-def calc_beatmap_attributes(beatmap: Beatmap, score: SimpleScoreInfo) -> CompletedSimpleScoreInfo:
-    """完整计算所需属性，这会覆盖 score 原本的 pp"""
-    ruleset_id = score.ruleset_id
-    my_attr = SimpleDifficultyAttribute(beatmap.cs, beatmap.accuracy, beatmap.ar, beatmap.bpm or 0, beatmap.hit_length)
-    my_attr.set_mods(score._mods)
-    download_osu(beatmap)
-    match ruleset_id:
-        case 0:
-            ruleset = OsuRuleset()
-            performance = OsuPerformance(
-                combo=score.max_combo,
-                misses=score.statistics["miss"],
-                mehs=score.statistics["meh"],
-                oks=score.statistics["ok"],
-                large_tick_hits=score.statistics["large_tick_hit"],
-                slider_tail_hits=score.statistics["slider_tail_hit"],
-            )
-            performance_type = OsuPerformance
-        case 1:
-            ruleset = TaikoRuleset()
-            performance = TaikoPerformance(
-                combo=score.max_combo,
-                misses=score.statistics["miss"],
-                oks=score.statistics["ok"],
-            )
-            performance_type = TaikoPerformance
-        case 2:
-            ruleset = CatchRuleset()
-            performance = CatchPerformance(
-                combo=score.max_combo,
-                misses=score.statistics["miss"],
-                small_tick_hits=score.statistics["small_tick_hit"],
-                large_tick_hits=score.statistics["large_tick_hit"],
-            )
-            performance_type = CatchPerformance
-        case 3:
-            ruleset = ManiaRuleset()
-            performance = ManiaPerformance(
-                misses=score.statistics["miss"],
-                mehs=score.statistics["meh"],
-                oks=score.statistics["ok"],
-                goods=score.statistics["good"],
-                greats=score.statistics["great"],
-            )
-            performance_type = ManiaPerformance
-        case _:
-            raise ValueError("ruleset_id %d not supported" % ruleset_id)
+    return BeatmapFileFetcher.get_default().fetch_sync(beatmap)
+
+
+def get_beatmap_path(bid: int) -> str:
+    """获取已下载的 .osu 文件可以交给 osu-tools 的路径，不进行校验
+
+    :param bid: 谱面 id
+    :return: .osu 文件路径
+    """
+    # beatmapfiles 依赖 utils，在这里导入以避免循环导入
+    from .beatmapfiles import BeatmapFileFetcher
+
+    return BeatmapFileFetcher.get_default().path(bid)
+
+
+def prefetch_osu(beatmaps: Iterable[Beatmap]) -> None:
+    """在计算之前并发下载一批谱面的 .osu 文件，供线程中的同步代码使用，异步代码应直接使用 BeatmapFileFetcher.prefetch
+
+    :param beatmaps: 谱面
+    """
+    # beatmapfiles 依赖 utils，在这里导入以避免循环导入
+    from .beatmapfiles import BeatmapFileFetcher
+
+    BeatmapFileFetcher.get_default().prefetch_sync(beatmaps)
+
+
+@cache
+def get_attribute_store() -> AttributeStore:
+    return AttributeStore(os.path.join(C.CACHE_DIRECTORY.value, "attributes.sqlite3"))
+
+
+def beatmap_attribute_key(beatmap: Beatmap, ruleset_id: int, mods: list[str], mod_options: list[str]) -> AttributeKey:
+    """谱面在属性存储中的键，谱面没有 checksum 时使用本地 .osu 文件的 md5（为此需要先下载）"""
+    checksum = beatmap.checksum
+    if checksum is None:
+        # beatmapfiles 依赖 utils，在这里导入以避免循环导入
+        from .beatmapfiles import BeatmapFileFetcher
+
+        fetcher = BeatmapFileFetcher.get_default()
+        fetcher.fetch_sync(beatmap)
+        checksum = fetcher.checksum(beatmap.id)
+    return make_attribute_key(checksum, ruleset_id, mods, mod_options)
+
+
+def _difficulty_attributes(osupp_attr: dict[str, Any]) -> dict[str, Any]:
+    # 以 __ 开头的是 strain 序列等附加数据，不与难度属性放在一起
+    return {k: v for k, v in osupp_attr.items() if not k.startswith("__")}
+
+
+def _performance_attributes(perf_attr: dict[str, Any]) -> dict[str, Any]:
+    return {k: perf_attr[k] for k in ("pp", "aim", "speed", "accuracy")}
+
+
+def get_difficulty_attributes(beatmap: Beatmap, mods: list[str], mod_options: list[str]) -> dict[str, Any]:
+    """读取谱面（不转谱）的难度属性，未命中时计算并写入属性存储
+
+    :param beatmap: 谱面
+    :param mods: osu-tools 所能接受的 mods
+    :param mod_options: osu-tools 所能接受的 mod options
+    :return: 难度属性
+    """
+    store = get_attribute_store()
+    key = beatmap_attribute_key(beatmap, beatmap.mode_int, mods, mod_options)
+    osupp_attr = store.get(key)
+    if osupp_attr is None:
+        osupp_attr = _difficulty_attributes(calculate_difficulty(beatmap_path=download_osu(beatmap), mods=mods, mod_options=mod_options))
+        store.put(key, osupp_attr, beatmap.id)
+    return osupp_attr
+
+
+# ruleset_id -> (ruleset, 表现计算参数)
+RULESET_CALCULATORS: dict[int, tuple[type, type]] = {
+    0: (OsuRuleset, OsuPerformance),
+    1: (TaikoRuleset, TaikoPerformance),
+    2: (CatchRuleset, CatchPerformance),
+    3: (ManiaRuleset, ManiaPerformance),
+}
+
+
+class PerformanceJob(NamedTuple):
+    """一次 osu-tools 计算的输入，只包含可以序列化的数据，以便交给计算进程池"""
+
+    beatmap_path: str
+    ruleset_id: int
+    mods: list[str]
+    mod_options: list[str]
+    performances: list[dict[str, int]]  # 需要计算 pp 的判定统计
+    with_beatmap_attributes: bool  # 是否需要计算难度属性与 if pp
+    with_pp_curve: bool = False  # 是否需要采样 pp 曲线，需要 len(PP_CURVE_MISSES) * len(PP_CURVE_ACCURACIES) 次 pp 计算，只在补全曲线时使用，不在保存成绩时使用
+
+
+class PerformanceResult(NamedTuple):
+    beatmap_attributes: Optional[dict[str, Any]]
+    performances: list[dict[str, Any]]
+    pp_curve: Optional[np.ndarray] = None  # 形状为 (len(PP_CURVE_MISSES), len(PP_CURVE_ACCURACIES))
+
+
+# pp 曲线的采样点：准确率（%）与 miss 数，必须单调递增
+PP_CURVE_ACCURACIES = np.array([60.0, 67.0, 75.0, 81.0, 85.0, 88.0, 90.0, 92.0, 94.0, 95.0, 96.0, 97.0, 98.0, 99.0, 99.5, 100.0])
+PP_CURVE_MISSES = np.array([0, 1, 2, 5, 10, 25])
+
+
+def run_performance_job(job: PerformanceJob, ruleset: Any = None) -> PerformanceResult:
+    """执行一次 osu-tools 计算
+
+    :param job: 计算的输入，谱面文件需要事先下载
+    :param ruleset: 复用的 ruleset 实例，为 None 时新建
+    :return: 难度属性与 if pp（仅当 job.with_beatmap_attributes 时），与 job.performances 一一对应的表现属性，以及 pp 曲线（仅当 job.with_pp_curve 时）
+    """
+    try:
+        ruleset_type, performance_type = RULESET_CALCULATORS[job.ruleset_id]
+    except KeyError:
+        raise ValueError("ruleset_id %d not supported" % job.ruleset_id) from None
     calculator = calculate_performance(
-        beatmap_path=os.path.join(C.BEATMAPS_CACHE_DIRECTORY.value, "%s.osu" % beatmap.id),
-        ruleset=ruleset,
-        mods=my_attr.osu_tool_mods,
-        mod_options=my_attr.osu_tool_mod_options,
+        beatmap_path=job.beatmap_path,
+        ruleset=ruleset_type() if ruleset is None else ruleset,
+        mods=job.mods,
+        mod_options=job.mod_options,
         # todo: 这里是否要不限制超时？
         allow_cancel=False,
     )
     osupp_attr = next(calculator)
-    perf_got_attr = calculator.send(performance)
-    # noinspection PyArgumentList
-    perf100_attr = calculator.send(performance_type())
-    # noinspection PyArgumentList
-    pp92 = calculator.send(performance_type(accuracy_percent=92.0))["pp"]
-    # noinspection PyArgumentList
-    pp81 = calculator.send(performance_type(accuracy_percent=81.0))["pp"]
-    # noinspection PyArgumentList
-    pp67 = calculator.send(performance_type(accuracy_percent=67.0))["pp"]
-    pp_got = perf_got_attr["pp"]
-    pp_got_aim = perf_got_attr["aim"]
-    pp_got_speed = perf_got_attr["speed"]
-    pp_got_accuracy = perf_got_attr["accuracy"]
-    pp100 = perf100_attr["pp"]
-    pp100_aim = perf100_attr["aim"]
-    pp100_speed = perf100_attr["speed"]
-    pp100_accuracy = perf100_attr["accuracy"]
-
-    return CompletedSimpleScoreInfo(
-        # 父类字段，除了 pp 全部照抄
-        score.bid,
-        score.user,
-        score.score,
-        score.accuracy,
-        score.max_combo,
-        score.passed,
-        pp_got,  # 使用本地计算的 pp
-        score._mods,
-        score.ts,
-        score.statistics,
-        score.st,
-        score.ruleset_id,
-        # 追加字段
-        my_attr.cs,
-        my_attr.hit_window,
-        my_attr.preempt,
-        my_attr.bpm,
-        my_attr.hit_length,
-        my_attr.is_nf,
-        my_attr.is_hd,
-        my_attr.is_high_ar,
-        my_attr.is_low_ar,
-        my_attr.is_very_low_ar,
-        my_attr.is_speed_up,
-        my_attr.is_speed_down,
-        "%s - %s (%s) [%s]"
-        % (
-            beatmap.beatmapset().artist,
-            beatmap.beatmapset().title,
-            beatmap.beatmapset().creator,
-            beatmap.version,
-        ),
-        beatmap.difficulty_rating,
-        osupp_attr["star_rating"],
-        osupp_attr["max_combo"],
-        osupp_attr["aim_difficulty"],
-        osupp_attr["aim_difficult_slider_count"],
-        osupp_attr["speed_difficulty"],
-        osupp_attr["speed_note_count"],
-        osupp_attr["slider_factor"],
-        osupp_attr["aim_top_weighted_slider_factor"],
-        osupp_attr["speed_top_weighted_slider_factor"],
-        osupp_attr["aim_difficult_strain_count"],
-        osupp_attr["speed_difficult_strain_count"],
-        pp_got_aim,
-        pp_got_speed,
-        pp_got_accuracy,
-        pp100_aim,
-        pp100_speed,
-        pp100_accuracy,
-        pp100,
-        pp92,
-        pp81,
-        pp67,
-    )
+    performances = [_performance_attributes(calculator.send(performance_type(**performance))) for performance in job.performances]
+    beatmap_attr = None
+    if job.with_beatmap_attributes:
+        # noinspection PyArgumentList
+        beatmap_attr = {
+            **_difficulty_attributes(osupp_attr),
+            "pp100": _performance_attributes(calculator.send(performance_type())),
+            "pp92": calculator.send(performance_type(accuracy_percent=92.0))["pp"],
+            "pp81": calculator.send(performance_type(accuracy_percent=81.0))["pp"],
+            "pp67": calculator.send(performance_type(accuracy_percent=67.0))["pp"],
+        }
+    pp_curve = None
+    if job.with_pp_curve:
+        # 在准确率与 miss 数的网格上采样 pp 曲线，miss 数不超过谱面的 max combo
+        max_misses = osupp_attr["max_combo"]
+        # noinspection PyArgumentList
+        pp_curve = np.array(
+            [[calculator.send(performance_type(accuracy_percent=float(accuracy), misses=int(min(misses, max_misses))))["pp"] for accuracy in PP_CURVE_ACCURACIES] for misses in PP_CURVE_MISSES],
+        )
+    return PerformanceResult(beatmap_attr, performances, pp_curve)
+
+
+def _performance_kwargs(score: SimpleScoreInfo) -> dict[str, int]:
+    match score.ruleset_id:
+        case 0:
+            return {
+                "combo": score.max_combo,
+                "misses": score.statistics["miss"],
+                "mehs": score.statistics["meh"],
+                "oks": score.statistics["ok"],
+                "large_tick_hits": score.statistics["large_tick_hit"],
+                "slider_tail_hits": score.statistics["slider_tail_hit"],
+            }
+        case 1:
+            return {
+                "combo": score.max_combo,
+                "misses": score.statistics["miss"],
+                "oks": score.statistics["ok"],
+            }
+        case 2:
+            return {
+                "combo": score.max_combo,
+                "misses": score.statistics["miss"],
+                "small_tick_hits": score.statistics["small_tick_hit"],
+                "large_tick_hits": score.statistics["large_tick_hit"],
+            }
+        case 3:
+            return {
+                "misses": score.statistics["miss"],
+                "mehs": score.statistics["meh"],
+                "oks": score.statistics["ok"],
+                "goods": score.statistics["good"],
+                "greats": score.statistics["great"],
+            }
+        case _:
+            raise ValueError("ruleset_id %d not supported" % score.ruleset_id)
+
+
+@dataclass(slots=True)
+class ScoreCalculation(object):
+    """
+    calc_beatmap_attributes 的拆分形式
+
+    prepare 查询属性存储中谱面的属性；成绩由 group_score_calculations 按谱面分组，交给 osu-tools（本进程或计算进程池）计算，由 apply_calculation_result 写回；最后由 complete 组装结果
+    """
+
+    beatmap: Beatmap
+    score: SimpleScoreInfo
+    my_attr: SimpleDifficultyAttribute
+    key: AttributeKey
+    performance: dict[str, int]
+    beatmap_attr: Optional[dict[str, Any]]
+    perf_got_attr: Optional[dict[str, Any]]  # 成绩的 pp，由 apply_calculation_result 补全
+
+    @classmethod
+    def prepare(cls, beatmap: Beatmap, score: SimpleScoreInfo):
+        my_attr = SimpleDifficultyAttribute(beatmap.cs, beatmap.accuracy, beatmap.ar, beatmap.bpm or 0, beatmap.hit_length)
+        my_attr.set_mods(score._mods)
+        performance = _performance_kwargs(score)
+        store = get_attribute_store()
+        key = beatmap_attribute_key(beatmap, score.ruleset_id, my_attr.osu_tool_mods, my_attr.osu_tool_mod_options)
+        beatmap_attr = store.get(key)
+        if beatmap_attr is not None and "pp100" not in beatmap_attr:
+            # 只有难度属性（由 beatmap_task 写入），还需要计算 if pp
+            beatmap_attr = None
+        return cls(beatmap, score, my_attr, key, performance, beatmap_attr, None)
+
+    def complete(self) -> CompletedSimpleScoreInfo:
+        """组装结果，这会覆盖 score 原本的 pp，需要事先通过 apply_calculation_result 补全成绩的 pp 与未命中的属性"""
+        score, my_attr, beatmap, beatmap_attr, perf_got_attr = self.score, self.my_attr, self.beatmap, self.beatmap_attr, self.perf_got_attr
+        return CompletedSimpleScoreInfo(
+            # 父类字段，除了 pp 全部照抄
+            score.bid,
+            score.user,
+            score.score,
+            score.accuracy,
+            score.max_combo,
+            score.passed,
+            perf_got_attr["pp"],  # 使用本地计算的 pp
+            score._mods,
+            score.ts,
+            score.statistics,
+            score.st,
+            score.ruleset_id,
+            # 追加字段
+            my_attr.cs,
+            my_attr.hit_window,
+            my_attr.preempt,
+            my_attr.bpm,
+            my_attr.hit_length,
+            my_attr.is_nf,
+            my_attr.is_hd,
+            my_attr.is_high_ar,
+            my_attr.is_low_ar,
+            my_attr.is_very_low_ar,
+            my_attr.is_speed_up,
+            my_attr.is_speed_down,
+            "%s - %s (%s) [%s]"
+            % (
+                beatmap.beatmapset().artist,
+                beatmap.beatmapset().title,
+                beatmap.beatmapset().creator,
+                beatmap.version,
+            ),
+            beatmap.difficulty_rating,
+            beatmap_attr["star_rating"],
+            beatmap_attr["max_combo"],
+            beatmap_attr["aim_difficulty"],
+            beatmap_attr["aim_difficult_slider_count"],
+            beatmap_attr["speed_difficulty"],
+            beatmap_attr["speed_note_count"],
+            beatmap_attr["slider_factor"],
+            beatmap_attr["aim_top_weighted_slider_factor"],
+            beatmap_attr["speed_top_weighted_slider_factor"],
+            beatmap_attr["aim_difficult_strain_count"],
+            beatmap_attr["speed_difficult_strain_count"],
+            perf_got_attr["aim"],
+            perf_got_attr["speed"],
+            perf_got_attr["accuracy"],
+            beatmap_attr["pp100"]["aim"],
+            beatmap_attr["pp100"]["speed"],
+            beatmap_attr["pp100"]["accuracy"],
+            beatmap_attr["pp100"]["pp"],
+            beatmap_attr["pp92"],
+            beatmap_attr["pp81"],
+            beatmap_attr["pp67"],
+        )
+
+
+class CalculationGroup(NamedTuple):
+    job: PerformanceJob
+    calculations: list[ScoreCalculation]
+
+
+def _performance_key(performance: dict[str, int]) -> tuple[tuple[str, int], ...]:
+    return tuple(sorted(performance.items()))
+
+
+def group_score_calculations(calculations: Iterable[ScoreCalculation]) -> list[CalculationGroup]:
+    """把成绩按 (谱面, ruleset, mods) 分组，每组只需要一次 osu-tools 会话：解析谱面与计算难度一次，然后依次计算组内每个成绩的 pp，以及属性存储未命中时共享的 if pp
+
+    :param calculations: ScoreCalculation.prepare 的结果
+    :return: 需要计算的组
+    """
+    groups: dict[AttributeKey, list[ScoreCalculation]] = {}
+    for calculation in calculations:
+        groups.setdefault(calculation.key, []).append(calculation)
+    result = []
+    for members in groups.values():
+        first = members[0]
+        # 判定统计完全相同的成绩只计算一次
+        performances = {_performance_key(m.performance): m.performance for m in members}
+        job = PerformanceJob(
+            get_beatmap_path(first.beatmap.id),
+            first.score.ruleset_id,
+            first.my_attr.osu_tool_mods,
+            first.my_attr.osu_tool_mod_options,
+            list(performances.values()),
+            first.beatmap_attr is None,
+        )
+        result.append(CalculationGroup(job, members))
+    return result
+
+
+def apply_calculation_result(group: CalculationGroup, result: PerformanceResult) -> None:
+    """把一组的计算结果写入属性存储，并补全组内的每个成绩"""
+    performances = {_performance_key(performance): perf_attr for performance, perf_attr in zip(group.job.performances, result.performances, strict=True)}
+    if result.beatmap_attributes is not None:
+        get_attribute_store().put(group.calculations[0].key, result.beatmap_attributes, group.calculations[0].beatmap.id)
+    for calculation in group.calculations:
+        calculation.perf_got_attr = performances[_performance_key(calculation.performance)]
+        if calculation.beatmap_attr is None:
+            calculation.beatmap_attr = result.beatmap_attributes
+
+
+def calc_beatmap_attributes_batch(beatmaps: Mapping[int, Beatmap], scores: Mapping[str, SimpleScoreInfo]) -> dict[str, CompletedSimpleScoreInfo]:
+    """批量计算所需属性，这会覆盖 score 原本的 pp
+
+    谱面的属性（星级、技能属性与 if pp）先从属性存储中读取，成绩按 (谱面, ruleset, mods) 分组，每组只进行一次 osu-tools 计算：依次计算组内每个成绩的 pp，未命中时顺带计算谱面的属性
+
+    :param beatmaps: bid 到谱面的映射，需要包含 scores 中所有的谱面
+    :param scores: 成绩
+    :return: 补全后的成绩，与 scores 的键一致
+    """
+    prefetch_osu(beatmaps[score.bid] for score in scores.values())
+    calculations = {score_id: ScoreCalculation.prepare(beatmaps[score.bid], score) for score_id, score in scores.items()}
+    for group in group_score_calculations(calculations.values()):
+        apply_calculation_result(group, run_performance_job(group.job))
+    return {score_id: calculation.complete() for score_id, calculation in calculations.items()}
+
+
+def calc_beatmap_attributes(beatmap: Beatmap, score: SimpleScoreInfo) -> CompletedSimpleScoreInfo:
+    """完整计算所需属性，这会覆盖 score 原本的 pp"""
+    return calc_beatmap_attributes_batch({beatmap.id: beatmap}, {"": score})[""]
+
+
+class PpCurveCalculation(NamedTuple):
+    key: AttributeKey
+    bid: int
+    job: PerformanceJob
+
+
+def prepare_pp_curve_calculations(beatmaps: Mapping[int, Beatmap], items: Iterable[tuple[int, int, list[dict[str, Any]]]]) -> list[PpCurveCalculation]:
+    """为 (谱面, ruleset, mods) 准备 pp 曲线的计算
+
+    采样曲线需要的 pp 计算次数远多于保存成绩时的计算，因此不在保存成绩时进行，而是由后台程序的 ppcurves 命令为已经保存的成绩补全
+
+    :param beatmaps: bid 到谱面的映射，谱面文件需要事先下载；不在其中的项（例如谱面已被删除）被跳过
+    :param items: (bid, ruleset_id, 成绩的 mods)
+    :return: 需要计算的曲线，键相同的项只计算一次
+    """
+    calculations: dict[AttributeKey, PpCurveCalculation] = {}
+    for bid, ruleset_id, mods in items:
+        beatmap = beatmaps.get(bid)
+        if beatmap is None:
+            continue
+        # 与 ScoreCalculation.prepare 中的 SimpleDifficultyAttribute 保持一致
+        _, _, osu_tool_mods, osu_tool_mod_options = SimpleDifficultyAttribute.validate_and_transform_mods(mods, 0)
+        key = beatmap_attribute_key(beatmap, ruleset_id, osu_tool_mods, osu_tool_mod_options)
+        if key not in calculations:
+            calculations[key] = PpCurveCalculation(key, bid, PerformanceJob(get_beatmap_path(bid), ruleset_id, osu_tool_mods, osu_tool_mod_options, [], False, True))
+    return list(calculations.values())
+
+
+def apply_pp_curve_result(calculation: PpCurveCalculation, result: PerformanceResult) -> None:
+    """把计算得到的 pp 曲线写入属性存储"""
+    get_attribute_store().put_pp_curve(calculation.key, calculation.bid, result.pp_curve)
+
+
+def evaluate_pp_curves(curves: np.ndarray, accuracy: Any, misses: Any = 0) -> np.ndarray:
+    """在 pp 曲线上做双线性插值（沿准确率与 miss 数两个方向各做一次 np.interp），超出采样范围时取边界值
+
+    :param curves: 形状为 (n, len(PP_CURVE_MISSES), len(PP_CURVE_ACCURACIES)) 的曲线，缺失的曲线为 nan
+    :param accuracy: 准确率（%），标量或长度为 n 的数组
+    :param misses: miss 数，标量或长度为 n 的数组
+    :return: 长度为 n 的 pp
+    """
+    n = len(curves)
+    rows = np.arange(n)
+    # 采样点不均匀，先把准确率与 miss 数映射为网格上的小数下标
+    acc_pos = np.interp(np.broadcast_to(accuracy, n), PP_CURVE_ACCURACIES, np.arange(len(PP_CURVE_ACCURACIES)))
+    miss_pos = np.interp(np.broadcast_to(misses, n), PP_CURVE_MISSES, np.arange(len(PP_CURVE_MISSES)))
+    a0 = np.floor(acc_pos).astype(np.intp)
+    a1 = np.minimum(a0 + 1, len(PP_CURVE_ACCURACIES) - 1)
+    m0 = np.floor(miss_pos).astype(np.intp)
+    m1 = np.minimum(m0 + 1, len(PP_CURVE_MISSES) - 1)
+    wa = acc_pos - a0
+    wm = miss_pos - m0
+    curves = curves.astype(np.float64, copy=False)
+    pp_m0 = curves[rows, m0, a0] * (1 - wa) + curves[rows, m0, a1] * wa
+    pp_m1 = curves[rows, m1, a0] * (1 - wa) + curves[rows, m1, a1] * wa
+    return pp_m0 * (1 - wm) + pp_m1 * wm
+
+
+def get_pp_curves(bids: Iterable[int], ruleset_ids: Iterable[int], mods: Iterable[list[dict[str, Any]]]) -> np.ndarray:
+    """从属性存储中读取一批成绩对应的 pp 曲线
+
+    :param bids: 谱面 id
+    :param ruleset_ids: ruleset
+    :param mods: 成绩的 mods
+    :return: 形状为 (n, len(PP_CURVE_MISSES), len(PP_CURVE_ACCURACIES)) 的曲线，尚未计算过曲线的成绩为 nan
+    """
+    mods_keys: dict[bytes, str] = {}
+    items = []
+    for bid, ruleset_id, score_mods in zip(bids, ruleset_ids, mods, strict=True):
+        mods_json = orjson.dumps(score_mods)
+        if mods_json not in mods_keys:
+            # 与 prepare_pp_curve_calculations 保持一致
+            _, _, osu_tool_mods, osu_tool_mod_options = SimpleDifficultyAttribute.validate_and_transform_mods(score_mods, 0)
+            mods_keys[mods_json] = make_mods_key(osu_tool_mods, osu_tool_mod_options)
+        items.append((int(bid), int(ruleset_id), mods_keys[mods_json]))
+    shape = (len(PP_CURVE_MISSES), len(PP_CURVE_ACCURACIES))
+    curves = np.full((len(items), *shape), np.nan, dtype=np.float32)
+    found = get_attribute_store().get_pp_curves(items)
+    for i, item in enumerate(items):
+        curve = found.get(item)
+        # 采样点变化后，旧的曲线长度不同，视为缺失
+        if curve is not None and curve.size == curves[i].size:
+            curves[i] = curve.reshape(shape)
+    return curves
 
 
 def calc_positive_percent(score: int | float | None, min_score: int | float, max_score: int | float) -> int:
@@ -947,16 +1672,16 @@ def format_size(size_bytes):
 
 
 def regex_search_column(data: pd.DataFrame, column: str, pattern: str):
-    """对某一列进行正则搜索，有匹配则输出匹配内容，无匹配输出 None"""
-
-    def search_func(text):
-        if pd.isna(text):
-            return None
-        m = re.search(pattern, str(text))
-        # 这里改成 .group(0) 显示匹配内容，或者直接返回 text 显示原行
-        return text if m else None
+    """对某一列进行正则搜索，有匹配则保留原内容，无匹配输出 None
 
-    data[column] = data[column].apply(search_func)
+    相同的值只搜索一次；category 类型的列直接在类别上搜索，不匹配的类别被移除（输出缺失值）
+    """
+    values = data[column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        data[column] = values.cat.set_categories([c for c in values.cat.categories if re.search(pattern, str(c))])
+    else:
+        matched = [text for text in values.dropna().unique() if re.search(pattern, str(text))]
+        data[column] = values.where(values.isin(matched), None)
     return data
 
 
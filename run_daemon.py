@@ -9,22 +9,32 @@ import logging
 import os
 import os.path
 import pickle
-from dataclasses import asdict
-from datetime import datetime
+from collections.abc import AsyncIterator, Sequence
+from operator import itemgetter
 from shutil import rmtree
 from time import time
-from typing import Literal, Optional, cast
+from typing import Any, Literal, Optional, cast
 
+import numpy as np
 import orjson
+import pandas as pd
 import redis
 import requests
 import schedule
 import toml
 from clayutil.cmdparse import CollectionField as Coll, Command, CommandParser, IntegerField as Int, JSONStringField as JsonStr
 from ossapi.ossapiv2_async import Domain, Scope, Score
-from sqlalchemy import create_engine, text
+from sqlalchemy import bindparam, create_engine, text
 
 from osuawa import Awapi, OsuPlaylist, Osuawa
+from osuawa.beatmapfiles import BeatmapFileFetcher, create_beatmap_file_fetcher
+from osuawa.cache import create_cache_backend
+from osuawa.calculation import create_calculation_executor
+from osuawa.osuawa import CachedMixIn, get_background_loop
+from osuawa.ratelimit import create_rate_limiter
+from osuawa.schema import Migration, migrate
+from osuawa.scoresnapshot import create_score_snapshot_store
+from osuawa.scorewriter import create_score_writer
 from osuawa.utils import (
     BeatmapSpec,
     BeatmapToUpdate,
@@ -32,11 +42,18 @@ from osuawa.utils import (
     CompletedPlaylistBeatmap,
     CompletedSimpleScoreInfo,
     DatabasePlaylistBeatmap,
-    SimpleScoreInfo,
-    _build_update_ignore,
+    MOD_ADJUSTED_FIELDS,
+    SCORE_DERIVED_COLUMNS,
+    SCORE_DERIVED_FIELDS,
+    SCORE_DERIVED_VERSION,
+    SCORE_TABLE_COLUMNS,
     _build_upsert,
     _create_tmp_playlist_p,
+    get_pp_curves,
     push_task,
+    recalc_mod_adjusted_columns,
+    score_table_row,
+    scores_table_to_dataframe,
 )
 
 # streamlit settings
@@ -53,14 +70,11 @@ for _path in [
     C.OAUTH_TOKEN_DIRECTORY.value,
     os.path.join(C.OAUTH_TOKEN_DIRECTORY.value, "refresh"),
     C.COMPONENTS_SHELVES_DIRECTORY.value,
+    C.CACHE_DIRECTORY.value,
 ]:
     if not os.path.exists(_path):
         os.mkdir(_path)
 
-# asyncio event loop
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
-
 # logging
 formatter = logging.Formatter(st_config["logger"]["messageFormat"])
 ch = logging.StreamHandler()
@@ -103,36 +117,47 @@ engine = (
     )
 )
 logger.info("sql connected: %s" % _url)
+score_writer = create_score_writer(engine)
 
 r = redis.Redis(host="localhost", port=6379, db=0, decode_responses=True)
 logger.info("redis connected")
 
+# 与 streamlit 共享二级缓存
+CachedMixIn.configure_policies(st_secrets.get("cache", {}).get("policies"))
+CachedMixIn.set_persistent_cache(create_cache_backend(st_secrets.get("cache")))
+logger.info("persistent api cache: %s" % st_secrets.get("cache", {}).get("backend", "none"))
+# 与 streamlit 共享请求预算（仅当 backend 为 redis 时跨进程生效）
+Awapi.set_rate_limiter(create_rate_limiter(st_secrets.get("ratelimit")))
+logger.info("api rate limiter: %s" % st_secrets.get("ratelimit", {}).get("backend", "local"))
+Osuawa.set_calculation_executor(create_calculation_executor(st_secrets.get("calculation")))
+logger.info("calculation backend: %s" % st_secrets.get("calculation", {}).get("backend", "process"))
+BeatmapFileFetcher.set_default(create_beatmap_file_fetcher(st_secrets.get("beatmap_files")))
+logger.info("beatmap file rate limiter: %s" % st_secrets.get("beatmap_files", {}).get("ratelimit", {}).get("backend", "local"))
+# 页面优先读取这里维护的成绩快照
+score_snapshot_store = create_score_snapshot_store(st_secrets.get("score_snapshots"))
+logger.info("score snapshots: %s" % ("disabled" if score_snapshot_store is None else score_snapshot_store.directory))
+
 # Daemon 使用 Client Credentials Grant
-daemon_awa = Osuawa(loop, st_secrets["args"]["client_id"], st_secrets["args"]["client_secret"], None, [Scope.PUBLIC.value], Domain.OSU.value, "daemon", None, None)
+daemon_awa = Osuawa(get_background_loop(), st_secrets["args"]["client_id"], st_secrets["args"]["client_secret"], None, [Scope.PUBLIC.value], Domain.OSU.value, "daemon", None, None)
 logger.info("osu! api initialized")
 sem = asyncio.Semaphore(1)
 
-# 数据库需要以下表和字段
-# 1. 表 BEATMAP，字段固定为 BID, SID, INFO, SKILL_SLOT, SR, BPM, HIT_LENGTH, MAX_COMBO, CS, AR, OD, MODS, NOTES, STATUS, COMMENTS, POOL, SUGGESTOR, RAW_MODS, ADD_TS, U_ARTIST, U_TITLE （一个经过修改的课题字段，后续可以复用生成课题的代码，逻辑是一样的），使用 BID + MODS 作为主键
-# 2. 表 SCORE，字段与 CompletedSimpleScoreInfo 大体一致，另附加 SCORE_ID 字段作为主键
-# 3. 表 USER_CACHE，字段固定为 USER_ID, USERNAME, AID, LAST_SEEN_TS，AID 为主键
+
+def _log_migration(version: int, migration: Migration) -> None:
+    logger.info("migrated the database schema to version %d: %s" % (version, migration.description))
+
+
+def migrate_schema() -> str:
+    """执行尚未执行的表结构迁移"""
+    old_version, version = migrate(engine, _log_migration)
+    return "database schema version: %d -> %d" % (old_version, version)
+
+
+logger.info(migrate_schema())
 with engine.begin() as _conn:
-    _conn.execute(
-        text(
-            "CREATE TABLE IF NOT EXISTS BEATMAP(BID BIGINT, SID BIGINT, INFO TEXT, SKILL_SLOT TEXT, SR TEXT, BPM TEXT, HIT_LENGTH TEXT, MAX_COMBO TEXT, CS TEXT, AR TEXT, OD TEXT, MODS VARCHAR(255), NOTES TEXT, STATUS INT, COMMENTS TEXT, POOL TEXT, SUGGESTOR TEXT, RAW_MODS TEXT, ADD_TS REAL, U_ARTIST TEXT, U_TITLE TEXT, PRIMARY KEY (BID, MODS));",
-        ),
-    )
-    _conn.execute(
-        text(
-            "CREATE TABLE IF NOT EXISTS SCORE(SCORE_ID BIGINT, BID BIGINT, USER_ID BIGINT, SCORE INT, ACCURACY REAL, MAX_COMBO INT, PASSED INT, PP REAL, MODS TEXT, TS REAL, STATISTICS TEXT, ST REAL, RULESET_ID INT, \
-             CS REAL, HIT_WINDOW REAL, PREEMPT REAL, BPM REAL, HIT_LENGTH INT, IS_NF INT, IS_HD INT, IS_HIGH_AR INT, IS_LOW_AR INT, IS_VERY_LOW_AR INT, IS_SPEED_UP INT, IS_SPEED_DOWN INT, INFO TEXT, ORIGINAL_DIFFICULTY REAL, B_STAR_RATING REAL, B_MAX_COMBO INT, B_AIM_DIFFICULTY REAL, B_AIM_DIFFICULT_SLIDER_COUNT REAL, B_SPEED_DIFFICULTY REAL, B_SPEED_NOTE_COUNT REAL, B_SLIDER_FACTOR REAL, B_AIM_TOP_WEIGHTED_SLIDER_FACTOR REAL, B_SPEED_TOP_WEIGHTED_SLIDER_FACTOR REAL, B_AIM_DIFFICULT_STRAIN_COUNT REAL, B_SPEED_DIFFICULT_STRAIN_COUNT REAL, PP_AIM REAL, PP_SPEED REAL, PP_ACCURACY REAL, B_PP_100IF_AIM REAL, B_PP_100IF_SPEED REAL, B_PP_100IF_ACCURACY REAL, B_PP_100IF REAL, B_PP_92IF REAL, B_PP_81IF REAL, B_PP_67IF REAL, PRIMARY KEY (SCORE_ID));",
-        ),
-    )
-    _conn.execute(
-        text(
-            "CREATE TABLE IF NOT EXISTS USER_CACHE(USER_ID BIGINT, USERNAME TEXT, AID VARCHAR(36), LAST_SEEN_TS REAL, PRIMARY KEY (AID));",
-        ),
-    )
+    _pending_derived = _conn.execute(text("SELECT COUNT(*) FROM SCORE WHERE DERIVED_VERSION IS NULL OR DERIVED_VERSION < :version"), {"version": SCORE_DERIVED_VERSION}).scalar()
+if _pending_derived:
+    logger.warning("%d scores have no derived columns yet, run `backfill` to compute them" % _pending_derived)
 
 
 def commands():
@@ -154,7 +179,7 @@ def commands():
                 ),
             ],
             0,
-            save_recent_scores,
+            update_recent_scores,
         ),
         Command(
             "beatmap",
@@ -165,17 +190,86 @@ def commands():
             0,
             update_beatmaps,
         ),
+        Command(
+            "backfill",
+            "compute derived columns of existing scores",
+            [],
+            0,
+            backfill_score_derived_columns,
+        ),
+        Command(
+            "reanalyse",
+            "recompute mod-adjusted and derived columns of all scores",
+            [],
+            0,
+            reanalyse_scores,
+        ),
+        Command(
+            "ppcurves",
+            "compute pp curves of saved scores",
+            [],
+            0,
+            backfill_pp_curves,
+        ),
+        Command(
+            "migrate",
+            "run pending database schema migrations",
+            [],
+            0,
+            migrate_schema,
+        ),
     ]
 
 
-async def async_save_recent_scores(user: int, include_fails: bool) -> tuple[str, dict[str, CompletedSimpleScoreInfo]]:
-    """返回 (username, completed_recent_scores_compact)"""
-    user_scores: list[Score] = await daemon_awa.async_get_recent_scores(user, include_fails)
-    recent_scores_compact: dict[str, SimpleScoreInfo] = {str(user_score.id): SimpleScoreInfo.from_score(user_score) for user_score in user_scores}
-    return await asyncio.gather(
-        daemon_awa.async_get_username(user),
-        daemon_awa.complete_scores_compact(recent_scores_compact),
-    )
+def _get_known_score_ids(score_ids: list[int]) -> set[int]:
+    """批量查询已经保存过的成绩"""
+    if len(score_ids) == 0:
+        return set()
+    with engine.begin() as conn:
+        return set(
+            conn.execute(
+                text("SELECT SCORE_ID FROM SCORE WHERE SCORE_ID IN :score_ids").bindparams(bindparam("score_ids", expanding=True)),
+                {"score_ids": score_ids},
+            ).scalars(),
+        )
+
+
+def _get_watermark(user: int) -> Optional[tuple[int, float]]:
+    with engine.begin() as conn:
+        row = conn.execute(text("SELECT SCORE_ID, TS FROM SCORE_WATERMARK WHERE USER_ID = :user"), {"user": user}).first()
+    return None if row is None else (int(row[0]), float(row[1]))
+
+
+def _set_watermark(user: int, score_id: int, ts: float) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO SCORE_WATERMARK (USER_ID, SCORE_ID, TS) VALUES (:user, :score_id, :ts) %s" % _build_upsert(_dialect, ["SCORE_ID", "TS"], ["USER_ID"])),
+            {"user": user, "score_id": score_id, "ts": ts},
+        )
+
+
+async def aiter_new_recent_scores(user: int, include_fails: bool, incremental: bool, seen: list[Score]) -> AsyncIterator[list[Score]]:
+    """按页产出尚未保存的最近成绩
+
+    :param user: 用户
+    :param include_fails: 是否包含失败的成绩
+    :param incremental: 是否在遇到已经完整同步过的页面（整页都已保存且到达水位线）时停止分页，没有水位线时获取全部页面
+    :param seen: 获取到的所有成绩（无论是否已保存）会追加到这里，用于统计和更新水位线
+    :return: 异步迭代器，每次产出一页中尚未保存的成绩
+    """
+    watermark = _get_watermark(user) if incremental else None
+    async for page in daemon_awa.aiter_recent_scores(user, include_fails):
+        seen.extend(page)
+        known_score_ids = await asyncio.to_thread(_get_known_score_ids, [score.id for score in page])
+        new_scores = [score for score in page if score.id not in known_score_ids]
+        if len(new_scores) > 0:
+            yield new_scores
+        if not incremental:
+            continue
+        # 最近成绩按时间倒序排列：整页都已保存且已到达水位线，说明更早的成绩在之前的完整同步中已经处理过
+        # 只有整页都已保存并不足以停止：上一次同步可能在保存了较新的页面后中途失败，更早的页面仍未保存
+        if len(new_scores) == 0 and watermark is not None and any(score.id <= watermark[0] for score in page):
+            break
 
 
 def get_all_score_users() -> list[int]:
@@ -187,50 +281,209 @@ def get_all_score_users() -> list[int]:
         )
 
 
-def save_recent_scores(user: int, include_fails: bool = True) -> str:
-    username, completed_recent_scores_compact = daemon_awa.run_coro(async_save_recent_scores(user, include_fails))
+_get_derived_values = itemgetter(*(column.lower() for column in SCORE_DERIVED_COLUMNS))
+
+
+def _score_derived_records(df: pd.DataFrame) -> dict[str, dict[str, Any]]:
+    """把成绩 DataFrame 中的 SCORE_DERIVED_FIELDS 转换为 SCORE_DERIVED_COLUMNS 对应的 SQL 参数
+
+    :return: score_id 到参数的映射，参数名为小写的列名，缺失值为 None
+    """
+    derived = df.set_index("score_id")[SCORE_DERIVED_FIELDS].rename(columns=dict(zip(SCORE_DERIVED_FIELDS, (column.lower() for column in SCORE_DERIVED_COLUMNS), strict=False)))
+    derived["only_common_mods"] = derived["only_common_mods"].astype(int)
+    derived["derived_version"] = SCORE_DERIVED_VERSION
+    return derived.astype(object).where(derived.notna(), None).to_dict("index")
+
+
+def _insert_scores(completed_scores_compact: dict[str, CompletedSimpleScoreInfo]) -> tuple[int, list[tuple]]:
+    """插入到表 SCORE，如果遇到冲突，则放弃
+
+    :return: (实际插入的行数, 尝试插入的行，按 SCORE_TABLE_COLUMNS + SCORE_DERIVED_COLUMNS 排列)
+    """
+    if len(completed_scores_compact) == 0:
+        return 0, []
+    # 派生字段在入库时一次性计算，读取时不再计算
+    derived = _score_derived_records(daemon_awa.create_scores_dataframe(completed_scores_compact))
+    # todo: 默认的时间是倒序的，是否有必要转换为正序？（可能只是一些强迫症需求罢了）
+    rows = [(*score_table_row(pk, score), *_get_derived_values(derived[pk])) for pk, score in completed_scores_compact.items()]
+    with engine.begin() as conn:
+        return score_writer.write(conn, rows), rows
+
+
+def update_recent_scores(user: int) -> str:
+    return save_recent_scores(user, incremental=True)
+
+
+def _update_score_snapshot(user: int, rows: Optional[Sequence[Sequence[Any]]] = None) -> int:
+    """把成绩追加到用户的快照中
+
+    :param user: 用户
+    :param rows: 刚刚插入 SCORE 表的行（按 SCORE_TABLE_COLUMNS + SCORE_DERIVED_COLUMNS 排列），直接追加，开销只与新成绩的数量有关；
+        为 None 时（或快照不存在时）与 SCORE 表中该用户的全部成绩比较，追加快照中缺少的成绩，开销与成绩总数有关，只用于生成和重新生成快照
+    :return: 追加的行数
+    """
+    if score_snapshot_store is None:
+        return 0
+    if rows is not None and score_snapshot_store.exists(user):
+        return score_snapshot_store.append(user, rows)
+    known_score_ids = score_snapshot_store.score_ids(user)
+    rows = []
     with engine.begin() as conn:
-        # 插入到表 SCORE，如果遇到冲突，则放弃
-        # 准备数据
-        scores = []
-        for pk, _v in completed_recent_scores_compact.items():
-            score = asdict(
-                _v,
-                dict_factory=lambda items: {k.lstrip("_"): None if v is None else v.timestamp() if isinstance(v, datetime) else int(v) if isinstance(v, bool) else orjson.dumps(v).decode("utf-8") if isinstance(v, (list, dict)) else v for k, v in items},
+        score_ids = [score_id for score_id in conn.execute(text("SELECT SCORE_ID FROM SCORE WHERE USER_ID = :user"), {"user": user}).scalars() if score_id not in known_score_ids]
+        for i in range(0, len(score_ids), 1000):
+            rows.extend(
+                conn.execute(
+                    text("SELECT %s FROM SCORE WHERE SCORE_ID IN :score_ids" % ", ".join([*SCORE_TABLE_COLUMNS, *SCORE_DERIVED_COLUMNS])).bindparams(bindparam("score_ids", expanding=True)),
+                    {"score_ids": score_ids[i : i + 1000]},
+                ).all(),
             )
-            score["score_id"] = pk
-            # todo: 默认的时间是倒序的，是否有必要转换为正序？（可能只是一些强迫症需求罢了）
-            scores.append(score)
-        if len(scores) > 0:
-            res = conn.execute(
-                text(
-                    _build_update_ignore(
-                        _dialect,
-                        """INSERT INTO SCORE (SCORE_ID, BID, USER_ID, SCORE, ACCURACY, MAX_COMBO, PASSED, PP, MODS, TS, STATISTICS, ST, RULESET_ID, CS, HIT_WINDOW, PREEMPT, BPM, HIT_LENGTH, IS_NF, IS_HD, IS_HIGH_AR, IS_LOW_AR, IS_VERY_LOW_AR, IS_SPEED_UP,
-                                              IS_SPEED_DOWN, INFO, ORIGINAL_DIFFICULTY, B_STAR_RATING, B_MAX_COMBO, B_AIM_DIFFICULTY, B_AIM_DIFFICULT_SLIDER_COUNT, B_SPEED_DIFFICULTY, B_SPEED_NOTE_COUNT, B_SLIDER_FACTOR, B_AIM_TOP_WEIGHTED_SLIDER_FACTOR,
-                                              B_SPEED_TOP_WEIGHTED_SLIDER_FACTOR, B_AIM_DIFFICULT_STRAIN_COUNT, B_SPEED_DIFFICULT_STRAIN_COUNT, PP_AIM, PP_SPEED, PP_ACCURACY, B_PP_100IF_AIM, B_PP_100IF_SPEED, B_PP_100IF_ACCURACY, B_PP_100IF, B_PP_92IF,
-                                              B_PP_81IF, B_PP_67IF)
-                           VALUES (:score_id, :bid, :user, :score, :accuracy, :max_combo, :passed, :pp, :mods, :ts, :statistics, :st, :ruleset_id, :cs, :hit_window, :preempt, :bpm, :hit_length, :is_nf, :is_hd, :is_high_ar, :is_low_ar, :is_very_low_ar,
-                                   :is_speed_up, :is_speed_down, :info, :original_difficulty, :b_star_rating, :b_max_combo, :b_aim_difficulty, :b_aim_difficult_slider_count, :b_speed_difficulty, :b_speed_note_count, :b_slider_factor,
-                                   :b_aim_top_weighted_slider_factor, :b_speed_top_weighted_slider_factor, :b_aim_difficult_strain_count, :b_speed_difficult_strain_count, :pp_aim, :pp_speed, :pp_accuracy, :b_pp_100if_aim, :b_pp_100if_speed,
-                                   :b_pp_100if_accuracy, :b_pp_100if, :b_pp_92if, :b_pp_81if, :b_pp_67if)""",
-                        ["SCORE_ID"],
-                    ),
-                ),
-                scores,
+    return score_snapshot_store.append(user, rows)
+
+
+def backfill_score_derived_columns(batch_size: int = 2000) -> str:
+    """计算迁移之前保存的成绩（以及按旧的 SCORE_DERIVED_VERSION 计算的成绩）的派生字段，并重新生成这些用户的快照
+
+    :param batch_size: 每个事务更新的行数
+    """
+    count = 0
+    users: set[int] = set()
+    while True:
+        with engine.begin() as conn:
+            table = pd.read_sql(
+                text("SELECT %s FROM SCORE WHERE DERIVED_VERSION IS NULL OR DERIVED_VERSION < :version LIMIT %d" % (", ".join(SCORE_TABLE_COLUMNS), batch_size)),
+                conn,
+                params={"version": SCORE_DERIVED_VERSION},
             )
+            if len(table) == 0:
+                break
+            records = _score_derived_records(daemon_awa.extend_scores_dataframe(scores_table_to_dataframe(table)))
+            conn.execute(
+                text("UPDATE SCORE SET %s WHERE SCORE_ID = :score_id" % ", ".join("%s = :%s" % (column, column.lower()) for column in SCORE_DERIVED_COLUMNS)),
+                [{**record, "score_id": int(score_id)} for score_id, record in records.items()],
+            )
+        count += len(table)
+        users.update(table.iloc[:, SCORE_TABLE_COLUMNS.index("USER_ID")].tolist())
+        logger.info("backfilled derived columns of %d scores" % count)
+    # 快照中的派生字段已经过时
+    if score_snapshot_store is not None:
+        for user in users:
+            score_snapshot_store.remove(user)
+            _update_score_snapshot(user)
+    return "backfilled %d scores of %d users" % (count, len(users))
 
-            len_diff = res.rowcount
-        else:
-            len_diff = 0
+
+def reanalyse_scores(batch_size: int = 2000) -> str:
+    """按谱面的原始属性与成绩的 mods 重新计算所有成绩中经过 mods 调整的列（CS、HIT_WINDOW、PREEMPT、IS_HD 等）与派生列，只更新发生变化的行
+
+    修改了 mods 的调整方式（SimpleDifficultyAttribute.set_mods 与 calc_mod_adjusted_attributes）之后使用，谱面的原始属性来自 osu! api；
+    计算方式没有变化时，批量计算的结果与保存成绩时逐个计算的结果一致，不会更新任何行
+
+    :param batch_size: 每批读取的行数
+    """
+    count = 0
+    changed = 0
+    users: set[int] = set()
+    last_score_id = -1
+    update = text("UPDATE SCORE SET %s WHERE SCORE_ID = :score_id" % ", ".join("%s = :%s" % (column, column.lower()) for column in [*(name.upper() for name in MOD_ADJUSTED_FIELDS), *SCORE_DERIVED_COLUMNS]))
+    while True:
+        with engine.begin() as conn:
+            table = pd.read_sql(text("SELECT %s FROM SCORE WHERE SCORE_ID > :last_score_id ORDER BY SCORE_ID LIMIT %d" % (", ".join(SCORE_TABLE_COLUMNS), batch_size)), conn, params={"last_score_id": last_score_id})
+        if len(table) == 0:
+            break
+        count += len(table)
+        last_score_id = int(table.iloc[-1, 0])
+        df = scores_table_to_dataframe(table)
+        beatmaps = daemon_awa.run_coro(daemon_awa.async_get_beatmaps_dict(sorted(set(df["bid"].tolist()))))
+        df = df[recalc_mod_adjusted_columns(df, beatmaps)].reset_index(drop=True)
+        if len(df) > 0:
+            adjusted = df.set_index("score_id")[MOD_ADJUSTED_FIELDS].astype({name: int for name in MOD_ADJUSTED_FIELDS if name.startswith("is_")})
+            adjusted = adjusted.astype(object).where(adjusted.notna(), None).to_dict("index")
+            records = _score_derived_records(daemon_awa.extend_scores_dataframe(df))
+            with engine.begin() as conn:
+                conn.execute(update, [{**adjusted[score_id], **record, "score_id": int(score_id)} for score_id, record in records.items()])
+            changed += len(df)
+            users.update(df["user"].tolist())
+        logger.info("reanalysed %d scores, %d changed" % (count, changed))
+    if score_snapshot_store is not None:
+        for user in users:
+            score_snapshot_store.remove(user)
+            _update_score_snapshot(user)
+    return "reanalysed %d scores, %d changed of %d users" % (count, changed, len(users))
+
+
+def backfill_pp_curves(batch_size: int = 200) -> str:
+    """为已经保存的成绩中尚无 pp 曲线的 (谱面, ruleset, mods) 计算曲线
+
+    采样一条曲线需要 96 次 pp 计算，而保存成绩时每个 (谱面, mods) 只需要 4 次，因此保存成绩时不采样曲线，由本命令在保存之后补全
+
+    :param batch_size: 每批计算的组合数
+    """
+    with engine.begin() as conn:
+        pairs = [(int(bid), int(ruleset_id), orjson.loads(mods or "[]")) for bid, ruleset_id, mods in conn.execute(text("SELECT DISTINCT BID, RULESET_ID, MODS FROM SCORE"))]
+    count = 0
+    missing = 0
+    for i in range(0, len(pairs), batch_size):
+        batch = pairs[i : i + batch_size]
+        bids, ruleset_ids, mods = zip(*batch, strict=True)
+        curves = get_pp_curves(bids, ruleset_ids, mods)
+        batch = [item for item, is_missing in zip(batch, np.isnan(curves[:, 0, 0]), strict=True) if is_missing]
+        if len(batch) == 0:
+            continue
+        missing += len(batch)
+        count += daemon_awa.run_coro(daemon_awa.complete_pp_curves(batch))
+        logger.info("checked pp curves of %d/%d (beatmap, mods) pairs, computed %d" % (min(i + batch_size, len(pairs)), len(pairs), count))
+    return "computed %d pp curves for %d of %d (beatmap, mods) pairs" % (count, missing, len(pairs))
+
+
+def save_recent_scores(user: int, include_fails: bool = True, incremental: bool = False) -> str:
+    """保存用户的最近成绩，只有尚未保存的成绩才会被补全和计算
+
+    :param user: 用户
+    :param include_fails: 是否包含失败的成绩
+    :param incremental: 增量同步，遇到已经同步过的页面即停止分页
+    """
+    username = daemon_awa.run_coro(daemon_awa.async_get_username(user))
+    seen: list[Score] = []
+    diff = 0
+    inserted_rows: list[tuple] = []
+    exact = True
+    try:
+        # 每补全一页就写入一页，内存中只保留少量页面，中途失败时已写入的成绩也不会丢失
+        for completed_page in daemon_awa.run_aiter(daemon_awa.aiter_complete_scores(aiter_new_recent_scores(user, include_fails, incremental, seen))):
+            inserted, rows = _insert_scores(completed_page)
+            diff += inserted
+            inserted_rows.extend(rows)
+            # 有成绩在查询之后被其他任务写入时，尝试插入的行与实际插入的行不一致，此时不能直接追加
+            exact = exact and inserted == len(rows)
+    finally:
+        # 中途失败时同样追加已经写入的成绩；快照只是读取加速，失败不影响保存的结果
+        try:
+            _update_score_snapshot(user, inserted_rows if exact else None)
+        except Exception as e:
+            logger.warning("failed to update the score snapshot of user %d: %s" % (user, e))
+            # 快照中缺少了这些成绩，删除后在下一次保存时重新生成
+            if score_snapshot_store is not None:
+                score_snapshot_store.remove(user)
+    # 只有完整同步后才推进水位线，否则中途失败时更早的页面会在下一次增量同步中被跳过
+    if len(seen) > 0:
+        watermark = _get_watermark(user)
+        newest = max(seen, key=lambda score: score.id)
+        if watermark is None or newest.id > watermark[0]:
+            _set_watermark(user, newest.id, newest.ended_at.timestamp())
+    got = len(seen)
     # noinspection PyStringFormat
     return "%s: got/diff: %d/%d" % (
         username,
-        len(completed_recent_scores_compact),
-        len_diff,
+        got,
+        diff,
     )
 
 
+def _log_prefetch_progress(done: int, total: int) -> None:
+    if done == total or done % 20 == 0:
+        logger.info("prefetched %d/%d beatmap files" % (done, total))
+
+
 # noinspection PyTypedDict
 def create_tmp_playlist(name: str, beatmap_specs: list[BeatmapSpec]) -> list[DatabasePlaylistBeatmap]:
     """创建临时课题。仅创建，不生成
@@ -254,6 +507,8 @@ def create_tmp_playlist(name: str, beatmap_specs: list[BeatmapSpec]) -> list[Dat
     # noinspection PyBroadException
     try:
         tmp_playlist = OsuPlaylist(daemon_awa, tmp_playlist_filename, css_style=1)  # 这里 css_style 不知道用哪一个好
+        # 先下载全部谱面文件，生成课题时的计算不再等待网络
+        daemon_awa.run_coro(BeatmapFileFetcher.get_default().prefetch((element["beatmap"] for element in tmp_playlist.beatmap_list), progress=_log_prefetch_progress))
         playlist_beatmaps_raw: list[CompletedPlaylistBeatmap] = daemon_awa.run_coro(tmp_playlist.playlist_task())  # 这里面每一个 dict 都表示一个 playlist beatmap
     except Exception as e:  # 这里无法确定是什么东西报错了，因为内部是 async 的 TaskGroup  # noqa: E722
         raise ValueError("failed to parse the spec(s): %s" % beatmap_specs) from e
@@ -435,6 +690,12 @@ def setup_scheduled_tasks():
         r,
         "update .*",
     )
+    # 在更新成绩之后补全新成绩的 pp 曲线
+    schedule.every(12).hours.do(
+        push_task,
+        r,
+        "ppcurves",
+    )
     schedule.every(1).hour.do(
         cleanup_ald_tasks_status,
     )
@@ -499,6 +760,10 @@ push_task(
     r,
     "update .*",
 )
+push_task(
+    r,
+    "ppcurves",
+)
 setup_scheduled_tasks()
 cleanup_ald_tasks_status()
 refresh_oauth_token()
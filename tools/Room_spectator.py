@@ -4,7 +4,7 @@ import streamlit as st
 
 from osuawa import Osuawa
 from osuawa.components import init_page
-from osuawa.utils import CompletedSimpleScoreInfo, SimpleScoreInfo
+from osuawa.utils import CompletedSimpleScoreInfo
 
 if TYPE_CHECKING:
 
@@ -16,12 +16,6 @@ if TYPE_CHECKING:
 init_page(_("Room Spectator") + " - osuawa")
 
 
-async def create_multiplayer_scores_dataframe(room_ids: list[int]) -> dict[str, CompletedSimpleScoreInfo]:
-    scores = await st.session_state.awa.async_get_rooms_scores(room_ids)
-    scores_compact = {str(score.id): SimpleScoreInfo.from_score(score) for score in scores}
-    return await st.session_state.awa.complete_scores_compact(scores_compact)
-
-
 room_ids_input = st.text_input(_("Room IDs, separated by spaces"), key="mp_room_id")
 
 room_ids: list[int] = []
@@ -30,5 +24,12 @@ if room_ids_input is None or room_ids_input == "":
 else:
     room_ids = [int(room_id) for room_id in room_ids_input.split()]
 
-df = st.session_state.awa.create_scores_dataframe(st.session_state.awa.run_coro(create_multiplayer_scores_dataframe(room_ids)))
-st.dataframe(df)
+# 每补全一页成绩就刷新一次表格，大房间不必等到全部成绩下载完成
+completed_scores_compact: dict[str, CompletedSimpleScoreInfo] = {}
+df_placeholder = st.empty()
+for completed_page in st.session_state.awa.run_aiter(st.session_state.awa.aiter_complete_scores(st.session_state.awa.aiter_rooms_scores(room_ids))):
+    completed_scores_compact.update(completed_page)
+    df_placeholder.dataframe(st.session_state.awa.create_scores_dataframe(completed_scores_compact))
+if not completed_scores_compact:
+    # 没有任何成绩时循环内不会绘制，仍然显示一个空表格
+    df_placeholder.dataframe(st.session_state.awa.create_scores_dataframe(completed_scores_compact))
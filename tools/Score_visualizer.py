@@ -8,7 +8,7 @@ from plotly import figure_factory as ff
 from scipy import stats
 
 from osuawa.components import get_all_score_users, get_scores_dataframe, init_page, memorized_multiselect, memorized_selectbox
-from osuawa.utils import calc_bin_size, regex_search_column
+from osuawa.utils import calc_bin_size, filter_mods, regex_search_column
 
 if TYPE_CHECKING:
 
@@ -19,6 +19,13 @@ init_page(_("Score Visualizer") + " - osuawa")
 all_users = get_all_score_users()
 user = st.selectbox(_("User"), all_users)
 st.date_input(_("Date range"), [date.today() - timedelta(days=30), date.today() + timedelta(days=1)], key="cat_date_range")
+st.text_input(_("Extra if accuracies (%, comma separated)"), "95, 98", key="cat_pp_if")
+try:
+    # 由属性存储中的 pp 曲线插值得到，不调用 osu-tools
+    pp_if_accuracies = tuple(float(x) for x in st.session_state.cat_pp_if.replace("，", ",").split(",") if x.strip() != "")
+except ValueError:
+    st.error(_("invalid accuracy list"))
+    pp_if_accuracies = ()
 
 CO = "#FF6A6A"
 CC = "#4C95D9"
@@ -47,6 +54,8 @@ def calc_pp_overall_count(data: pd.DataFrame, tag: Optional[str] = None) -> str:
 def apply_filter(data: pd.DataFrame) -> pd.DataFrame:
     srl, srh = st.session_state.cat_sr_range
     df1 = regex_search_column(data, "mods", st.session_state.cat_mods)
+    if st.session_state.cat_mods_required or st.session_state.cat_mods_excluded:
+        df1 = df1[filter_mods(df1, st.session_state.cat_mods_required, st.session_state.cat_mods_excluded)]
     if srl == 0.0 and srh == 10.0:
         # 0 - 10 视为无限制
         df2: pd.DataFrame = df1[((not st.session_state.cat_passed) | df1["passed"]) & ((not st.session_state.cat_acm) | df1["only_common_mods"])]
@@ -100,13 +109,22 @@ def generate_stats_dataframe(data: pd.DataFrame, indexes: list[str]) -> pd.DataF
 
 
 begin_date, end_date = st.session_state.cat_date_range
-df = get_scores_dataframe(user, (begin_date, end_date))
+df = get_scores_dataframe(user, (begin_date, end_date), pp_if_accuracies)
 if len(df) == 0:
     st.error(_("no scores found"))
     st.stop()
 dfp = df[df["passed"]]
 st.link_button(_("User profile"), f"https://osu.ppy.sh/users/{user}")
 
+if pp_if_accuracies:
+    # 尚未计算过 pp 曲线（由后台程序的 ppcurves 命令补全）的成绩不计入，单独列出数量
+    pp_if_missing = int(dfp["b_pp_%gif" % pp_if_accuracies[0]].isna().sum())
+    pp_if_overall = "if %s %spp" % ("/".join("%g%%" % acc for acc in pp_if_accuracies), "/".join("%.2f" % dfp["b_pp_%gif" % acc].sum() for acc in pp_if_accuracies))
+    if pp_if_missing > 0:
+        pp_if_overall += " (%s)" % (_("%d passed score(s) without pp curves are excluded") % pp_if_missing)
+else:
+    pp_if_overall = ""
+
 with st.container(border=True):
     st.markdown(_("## PP Overall"))
     st.markdown(
@@ -114,6 +132,8 @@ with st.container(border=True):
 
 got/100/92/81/67 {dfp["pp"].sum():.2f}/{dfp["b_pp_100if"].sum():.2f}/{dfp["b_pp_92if"].sum():.2f}/{dfp["b_pp_81if"].sum():.2f}/{dfp["b_pp_67if"].sum():.2f}pp
 
+{pp_if_overall}
+
 | tag         | got (passed)                                  | if (passed)                                 | count (total)                                 |
 | ----------- | --------------------------------------------- | ------------------------------------------- | --------------------------------------------- |
 | hd          | {calc_pp_overall_main(dfp, "is_hd")}          | {calc_pp_overall_if(dfp, "is_hd")}          | {calc_pp_overall_count(df, "is_hd")}          |
@@ -129,6 +149,9 @@ got/100/92/81/67 {dfp["pp"].sum():.2f}/{dfp["b_pp_100if"].sum():.2f}/{dfp["b_pp_
 
 with st.expander(_("Filtering")):
     st.text_input(_("Mods filter (regex)"), key="cat_mods")
+    mods_acronyms = sorted(set().union(*(c.acronyms for c in df.attrs.get("mod_combinations", ()))))
+    st.multiselect(_("Required mods"), mods_acronyms, key="cat_mods_required")
+    st.multiselect(_("Excluded mods"), mods_acronyms, key="cat_mods_excluded")
     st.slider(_("Star rating"), 0.0, 10.0, (1.5, 8.5), key="cat_sr_range")
     st.checkbox(_("Passed only"), key="cat_passed")
     st.checkbox(_("Common mods only"), key="cat_acm")
@@ -165,7 +188,7 @@ df_o = apply_filter(df)
 with st.container(border=True):
     st.markdown(_("## Playing Preferences"))
     comp_user = st.selectbox(_("Compared to"), all_users)
-    df_c = get_scores_dataframe(comp_user, (begin_date, end_date))
+    df_c = get_scores_dataframe(comp_user, (begin_date, end_date), pp_if_accuracies)
     stats_indexes = [
         "accuracy",
         "hit_window",
@@ -187,6 +210,7 @@ with st.container(border=True):
         "pp_92pct",
         "pp_81pct",
         "pp_67pct",
+        *("pp_%gpct" % acc for acc in pp_if_accuracies),
         "combo_pct",
         "density",
         "aim_density_ratio",